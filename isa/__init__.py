@@ -97,6 +97,10 @@ login_manager.login_message_category = 'danger'
 CSRFProtect(app)
 
 
+# Seconds before Redis redelivers a task that hasn't been acknowledged.
+CELERY_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+
 def celery_init_app(app):
     class FlaskTask(Task):
         def __call__(self, *args, **kwargs):
@@ -104,13 +108,34 @@ def celery_init_app(app):
                 return self.run(*args, **kwargs)
 
     celery_app = Celery(app.name, task_cls=FlaskTask)
-    celery_app.config_from_object(app.config["CELERY"])
+    celery_config = dict(app.config["CELERY"])
+    # Image updates are acknowledged late and can run for hours. Redis
+    # redelivers tasks that aren't acknowledged within the visibility
+    # timeout, one hour by default, so allow longer unless configured.
+    celery_config["broker_transport_options"] = {
+        "visibility_timeout": CELERY_VISIBILITY_TIMEOUT,
+        **celery_config.get("broker_transport_options", {})
+    }
+    celery_app.config_from_object(celery_config)
     celery_app.set_default()
     app.extensions["celery"] = celery_app
     return celery_app
 
 
 celery_app = celery_init_app(app)
+# Periodic tasks, run by Celery beat. Schedules with the same name in
+# the config take precedence.
+celery_app.conf.beat_schedule = {
+    'reconcile-campaign-counters': {
+        'task': 'isa.campaigns.stats.reconcile_campaign_counters_task',
+        'schedule': app.config.get('CAMPAIGN_COUNTERS_RECONCILE_INTERVAL', 3600),
+    },
+    'write-yearly-stats-snapshot': {
+        'task': 'isa.main.yearly_stats.write_snapshot_task',
+        'schedule': app.config.get('YEARLY_STATS_SNAPSHOT_INTERVAL', 86400),
+    },
+    **(celery_app.conf.beat_schedule or {})
+}
 
 # we import all our blueprint routes here
 from isa.campaigns.routes import campaigns as campaigns_blueprint
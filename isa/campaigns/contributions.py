@@ -0,0 +1,213 @@
+"""Make contribution edits on Commons and record them
+
+Used by the contribution route, either directly or through a Celery
+task when ASYNC_CONTRIBUTIONS is set in the config.
+
+"""
+
+from datetime import datetime
+import logging
+
+from celery import shared_task
+import requests
+
+from isa import app, db
+from isa.campaigns import stats
+from isa.campaigns.utils import (make_edit_api_call, generate_csrf_token, invalidate_csrf_token,
+                                 BadTokenException)
+from isa.main.utils import commit_changes_to_db
+from isa.models import Contribution, Suggestion, User
+from isa.utils import cache
+
+VALID_ACTIONS = [
+    "wbsetclaim",
+    "wbremoveclaims",
+    "wbsetlabel"
+]
+SUGGESTION_KEYS = ['google_vision', 'metadata_to_concept']
+
+# Statuses for each edit.
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+# The edit wasn't made because an earlier edit failed.
+SKIPPED = "skipped"
+
+
+def is_valid_edit(data):
+    """
+    Check that an edit uses one of the allowed API actions
+
+    Keyword arguments:
+    data -- Contribution data for one edit.
+    """
+    return data["api_options"]["action"] in VALID_ACTIONS
+
+
+def make_edits(contrib_data_list, user_id, access_token, on_edit=None):
+    """
+    Make edits on Commons, one after another
+
+    The revision id of each edit is used as baserevid for the next one.
+    If an edit fails, also when its API request fails, the remaining
+    edits are skipped. A contribution is recorded as soon as its edit is
+    made. Suggestions in the data of the edits that were made are
+    recorded after the last edit.
+
+    Keyword arguments:
+    contrib_data_list -- Contribution data for each edit, as sent by the
+      client.
+    user_id -- Id of the user making the edits.
+    access_token -- The user's OAuth access token, as a dict with "key"
+      and "secret".
+    on_edit -- Called with the list of results after each edit. Defaults
+      to None.
+
+    Returns:
+    A list with a result for each edit, as dicts with "status" and
+    "revision_id".
+    """
+    user = User.query.get(user_id)
+    results = [{"status": PENDING, "revision_id": None} for _ in contrib_data_list]
+    # The same token is used for all the edits. It's requested before the
+    # first edit.
+    csrf_token = api_auth_token = None
+    for i, data in enumerate(contrib_data_list):
+        try:
+            if csrf_token is None:
+                csrf_token, api_auth_token = _get_csrf_token(access_token)
+            try:
+                lastrevid = make_edit_api_call(csrf_token, api_auth_token, data)
+            except BadTokenException:
+                # The cached token is no longer valid. Get a new one and
+                # try the edit again, once.
+                invalidate_csrf_token(access_token['key'], access_token['secret'])
+                csrf_token, api_auth_token = _get_csrf_token(access_token)
+                try:
+                    lastrevid = make_edit_api_call(csrf_token, api_auth_token, data)
+                except BadTokenException:
+                    invalidate_csrf_token(access_token['key'], access_token['secret'])
+                    lastrevid = None
+        except requests.RequestException:
+            # E.g. a timeout. The edits that were made are kept and
+            # reported.
+            logging.exception("Edit {} of {} failed.".format(i + 1, len(contrib_data_list)))
+            lastrevid = None
+
+        if lastrevid is None:
+            results[i]["status"] = FAILED
+            for result in results[i + 1:]:
+                result["status"] = SKIPPED
+            if on_edit is not None:
+                on_edit(results)
+            break
+
+        results[i] = {"status": DONE, "revision_id": lastrevid}
+        _record_contribution(user, data)
+        if i + 1 < len(contrib_data_list):
+            # The next edit is based on the revision made by this one
+            contrib_data_list[i + 1]['api_options']['baserevid'] = lastrevid
+        if on_edit is not None:
+            on_edit(results)
+
+    made_edits = [data for data, result in zip(contrib_data_list, results) if result["status"] == DONE]
+    if made_edits:
+        _record_suggestions(user, made_edits)
+    return results
+
+
+def _get_csrf_token(access_token):
+    return generate_csrf_token(
+        app.config['CONSUMER_KEY'], app.config['CONSUMER_SECRET'],
+        access_token['key'],
+        access_token['secret']
+    )
+
+
+def _record_contribution(user, data):
+    """
+    Save the contribution for an edit that was made
+
+    Keyword arguments:
+    user -- The user who made the edit.
+    data -- Contribution data for the edit.
+    """
+    # Don't create a new contribution if it's an edit
+    if data['edit_action'] == 'edit':
+        return
+
+    contribution = Contribution(user=user,
+                                campaign_id=int(data['campaign_id']),
+                                file=data['image'],
+                                edit_action=data['edit_action'],
+                                edit_type=data['edit_type'],
+                                country=data['country'],
+                                depict_item=data.get('depict_item'),
+                                depict_prominent=data.get('depict_prominent'),
+                                caption_language=data.get('caption_language'),
+                                caption_text=data.get('caption_text'),
+                                date=datetime.date(datetime.utcnow()))
+    db.session.add(contribution)
+    stats.record_contributions([contribution])
+    commit_changes_to_db()
+    # Cached stats for the campaign don't include the new contribution
+    cache.invalidate_campaign(int(data['campaign_id']))
+
+
+def _record_suggestions(user, contrib_data_list):
+    """
+    Save suggestions that were used for the edits
+
+    Keyword arguments:
+    user -- The user who made the edits.
+    contrib_data_list -- Contribution data for the edits.
+    """
+    suggestions = []
+    for data in contrib_data_list:
+        # Also create a new suggestion if depict item was suggested
+        if any(key in data for key in SUGGESTION_KEYS):
+            suggestions.append(Suggestion(campaign_id=data['campaign_id'],
+                                          file_name=data['image'],
+                                          depict_item=data['depict_item'],
+                                          google_vision=data.get('google_vision'),
+                                          google_vision_confidence=data.get('google_vision_confidence'),
+                                          metadata_to_concept=data.get('metadata_to_concept'),
+                                          metadata_to_concept_confidence=data.get('metadata_to_concept_confidence'),
+                                          update_status=1,
+                                          user_id=user.id))
+    if suggestions:
+        db.session.add_all(suggestions)
+        commit_changes_to_db()
+
+
+@shared_task(bind=True, ignore_result=False)
+def make_edits_task(self, contrib_data_list, user_id, access_token):
+    """
+    Make edits on Commons in the background
+
+    The progress is reported in the task state, so that it can be polled
+    while the edits are being made.
+
+    Keyword arguments:
+    contrib_data_list -- Contribution data for each edit.
+    user_id -- Id of the user making the edits.
+    access_token -- The user's OAuth access token.
+
+    Returns:
+    A dict with the user id, the results for each edit and the revision
+    id of the last edit that was made.
+    """
+    def on_edit(results):
+        self.update_state(state="PROGRESS", meta=_job_state(user_id, results))
+
+    results = make_edits(contrib_data_list, user_id, access_token, on_edit)
+    return _job_state(user_id, results)
+
+
+def _job_state(user_id, results):
+    revision_ids = [r["revision_id"] for r in results if r["revision_id"] is not None]
+    return {
+        "user_id": user_id,
+        "edits": results,
+        "revision_id": revision_ids[-1] if revision_ids else None
+    }
@@ -0,0 +1,253 @@
+"""Export all contributions of a campaign
+
+The contributions are read with one query that joins their users, using
+a server side cursor, and written to the response in batches while they
+are being read. A large campaign is never held in memory at once.
+
+The export can be made as CSV, gzipped CSV, newline delimited JSON or,
+if pyarrow is installed, Parquet.
+
+"""
+
+import csv
+import io
+import json
+from urllib.parse import quote
+import zlib
+
+from flask import Response, stream_with_context
+from sqlalchemy import select
+
+from isa import db
+from isa.campaigns.utils import convert_latin_to_english, get_stats_file_name
+from isa.models import Contribution, User
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columns in the export, in order.
+EXPORT_FIELDS = ['username', 'file', 'edit_type', 'edit_action', 'country', 'depict_item',
+                 'depict_prominent', 'caption_text', 'caption_language', 'date']
+# Export formats, with their mimetypes and file extensions.
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+# Number of rows fetched from the database and written at a time.
+BATCH_SIZE = 1000
+
+
+def get_contribution_rows(campaign_id, batch_size=BATCH_SIZE):
+    """
+    Get the rows for the export of a campaign
+
+    The rows are fetched from the database in batches, as they are
+    consumed.
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+    batch_size -- Number of rows to fetch at a time. Defaults to
+      BATCH_SIZE.
+
+    Returns:
+    Generator of lists of rows, with the values in the order of
+    EXPORT_FIELDS.
+    """
+    statement = (select(User.username,
+                        Contribution.file,
+                        Contribution.edit_type,
+                        Contribution.edit_action,
+                        Contribution.country,
+                        Contribution.depict_item,
+                        Contribution.depict_prominent,
+                        Contribution.caption_text,
+                        Contribution.caption_language,
+                        Contribution.date)
+                 .join_from(Contribution, User, Contribution.user_id == User.id)
+                 .where(Contribution.campaign_id == campaign_id)
+                 .order_by(Contribution.id))
+    connection = db.session.connection().execution_options(stream_results=True)
+    result = connection.execute(statement)
+    try:
+        for batch in result.partitions(batch_size):
+            yield batch
+    finally:
+        result.close()
+
+
+def generate_csv(campaign_id):
+    """
+    Generate the CSV export for a campaign
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+
+    Returns:
+    Generator of strings with the header and then a batch of rows each.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield _flush(buffer)
+    for batch in get_contribution_rows(campaign_id):
+        writer.writerows(batch)
+        yield _flush(buffer)
+
+
+def generate_csv_gz(campaign_id):
+    """
+    Generate the gzipped CSV export for a campaign
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+
+    Returns:
+    Generator of gzip compressed bytes.
+    """
+    # wbits 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in generate_csv(campaign_id):
+        data = compressor.compress(chunk.encode('UTF-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def generate_ndjson(campaign_id):
+    """
+    Generate the newline delimited JSON export for a campaign
+
+    Every row is a JSON object with the fields in EXPORT_FIELDS. Dates
+    are written as YYYY-MM-DD.
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+
+    Returns:
+    Generator of strings with a batch of lines each.
+    """
+    for batch in get_contribution_rows(campaign_id):
+        yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str) + '\n' for row in batch)
+
+
+def generate_parquet(campaign_id):
+    """
+    Generate the Parquet export for a campaign
+
+    Every batch of rows is written as a row group. Needs pyarrow.
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+
+    Returns:
+    Generator of bytes.
+    """
+    schema = pyarrow.schema([
+        ('username', pyarrow.string()),
+        ('file', pyarrow.string()),
+        ('edit_type', pyarrow.string()),
+        ('edit_action', pyarrow.string()),
+        ('country', pyarrow.string()),
+        ('depict_item', pyarrow.string()),
+        ('depict_prominent', pyarrow.bool_()),
+        ('caption_text', pyarrow.string()),
+        ('caption_language', pyarrow.string()),
+        ('date', pyarrow.date32()),
+    ])
+    sink = _StreamSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for batch in get_contribution_rows(campaign_id):
+            columns = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*batch), schema)]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+# Generators for each export format.
+GENERATORS = {
+    'csv': generate_csv,
+    'csv.gz': generate_csv_gz,
+    'ndjson': generate_ndjson,
+    'parquet': generate_parquet,
+}
+
+
+def is_available(export_format):
+    """
+    Check that an export format exists and can be made
+
+    Keyword arguments:
+    export_format -- Name of the format, a key in FORMATS.
+    """
+    if export_format == 'parquet':
+        return pyarrow is not None
+    return export_format in FORMATS
+
+
+def export_response(campaign, export_format='csv'):
+    """
+    Create a streamed response with the export of a campaign
+
+    Keyword arguments:
+    campaign -- The campaign to export.
+    export_format -- Name of the format, a key in FORMATS. Check that it
+      is available with is_available() first. Defaults to "csv".
+    """
+    mimetype, extension = FORMATS[export_format]
+    response = Response(stream_with_context(GENERATORS[export_format](campaign.id)), mimetype=mimetype)
+    file_name = get_stats_file_name(convert_latin_to_english(campaign.campaign_name), 'all_stats')
+    file_name = file_name[:-len('csv')] + extension
+    try:
+        file_name.encode('ascii')
+        response.headers.set('Content-Disposition', 'attachment', filename=file_name)
+    except UnicodeEncodeError:
+        # Give an ASCII name for clients that don't support encoded names,
+        # like send_file does
+        response.headers.set('Content-Disposition', 'attachment',
+                             filename=file_name.encode('ascii', 'ignore').decode('ascii'),
+                             **{'filename*': "UTF-8''" + quote(file_name)})
+    return response
+
+
+def _flush(buffer):
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return data
+
+
+class _StreamSink(io.RawIOBase):
+    """
+    File object that keeps what is written until it is drained
+
+    Unlike a BytesIO that is emptied, the position keeps counting the
+    bytes written, which the Parquet writer needs for the file footer.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
@@ -1,19 +1,25 @@
 import time
 import json
 import logging
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from threading import Thread
 import re
+import uuid
 
 from celery import shared_task
+import redis
 import requests
-from requests.exceptions import Timeout
+from sqlalchemy import func
 
-from isa import db
+from isa import app, db
 from isa.main.utils import commit_changes_to_db
 from isa.models import Campaign
 from isa.models import Image
 from isa.models import Country
 from isa.campaigns.utils import API_URL
+from isa.utils import api_client, cache
 
 # Statuses used when processing. Set as Campaign.campaign_images.
 DONE = 0
@@ -26,193 +32,806 @@ ALLOWED_FILE_EXTENISONS = ["jpg", "jpeg", "png", "svg", "gif", "tif", "tiff"]
 API_TIMEOUT = 5
 # Retry sending API request at most this many times before giving up.
 MAX_RETRIES = 5
-# Wait this long (in seconds) before retrying to send an API request.
-RETRY_DELAY = 1
+# Ask the API to refuse requests while the database replicas lag more
+# than this many seconds. Can be overridden with MEDIAWIKI_MAXLAG in the
+# config.
+MAXLAG = 5
 # Commit this many images at a time to database.
 IMAGES_PER_COMMIT = 1000
+# Send at most this many API requests at the same time when crawling
+# categories. Can be overridden with IMAGE_UPDATER_WORKERS in the
+# config. 1 means that categories are crawled one page at a time.
+DEFAULT_WORKERS = 4
+# Save the crawl state at most this often (in seconds), so that a failed
+# update can be resumed.
+CHECKPOINT_INTERVAL = 60
+# Retry a failed update task at most this many times. The retried
+# task resumes from the last checkpoint.
+MAX_TASK_RETRIES = 3
+# Wait this long (in seconds) before retrying a failed update task.
+TASK_RETRY_DELAY = 60
+# Hold the lock for updating a campaign this long (in seconds) after it
+# was taken or last refreshed. It's refreshed when checkpoints are
+# saved, so that it's kept for as long as the update runs.
+UPDATE_LOCK_TTL = 30 * 60
+
+# Country ids by name, shared by all updates in this process. Only used
+# when IMAGE_UPDATER_SHARED_COUNTRY_CACHE is set in the config.
+_shared_country_ids = {}
 
 
 class UpdateImageException(Exception):
     pass
 
 
-def update_in_task(campaign_id):
+class UpdateInProgressException(UpdateImageException):
+    """Raised when another update of the campaign is running"""
+    pass
+
+
+def invalidate_country_cache():
+    """
+    Clear the country ids shared by updates in this process
+    """
+    _shared_country_ids.clear()
+
+
+class CountryCache:
+    """
+    Maps country names to ids in the country table
+
+    All countries are loaded with one query the first time they are
+    needed. Countries that are missing from the table are added in one
+    batch when their ids are requested.
+    """
+
+    def __init__(self, shared=False):
+        """
+        Keyword arguments:
+        shared -- If True, use the ids shared by all updates in this
+          process instead of loading them for every update. Defaults to
+          False.
+        """
+        self._ids = _shared_country_ids if shared else {}
+
+    def get_ids(self, names):
+        """
+        Get ids for countries, adding the ones that don't exist
+
+        The added countries are not committed.
+
+        Keyword arguments:
+        names -- Iterable of country names.
+
+        Returns:
+        Dictionary with country names as keys and ids as values.
+        """
+        if not self._ids:
+            self._load()
+        missing = {n for n in names if n not in self._ids}
+        if missing:
+            logging.debug('Adding new countries: {}.'.format(", ".join(sorted(missing))))
+            db.session.execute(
+                Country.__table__.insert(),
+                [{"name": name} for name in missing]
+            )
+            self._load(missing)
+        return {name: self._ids[name] for name in names}
+
+    def _load(self, names=None):
+        """
+        Load country ids from the database
+
+        If there are multiple countries with the same name, the one
+        with the lowest id is used.
+
+        Keyword arguments:
+        names -- Only load these countries. Defaults to None, which
+          loads all countries.
+        """
+        query = db.session.query(Country.id, Country.name).order_by(Country.id)
+        if names is not None:
+            query = query.filter(Country.name.in_(names))
+        for country_id, name in query:
+            self._ids.setdefault(name, country_id)
+
+
+class ImageBuffer:
+    """
+    Collects images for a campaign and inserts them in bulk
+
+    Images are kept as plain rows and written with one multi-row INSERT
+    per flush, bypassing the ORM. The number of images is counted here,
+    so that the table doesn't have to be counted.
+
+    If the images already stored for the campaign are given, only images
+    that are not stored are inserted. The stored images that were never
+    added to the buffer can then be removed, see `unseen_image_ids`.
+    """
+
+    def __init__(self, campaign_id, countries=None, existing=None, size=IMAGES_PER_COMMIT):
+        """
+        Keyword arguments:
+        campaign_id -- Id of the campaign the images belong to.
+        countries -- CountryCache used to get ids for countries. Only
+          needed if images are added with countries. Defaults to None.
+        existing -- Images stored for the campaign, as a dictionary with
+          tuples of page id and country id as keys and image ids as
+          values. Defaults to None, which inserts all images.
+        size -- The number of images to collect before the buffer is
+          full. Defaults to IMAGES_PER_COMMIT.
+        """
+        self._campaign_id = campaign_id
+        self._countries = countries
+        self._existing = existing
+        self._seen = set()
+        self._size = size
+        self._rows = []
+        # Number of images for the campaign, both inserted and
+        # already stored ones.
+        self.count = 0
+        # Number of inserted images.
+        self.added = 0
+
+    def add(self, page_id, country=None):
+        """
+        Add an image to the buffer
+
+        Keyword arguments:
+        page_id -- Page id of the image file.
+        country -- Name of the country for the image. Defaults to None.
+        """
+        self._rows.append((page_id, self._campaign_id, country))
+
+    def is_full(self):
+        return len(self._rows) >= self._size
+
+    def flush(self):
+        """
+        Insert the buffered images into the database session
+
+        The images are not committed.
+        """
+        if not self._rows:
+            return
+
+        country_ids = {}
+        countries = {country for _, _, country in self._rows if country}
+        if countries:
+            country_ids = self._countries.get_ids(countries)
+        rows = [
+            {"page_id": page_id, "campaign_id": campaign_id, "country_id": country_ids.get(country)}
+            for page_id, campaign_id, country in self._rows
+        ]
+        self._rows = []
+        if self._existing is not None:
+            new_rows = []
+            for row in rows:
+                key = (row["page_id"], row["country_id"])
+                if key not in self._seen:
+                    self._seen.add(key)
+                    if key not in self._existing:
+                        new_rows.append(row)
+            self.count = len(self._seen)
+            rows = new_rows
+        else:
+            self.count += len(rows)
+
+        if rows:
+            db.session.execute(Image.__table__.insert(), rows)
+        self.added += len(rows)
+
+    def get_state(self):
+        """
+        Get the counters and seen images, for storing in a checkpoint
+
+        Should only be called when the buffer is empty.
+        """
+        return {
+            "count": self.count,
+            "added": self.added,
+            "seen": [list(key) for key in self._seen]
+        }
+
+    def set_state(self, state):
+        """
+        Restore counters and seen images from a checkpoint
+
+        Keyword arguments:
+        state -- Dictionary returned by `get_state`.
+        """
+        self.count = state["count"]
+        self.added = state["added"]
+        self._seen = {tuple(key) for key in state["seen"]}
+
+    def unseen_image_ids(self):
+        """
+        Get ids of stored images that haven't been added to the buffer
+
+        Returns:
+        List of image ids.
+        """
+        return [
+            image_id for key, image_id in (self._existing or {}).items()
+            if key not in self._seen
+        ]
+
+
+class Checkpoint:
+    """
+    Crawl state of an image update, stored as a JSON file per campaign
+
+    The files are stored in the directory set as
+    IMAGE_UPDATER_CHECKPOINT_DIR in the config, by default
+    "image_update_checkpoints" in the working directory.
+    """
+
+    def __init__(self, campaign_id):
+        """
+        Keyword arguments:
+        campaign_id -- Id of the campaign that is updated.
+        """
+        directory = app.config.get(
+            "IMAGE_UPDATER_CHECKPOINT_DIR",
+            os.path.join(os.getcwd(), "image_update_checkpoints")
+        )
+        self._path = os.path.join(directory, "{}.json".format(campaign_id))
+
+    def load(self):
+        """
+        Load the checkpoint
+
+        Returns:
+        The saved state, or None if there is no checkpoint.
+        """
+        try:
+            with open(self._path, encoding="utf-8") as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logging.warning('Ignoring unreadable checkpoint "{}".'.format(self._path))
+            return None
+
+    def save(self, state):
+        """
+        Save the checkpoint
+
+        The state is written to a temporary file which then replaces the
+        checkpoint, so that a crash never leaves a partial file.
+
+        Keyword arguments:
+        state -- JSON serializable crawl state.
+        """
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        temporary_path = self._path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temporary_path, self._path)
+
+    def delete(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class UpdateLock:
+    """
+    Lets only one update of a campaign run at a time
+
+    The lock is kept in the cache backend, so that it's shared by the
+    workers when the backend is. If the backend is unavailable, the
+    update runs without the lock.
+    """
+
+    def __init__(self, campaign_id):
+        """
+        Keyword arguments:
+        campaign_id -- Id of the campaign that is updated.
+        """
+        self._key = "{}image-update:{}".format(cache.KEY_PREFIX, campaign_id)
+        self._token = uuid.uuid4().hex
+
+    def acquire(self):
+        """
+        Take the lock
+
+        Returns:
+        True if the lock was taken, False if another update holds it.
+        """
+        try:
+            return cache.get_backend().add(self._key, self._token, UPDATE_LOCK_TTL)
+        except redis.RedisError:
+            logging.exception("Could not lock the update, updating anyway.")
+            return True
+
+    def refresh(self):
+        """Keep the lock for another UPDATE_LOCK_TTL seconds"""
+        try:
+            if self._is_held():
+                cache.get_backend().set(self._key, self._token, UPDATE_LOCK_TTL)
+        except redis.RedisError:
+            logging.exception("Could not refresh the update lock.")
+
+    def release(self):
+        try:
+            if self._is_held():
+                cache.get_backend().delete(self._key)
+        except redis.RedisError:
+            logging.exception("Could not release the update lock.")
+
+    def _is_held(self):
+        value = cache.get_backend().get(self._key)
+        if isinstance(value, bytes):
+            value = value.decode()
+        return value == self._token
+
+
+class CategoryCrawler:
+    """
+    Lists the files in categories and their subcategories
+
+    Iterating over the crawler yields one page of files at a time, as
+    tuples of category title and a list of file members, as returned by
+    the API. Requests that haven't been sent yet are kept in a queue and
+    at most `workers` requests are sent at the same time, in worker
+    threads. Since a new request is only sent when a page has been
+    handled, memory use doesn't grow with the size of the categories,
+    and the next pages are fetched while the current one is handled.
+    """
+
+    def __init__(self, api_get, pending, processed_categories, workers=1):
+        """
+        Keyword arguments:
+        api_get -- Function that sends a request to the API, given the
+          parameters, and returns the response.
+        pending -- Requests to send, as tuples of category title, depth
+          and continue string. Depth is the number of subcategories down
+          to go, 0 means no subcategories.
+        processed_categories -- Set of categories that have been
+          requested, which is updated while crawling. The categories in
+          `pending` must already be in it.
+        workers -- The maximum number of requests to send at the same
+          time. Defaults to 1.
+        """
+        self._api_get = api_get
+        self._queue = deque(tuple(request) for request in pending)
+        self._in_flight = {}
+        self.processed_categories = processed_categories
+        self._workers = workers
+
+    @property
+    def pending(self):
+        """
+        Requests that haven't been handled, including the ones being sent
+        """
+        return list(self._in_flight.values()) + list(self._queue)
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            self._send_requests(executor)
+            while self._in_flight:
+                done, _ = wait(self._in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    category, depth, _ = self._in_flight.pop(future)
+                    response = future.result()
+                    files = []
+                    for member in response["query"]["categorymembers"]:
+                        if member["type"] == "file":
+                            files.append(member)
+                        elif depth and member["type"] == "subcat":
+                            self._add_category(member["title"], depth - 1)
+                    if "continue" in response:
+                        self._queue.append((category, depth, response["continue"]["cmcontinue"]))
+                    self._send_requests(executor)
+                    yield category, files
+
+    def _add_category(self, category, depth):
+        """
+        Queue a request for a category, unless it has been requested
+
+        Keyword arguments:
+        category -- Category title, including "Category:" prefix.
+        depth -- The number of subcategories down to go.
+        """
+        if category in self.processed_categories:
+            logging.debug('Skipping already processed category "{}".'.format(category))
+            return
+
+        self.processed_categories.add(category)
+        self._queue.append((category, depth, None))
+
+    def _send_requests(self, executor):
+        """
+        Send queued requests until `self._workers` are being sent
+        """
+        while self._queue and len(self._in_flight) < self._workers:
+            category, depth, continue_string = self._queue.popleft()
+            if not continue_string:
+                logging.debug('Fetching page ids for category "{}".'.format(category))
+            parameters = self._members_parameters(category, continue_string)
+            future = executor.submit(self._api_get, parameters)
+            self._in_flight[future] = (category, depth, continue_string)
+
+    def _members_parameters(self, category, continue_string=None):
+        """
+        Get API parameters for listing members of a category
+
+        Keyword arguments:
+        category -- Category title, including "Category:" prefix.
+        continue_string -- Used for API requests. Defaults to None.
+        """
+        parameters = {
+            "action": "query",
+            "list": "categorymembers",
+            "cmtitle": category,
+            "cmlimit": "max",
+            "cmprop": "title|type|ids",
+            "cmtype": "subcat|file"
+        }
+        if continue_string:
+            parameters["cmcontinue"] = continue_string
+        return parameters
+
+
+def update_in_task(campaign_id, incremental=False):
     """
     Update campaign images in a task
 
     Keyword arguments:
     campaign_id -- Id of the campaign to update.
+    incremental -- If True, only add new images and remove images
+      that are no longer in the categories, instead of replacing all
+      images. Defaults to False.
     """
-    update_task.delay(campaign_id)
+    update_task.delay(campaign_id, incremental)
 
 
-@shared_task
-def update_task(campaign_id):
+@shared_task(bind=True, acks_late=True, max_retries=MAX_TASK_RETRIES)
+def update_task(self, campaign_id, incremental=False):
     """
     Celery task for updating campaign images
 
+    If the update fails, the task is retried and continues from where
+    the failed update stopped. The task is acknowledged late, so that it
+    is run again if the worker is restarted during the update. If the
+    campaign is already being updated, the task does nothing.
+
     Keyword arguments:
     campaign_id -- Id of the campaign to update.
+    incremental -- See `update_in_task`. Defaults to False.
+
+    Returns:
+    Dictionary with the number of added and removed images, or None if
+    the update failed.
     """
-    update(campaign_id)
+    try:
+        result = update(campaign_id, incremental)
+    except UpdateInProgressException:
+        # E.g. the task was delivered again while it's still running
+        logging.warning("Images for campaign {} are already being updated.".format(campaign_id))
+        return None
+    if result is None and self.request.retries < self.max_retries:
+        raise self.retry(countdown=TASK_RETRY_DELAY)
+
+    return result
 
 
-def update(campaign_id):
+def update(campaign_id, incremental=False, resume=True):
     """
     Updated images for a campaign
 
     Keyword arguments:
     campaign_id -- Id of the campaign to update.
+    incremental -- See `update_in_task`. Defaults to False.
+    resume -- If True, continue a previous update of the campaign that
+      failed, if there is one. Defaults to True.
+
+    Returns:
+    Dictionary with the number of added and removed images, or None if
+    the update failed.
+
+    Exceptions:
+    UpdateInProgressException -- When another update of the campaign is
+      running.
     """
+    lock = UpdateLock(campaign_id)
+    if not lock.acquire():
+        raise UpdateInProgressException(
+            "Images for campaign {} are already being updated.".format(campaign_id)
+        )
     try:
-        updater = ImageUpdater(campaign_id)
-        updater.update_images()
+        updater = ImageUpdater(campaign_id, incremental, resume, lock)
+        return updater.update_images()
     except Exception:
         logging.exception("Failed to update images for campaign {}.".format(
             campaign_id
         ))
+        # Countries added in the failed update may have been rolled
+        # back, so their ids can't be trusted.
+        invalidate_country_cache()
+        db.session.rollback()
         campaign = Campaign.query.filter_by(id=campaign_id).first()
         campaign.update_status = FAILED
         commit_changes_to_db()
+    finally:
+        lock.release()
 
 
 class ImageUpdater:
-    def __init__(self, campaign_id):
+    def __init__(self, campaign_id, incremental=False, resume=True, lock=None):
         """
         Keyword arguments:
         campaign_id -- Id of the campaign to update.
+        incremental -- If True, keep images that are still in the
+          categories and only add and remove the ones that differ.
+          Defaults to False, which replaces all images.
+        resume -- If True, continue a previous update that didn't
+          finish, if there is one. Defaults to True.
+        lock -- UpdateLock held for the update, refreshed when a
+          checkpoint is saved. Defaults to None.
         """
+        self._lock = lock
         self._campaign = Campaign.query.get(campaign_id)
-        self._images = {}
+        self._incremental = incremental
+        self._resume = resume
+        self._countries = CountryCache(
+            shared=app.config.get("IMAGE_UPDATER_SHARED_COUNTRY_CACHE", False)
+        )
+        self._images = None
+        self._checkpoint = Checkpoint(campaign_id)
+        self._checkpoint_time = time.time()
+        self._removed = 0
         self._processed_categories = set()
         self._image_commits = 0
-        self._uncommited_images = 0
+        self._workers = max(1, int(app.config.get("IMAGE_UPDATER_WORKERS", DEFAULT_WORKERS)))
 
     def update_images(self):
         """
         Update images and countries for a campaign
 
+        Returns:
+        Dictionary with the number of images that were added and
+        removed, with the keys "added" and "removed".
+
         Exceptions:
         UpdateImageException -- When committing to the database fails.
         """
-        logging.info("Updating images for campaign {}.".format(self._campaign.id))
+        logging.info("Updating images for campaign {}{}.".format(
+            self._campaign.id,
+            " incrementally" if self._incremental else ""
+        ))
         start_time = time.time()
         self._campaign.update_status = PROCESSING
         if not commit_changes_to_db():
             raise UpdateImageException("Committing to database failed.")
 
-        # Clear images for the campaign to ensure that images that have
-        # been removed from categories do not remain.
-        Image.query.filter_by(campaign_id=self._campaign.id).delete()
-        self._campaign.images.clear()
-        self._campaign.campaign_images = 0
-        if not commit_changes_to_db():
-            raise UpdateImageException("Committing to database failed.")
-
-        categories = json.loads(self._campaign.categories)
-        for category in categories:
-            if self._campaign.campaign_type:
-                depth = 1
+        state = self._load_checkpoint()
+        if self._incremental:
+            existing, duplicate_ids = self._load_stored_images()
+            self._images = ImageBuffer(self._campaign.id, self._countries, existing)
+        else:
+            if state:
+                # Remove images committed after the checkpoint was
+                # saved, since their pages will be fetched again.
+                Image.query.filter(
+                    Image.campaign_id == self._campaign.id,
+                    Image.id > (state["last_image_id"] or 0)
+                ).delete(synchronize_session=False)
             else:
-                depth = int(category["depth"])
-            self._fetch_images(category["name"], depth)
+                # Clear images for the campaign to ensure that images that have
+                # been removed from categories do not remain.
+                self._removed = Image.query.filter_by(campaign_id=self._campaign.id).delete()
+                self._campaign.images.clear()
+                self._campaign.campaign_images = 0
+            if not commit_changes_to_db():
+                raise UpdateImageException("Committing to database failed.")
+
+            self._images = ImageBuffer(self._campaign.id, self._countries)
+
+        if state:
+            logging.info("Resuming update from checkpoint, {} requests pending.".format(
+                len(state["pending"])
+            ))
+            self._processed_categories = set(state["processed_categories"])
+            self._images.set_state(state["images"])
+            self._removed = state["removed"]
+            pending = [tuple(request) for request in state["pending"]]
+        else:
+            pending = []
+            for category in json.loads(self._campaign.categories):
+                if self._campaign.campaign_type:
+                    depth = 1
+                else:
+                    depth = int(category["depth"])
+                title = self._category_title(category["name"])
+                if title not in self._processed_categories:
+                    self._processed_categories.add(title)
+                    pending.append((title, depth, None))
+
+        crawler = CategoryCrawler(self._api_get, pending, self._processed_categories, self._workers)
+        for category, files in crawler:
+            for member in files:
+                self._add_image(category, member)
+            self._save_checkpoint(crawler.pending)
 
         self._commit_images()
+        if self._incremental:
+            self._removed += self._remove_images(self._images.unseen_image_ids() + duplicate_ids)
+            self._campaign.campaign_images = self._images.count
         logging.info(
             "{} images committed for campaign {} in {} seconds "
-            "and {} commits."
+            "and {} commits. {} images added, {} removed."
             .format(
                 self._campaign.campaign_images,
                 self._campaign.id,
                 int(time.time() - start_time),
-                self._image_commits
+                self._image_commits,
+                self._images.added,
+                self._removed
             )
         )
         self._campaign.update_status = DONE
         if not commit_changes_to_db():
             raise UpdateImageException("Committing to database failed.")
 
-    def _fetch_images(self, category, depth, continue_string=None):
+        self._checkpoint.delete()
+        return {"added": self._images.added, "removed": self._removed}
+
+    def _load_checkpoint(self):
         """
-        Add images for a category to the campaign
+        Load the checkpoint of a previous update, if it can be resumed
 
-        Fetches all images in the given category and if, `depth` is
-        more than 0, its subcategories. Filters out pages that do not
-        match file extensions for images.
+        A checkpoint is only used if it was saved by an update with the
+        same mode and categories.
+
+        Returns:
+        The checkpoint state, or None if the update should start from
+        the beginning.
+        """
+        if not self._resume:
+            self._checkpoint.delete()
+            return None
+
+        state = self._checkpoint.load()
+        if state is None:
+            return None
+
+        if (state.get("incremental") != self._incremental or
+                state.get("categories") != self._campaign.categories):
+            logging.info("Ignoring checkpoint from a different update.")
+            self._checkpoint.delete()
+            return None
+
+        return state
+
+    def _save_checkpoint(self, pending):
+        """
+        Commit images and save the crawl state
+
+        Only saves if CHECKPOINT_INTERVAL seconds have passed since the
+        last save. Must only be called between pages, when all images
+        from the processed pages have been added to the buffer.
 
         Keyword arguments:
-        category -- Id of the campaign to fetch images for. Accepts both
-          with and without "Category:" prefix.
-        depth -- The number of subcategories down to go. 0 means no
-          subcategories.
-        continue_string -- Used for API requests. Defaults to None.
+        pending -- Requests that haven't been processed yet, as tuples
+          of category, depth and continue string.
         """
-        if not category.startswith("Category:"):
-            category = "Category:" + category
-        if category in self._processed_categories and not continue_string:
-            # Skip the category if it has already been processed, except
-            # if we are continuing on the same category.
-            logging.debug('Skipping already processed category "{}".'.format(category))
+        if time.time() - self._checkpoint_time < CHECKPOINT_INTERVAL:
             return
 
-        if not continue_string:
-            logging.debug('Fetching page ids for category "{}".'.format(category))
-        self._processed_categories.add(category)
-        parameters = {
-            "action": "query",
-            "list": "categorymembers",
-            "cmtitle": category,
-            "cmlimit": "max",
-            "cmprop": "title|type|ids",
-            "cmtype": "subcat|file"
-        }
-        if continue_string:
-            parameters["cmcontinue"] = continue_string
-        response = self._api_get(parameters)
-
-        for member in response["query"]["categorymembers"]:
-            if member["type"] == "file" and self._is_allowed(member["title"]):
-                image = Image(
-                    page_id=member["pageid"],
-                    campaign_id=self._campaign.id
-                )
-                if self._campaign.campaign_type:
-                    country_name = self._get_country(category)
-                    if not country_name:
-                        # Skip categories without countries.
-                        continue
-
-                    if Country.query.filter_by(name=country_name).count() == 0:
-                        # Make sure that the country is in the
-                        # database.
-                        country = Country(name=country_name)
-                        logging.debug('Adding new country "{}".'.format(country_name))
-                        db.session.add(country)
-                    country_id = Country.query.filter_by(name=country_name)[0].id
-                    image.country_id = country_id
-
-                db.session.add(image)
-                self._uncommited_images += 1
-                if self._uncommited_images % IMAGES_PER_COMMIT == 0:
-                    self._commit_images()
-                    self._uncommited_images = 0
-                    logging.debug("A total of {} images have been committed so far.".format(self._campaign.campaign_images))
-            elif depth and member["type"] == "subcat":
-                self._fetch_images(member["title"], depth - 1)
-        if "continue" in response:
-            new_continue_string = response["continue"]["cmcontinue"]
-            self._fetch_images(category, depth, new_continue_string)
+        self._commit_images()
+        last_image_id = (
+            db.session.query(func.max(Image.id))
+            .filter(Image.campaign_id == self._campaign.id)
+            .scalar()
+        )
+        self._checkpoint.save({
+            "incremental": self._incremental,
+            "categories": self._campaign.categories,
+            "pending": [list(request) for request in pending],
+            "processed_categories": sorted(self._processed_categories),
+            "images": self._images.get_state(),
+            "removed": self._removed,
+            "last_image_id": last_image_id
+        })
+        self._checkpoint_time = time.time()
+        if self._lock is not None:
+            self._lock.refresh()
+
+    def _load_stored_images(self):
+        """
+        Load the images stored for the campaign
+
+        Returns:
+        Tuple with a dictionary and a list. The dictionary has tuples of
+        page id and country id as keys and image ids as values. The list
+        has ids of images that are stored more than once.
+        """
+        existing = {}
+        duplicate_ids = []
+        query = (
+            db.session.query(Image.id, Image.page_id, Image.country_id)
+            .filter(Image.campaign_id == self._campaign.id)
+            .order_by(Image.id)
+        )
+        for image_id, page_id, country_id in query:
+            key = (page_id, country_id)
+            if key in existing:
+                duplicate_ids.append(image_id)
+            else:
+                existing[key] = image_id
+        return existing, duplicate_ids
+
+    def _remove_images(self, image_ids):
+        """
+        Remove images from the database, in batches
+
+        Keyword arguments:
+        image_ids -- Ids of the images to remove.
+
+        Returns:
+        The number of removed images.
+        """
+        for start in range(0, len(image_ids), IMAGES_PER_COMMIT):
+            batch = image_ids[start:start + IMAGES_PER_COMMIT]
+            Image.query.filter(Image.id.in_(batch)).delete(synchronize_session=False)
+            if not commit_changes_to_db():
+                raise UpdateImageException("Committing to database failed.")
+
+        return len(image_ids)
+
+    def _add_image(self, category, member):
+        """
+        Add an image to the image buffer
+
+        Skips files that aren't images. For Wiki Loves campaigns, the
+        country is taken from the category and files in categories
+        without a country are skipped.
+
+        Keyword arguments:
+        category -- Title of the category the file is in.
+        member -- Category member, as returned by the API.
+        """
+        if not self._is_allowed(member["title"]):
+            return
+
+        country_name = None
+        if self._campaign.campaign_type:
+            country_name = self._get_country(category)
+            if not country_name:
+                # Skip categories without countries.
+                return
+
+        self._images.add(member["pageid"], country_name)
+        if self._images.is_full():
+            self._commit_images()
+            logging.debug("A total of {} images have been committed so far.".format(self._campaign.campaign_images))
 
     def _commit_images(self):
         """
-        Commit images to database
+        Write buffered images and commit them to database
+
+        The image count for the campaign is only updated when replacing
+        all images, incremental updates keep the old count until done.
         """
-        self._campaign.campaign_images = Image.query.filter_by(campaign_id=self._campaign.id).count()
+        self._images.flush()
+        if not self._incremental:
+            self._campaign.campaign_images = self._images.count
         if not commit_changes_to_db():
             raise UpdateImageException("Committing to database failed.")
 
         self._image_commits += 1
 
+    def _category_title(self, category):
+        """
+        Get category title with "Category:" prefix
+        """
+        if not category.startswith("Category:"):
+            category = "Category:" + category
+        return category
+
     def _get_country(self, category):
         """
         Get country from a Wiki Loves images category
@@ -235,18 +854,16 @@ class ImageUpdater:
         extension = filename.lower().split(".")[-1]
         return extension in ALLOWED_FILE_EXTENISONS
 
-    def _api_get(self, parameters, retries=0):
+    def _api_get(self, parameters):
         """Make a GET request to the Commons API
 
-        If the request times out or if an exception is raised in another
-        way, the same request will be sent again, up to a certain amount
-        of retries.
+        The request is sent through the shared API client, which retries
+        it if it times out, fails to connect or if the database replicas
+        lag.
 
         Keyword arguments:
         parameters -- API parameters. General parameters are set for all
           requests.
-        retries -- How many retries there have been, including this
-          one. Defaults to 0.
 
         Returns:
         API response.
@@ -261,17 +878,16 @@ class ImageUpdater:
         }
         parameters.update(base_parameters)
         try:
-            logging.debug("Sending request, retry number {}.".format(retries))
-            response = requests.get(
+            response = api_client.get(
                 API_URL,
                 params=parameters,
-                headers={'User-Agent': 'ISA/1.0 (contact: https://www.mediawiki.org/wiki/User:IsaBot)'},
-                timeout=API_TIMEOUT
+                timeout=API_TIMEOUT,
+                retries=MAX_RETRIES,
+                maxlag=app.config.get("MEDIAWIKI_MAXLAG", MAXLAG)
             ).json()
-        except (Timeout,requests.RequestException, ConnectionError) as e:
-            if retries > MAX_RETRIES:
-                raise UpdateImageException(f"API request failed after {MAX_RETRIES} retries: {str(e)}")
+        except (requests.RequestException, ValueError) as e:
+            raise UpdateImageException(f"API request failed after {MAX_RETRIES} retries: {str(e)}")
 
-            time.sleep(RETRY_DELAY)
-            return self._api_get(parameters, retries + 1)
+        if "error" in response:
+            raise UpdateImageException("API request failed: {}".format(response["error"].get("info")))
         return response
@@ -1,28 +1,25 @@
 from datetime import datetime
-import glob
 import json
 import os
 from types import SimpleNamespace
 
 import requests
+from celery.result import AsyncResult
 from flask import (make_response, render_template, redirect, url_for, flash, request,
-                   session, Blueprint, send_file, jsonify, abort)
+                   session, Blueprint, jsonify, abort)
 from flask_login import current_user
 from markupsafe import Markup, escape
 from sqlalchemy import func, or_
 from sqlalchemy.exc import SQLAlchemyError
 
-from isa import app, db, gettext
+from isa import app, celery_app, db, gettext
 from isa.campaigns.forms import CampaignForm
-from isa.campaigns.utils import (convert_latin_to_english, get_table_stats, compute_campaign_status,
-                                 create_campaign_country_stats_csv, create_campaign_contributor_stats_csv,
-                                 create_campaign_all_stats_csv, get_all_camapaign_stats_data,
-                                 make_edit_api_call, generate_csrf_token,
-                                 get_stats_data_points)
-from isa.campaigns import image_updater
+from isa.campaigns.utils import get_table_stats, compute_campaign_status, get_stats_data_points
+from isa.campaigns import contributions, export, image_updater, stats, stats_files
 from isa.main.utils import commit_changes_to_db, manage_session
 from isa.models import Campaign, Contribution, Country, Image, User, Suggestion
 from isa.users.utils import (get_user_language_preferences, get_current_user_images_improved)
+from isa.utils import api_client, cache
 
 
 campaigns = Blueprint('campaigns', __name__)
@@ -266,17 +263,6 @@ def getCampaignById(id):
         flash(gettext('Campaign with id %(id)s does not exist', id=id), 'info')
         return redirect(url_for('campaigns.getCampaigns'))
 
-    # We get all the contributions from the ddatabase
-    all_contributions = Contribution.query.filter_by(campaign_id=campaign.id).all()
-    # contributions for campaign
-    campaign_contributions = 0
-    # Editor for a particular campaign
-    campaign_editors = 0
-    # We now get the contributor count for this campaign
-    for contrib in all_contributions:
-        if (contrib.campaign_id == campaign.id):
-            campaign_contributions += 1
-
     try:
         campaign_table_stats = get_table_stats(id, username, page, per_page)
     except SQLAlchemyError:
@@ -310,49 +296,16 @@ def getCampaignById(id):
             page_num = 1
             total = 0
         page_info = SimpleNamespace(pages=pages, page=page_num, total=total)
-    # Delete the files in the campaign directory
-    stats_path = os.getcwd() + '/campaign_stats_files/' + str(campaign.id)
-    files = glob.glob(stats_path + '/*')
-    if len(files) > 0:
-        for f in files:
-            os.remove(f)
-
-    # We create the campaign stats directory if it does not exist
-    if not os.path.exists(stats_path):
-        os.makedirs(stats_path)
-
-    # We build the campaign statistucs file here with the contributor stats
-    # 1 - country contribution file
-
-    campaign_name = campaign.campaign_name
-    stats_file_directory = stats_path
-    country_fields = ['rank', 'country', 'images_improved']
-    country_stats_data = campaign_table_stats['all_campaign_country_statistics_data']
-
-    country_csv_file = create_campaign_country_stats_csv(stats_file_directory, campaign_name,
-                                                         country_fields, country_stats_data)
-
-    # 2 - contributors file
-    contributor_fields = ['rank', 'username', 'images_improved']
-    contributor_stats_data = campaign_table_stats['all_contributors_data']
-
-    current_user_images_improved = get_current_user_images_improved(contributor_stats_data, username)
-
-    contributor_csv_file = create_campaign_contributor_stats_csv(stats_file_directory,
-                                                                 campaign_name,
-                                                                 contributor_fields,
-                                                                 contributor_stats_data)
-    campaign.campaign_participants = campaign_table_stats['campaign_editors']
-    campaign.campaign_contributions = campaign_contributions
-    if commit_changes_to_db():
-        print('Campaign info updated successfully!')
+    country_csv_file, contributor_csv_file = stats_files.get_stats_file_names(campaign.campaign_name)
+    current_user_images_improved = get_current_user_images_improved(
+        campaign_table_stats['all_contributors_data'], username)
     session['next_url'] = request.url
     campaign_image = ('https://commons.wikimedia.org/wiki/Special:FilePath/' + campaign.campaign_image
                       if campaign.campaign_image != ''
                       else None)
     countries = Country.query.join(Image).filter(Image.campaign_id == campaign.id).all()
     country_names = sorted([c.name for c in countries])
-    return (render_template('campaign/campaign.html', title=gettext('Campaign - %(campaign_name)s',
+    page = (render_template('campaign/campaign.html', title=gettext('Campaign - %(campaign_name)s',
                                                                     campaign_name=campaign.campaign_name),
                             campaign_name=campaign.campaign_name,
                             campaign=campaign,
@@ -360,8 +313,8 @@ def getCampaignById(id):
                             username=username,
                             campaign_image=campaign_image,
                             session_language=session_language,
-                            campaign_editors=campaign_editors,
-                            campaign_contributions=campaign_contributions,
+                            campaign_editors=campaign_table_stats['campaign_editors'],
+                            campaign_contributions=campaign.campaign_contributions or 0,
                             current_user=current_user,
                             is_wiki_loves_campaign=campaign.campaign_type,
                             campaign_table_pagination_data=page_info,
@@ -374,6 +327,11 @@ def getCampaignById(id):
                             countries=country_names,
                             isa_superusers=app.config.get('ISA_SUPERUSERS', [])
                             ))
+    # The statistics files are written in the background when there are
+    # new contributions. This is done after rendering, since the task
+    # runs in place of the request when Celery runs tasks eagerly.
+    stats_files.update_stats_files(campaign)
+    return page
 
 
 @campaigns.route('/campaigns/<int:id>/table')
@@ -407,7 +365,11 @@ def getCampaignTableData(id):
             return make_response(jsonify({'error': gettext('Invalid "per_page" parameter')}), 400)
 
         username = session.get('username', None)
-        campaign_table_stats = get_table_stats(id, username, page, per_page)
+        # The table has the rank of the current user, so it's cached for each user
+        campaign_table_stats = cache.get_or_compute(
+            'table', id, {'username': username, 'page': page, 'per_page': per_page},
+            lambda: get_table_stats(id, username, page, per_page)
+        )
         return jsonify(campaign_table_stats)
     except Exception:
         app.logger.exception('Unexpected error while loading campaign table for %s', id)
@@ -425,55 +387,7 @@ def getCampaignStatsById(id):
     session['next_url'] = request.url
 
     campaign = Campaign.query.get_or_404(id)
-    base_query = Contribution.query.filter_by(campaign_id=id)
-    total_contributions = base_query.count()
-
-    # 1. Contributions Over Time (Date-wise)
-    datewise_data_query = db.session.query(
-        Contribution.date,
-        func.count(Contribution.id).label('count')
-    ).filter_by(campaign_id=id).group_by(Contribution.date).order_by(Contribution.date).all()
-    datewise_data = [{'date': r.date.strftime('%Y-%m-%d'), 'count': r.count} for r in datewise_data_query]
-
-    # 2. Top 10 Contributors
-    top_contributors_query = db.session.query(
-        User.username,
-        func.count(Contribution.id).label('count')
-    ).join(User, User.id == Contribution.user_id).filter(Contribution.campaign_id == id).group_by(User.username).order_by(func.count(Contribution.id).desc()).limit(5).all()
-    top_contributors = [{'username': r.username, 'count': r.count} for r in top_contributors_query]
-
-    # 3. Language Distribution
-    language_stats_query = db.session.query(
-        Contribution.caption_language.label('language'),
-        func.count(Contribution.id).label('count')
-    ).filter(
-        Contribution.campaign_id == id,
-        Contribution.caption_language.isnot(None),
-        Contribution.caption_language != ''
-    ).group_by('language').order_by(func.count(Contribution.id).desc()).all()
-    language_stats = [{'language': r.language, 'count': r.count} for r in language_stats_query]
-
-    # 4. Country Distribution
-    country_distribution_query = db.session.query(
-        Contribution.country,
-        func.count(Contribution.id).label('count')
-    ).filter(
-        Contribution.campaign_id == id,
-        Contribution.country.isnot(None),
-        Contribution.country != ''
-    ).group_by(Contribution.country).order_by(func.count(Contribution.id).desc()).all()
-    country_distribution = [{'country': r.country, 'count': r.count} for r in country_distribution_query]
-
-    # 5. Contribution Types
-    contribution_types_query = db.session.query(
-        Contribution.edit_type,
-        func.count(Contribution.id).label('count')
-    ).filter(
-        Contribution.campaign_id == id,
-        Contribution.edit_type.isnot(None),
-        Contribution.edit_type != ''
-    ).group_by(Contribution.edit_type).order_by(func.count(Contribution.id).desc()).all()
-    contribution_types = [{'type': r.edit_type, 'count': r.count} for r in contribution_types_query]
+    campaign_stats = stats.get_campaign_stats(id)
 
     # Render the template with the correctly formatted data
     return render_template(
@@ -481,12 +395,12 @@ def getCampaignStatsById(id):
         title=gettext('Campaign stats - %(campaign_name)s',
                       campaign_name=campaign.campaign_name),
         campaign=campaign,
-        total_contributions=total_contributions,
-        datewise_data=datewise_data,
-        top_contributors=top_contributors,
-        language_stats=language_stats,
-        country_distribution=country_distribution,
-        contribution_types=contribution_types,
+        total_contributions=campaign_stats['total_contributions'],
+        datewise_data=campaign_stats['datewise_data'],
+        top_contributors=campaign_stats['top_contributors'],
+        language_stats=campaign_stats['language_stats'],
+        country_distribution=campaign_stats['country_distribution'],
+        contribution_types=campaign_stats['contribution_types'],
         session_language=session_language,
         username=username,
         current_user=current_user,
@@ -520,58 +434,11 @@ def get_stats_by_date(campaign_id):
         return make_response(jsonify({'error': gettext('Invalid date format; expected YYYY-MM-DD')}), 400)
 
     try:
-        # Base filter list to be applied to every query
-        filters = [Contribution.campaign_id == campaign_id]
-        if start_date:
-            filters.append(Contribution.date >= start_date)
-        if end_date:
-            filters.append(Contribution.date <= end_date)
-
-        # Total contributions in the date range
-        total_contributions = db.session.query(func.count(Contribution.id)).filter(*filters).scalar()
-
-        datewise_data_query = db.session.query(
-            Contribution.date,
-            func.count(Contribution.id).label('count')
-        ).filter(*filters).group_by(Contribution.date).order_by(Contribution.date).all()
-        datewise_data = [{'date': r.date.strftime('%Y-%m-%d'), 'count': r.count} for r in datewise_data_query]
-        
-        # Top 5 contributors in the date range
-        top_contributors_query = db.session.query(
-            User.username,
-            func.count(Contribution.id).label('count')
-        ).join(Contribution, User.id == Contribution.user_id).filter(*filters).group_by(User.username).order_by(func.count(Contribution.id).desc()).limit(5).all()
-        top_contributors = [{'username': r.username, 'count': r.count} for r in top_contributors_query]
-
-        # Language stats in the date range
-        language_stats_query = db.session.query(
-            Contribution.caption_language.label('language'),
-            func.count(Contribution.id).label('count')
-        ).filter(Contribution.caption_language.isnot(None), Contribution.caption_language != '', *filters).group_by('language').order_by(func.count(Contribution.id).desc()).all()
-        language_stats = [{'language': r.language, 'count': r.count} for r in language_stats_query]
-
-        # Country distribution in the date range
-        country_distribution_query = db.session.query(
-            Contribution.country,
-            func.count(Contribution.id).label('count')
-        ).filter(Contribution.country.isnot(None), Contribution.country != '', *filters).group_by(Contribution.country).order_by(func.count(Contribution.id).desc()).all()
-        country_distribution = [{'country': r.country, 'count': r.count} for r in country_distribution_query]
-
-        # Contribution types in the date range
-        contribution_types_query = db.session.query(
-            Contribution.edit_type,
-            func.count(Contribution.id).label('count')
-        ).filter(Contribution.edit_type.isnot(None), Contribution.edit_type != '', *filters).group_by(Contribution.edit_type).order_by(func.count(Contribution.id).desc()).all()
-        contribution_types = [{'type': r.edit_type, 'count': r.count} for r in contribution_types_query]
-
-        return jsonify({
-            'total_contributions': total_contributions,
-            'datewise_data': datewise_data,
-            'top_contributors': top_contributors,
-            'language_stats': language_stats,
-            'country_distribution': country_distribution,
-            'contribution_types': contribution_types
-        })
+        campaign_stats = cache.get_or_compute(
+            'stats_by_date', campaign_id, {'start_date': start_date, 'end_date': end_date},
+            lambda: stats.get_campaign_stats(campaign_id, start_date, end_date)
+        )
+        return jsonify(campaign_stats)
     except Exception:
         app.logger.exception('Unexpected error while generating stats for campaign %s', campaign_id)
         return make_response(jsonify({'error': gettext('An internal error occurred')}), 500)
@@ -699,7 +566,8 @@ def updateCampaign(id):
             flash(gettext('Campaign update failed. Please try later!'), 'danger')
         else:
             if form.update_images.data:
-                image_updater.update_in_task(id)
+                # Keep the current images available while updating.
+                image_updater.update_in_task(id, incremental=True)
             flash(gettext('Update succesfull!'), 'success')
             return redirect(url_for('campaigns.getCampaignById', id=id))
 
@@ -790,24 +658,30 @@ def getCampaignGraphStatsData():
     # We get the current user's username
     username = session.get('username', None)
     try:
-        data_points = get_stats_data_points(campaign_id_int, username, page, per_page)
+        data_points = cache.get_or_compute(
+            'graph_stats', campaign_id_int, {'page': page, 'per_page': per_page},
+            lambda: get_stats_data_points(campaign_id_int, username, page, per_page)
+        )
         return jsonify(data_points)
     except Exception:
         app.logger.exception('Unexpected error while loading graph stats for campaign %s', campaign_id_int)
         return make_response(jsonify({'error': gettext('An internal error occurred')}), 500)
 
 
+@campaigns.route('/api/stats-cache')
+def getStatsCacheCounters():
+    """Get the number of hits and misses of the stats cache."""
+    try:
+        return jsonify(cache.get_counters())
+    except Exception:
+        app.logger.exception('Unexpected error while reading the stats cache counters')
+        return make_response(jsonify({'error': gettext('An internal error occurred')}), 500)
+
+
 @campaigns.route('/api/post-contribution', methods=['POST'])
 def postContribution():
-    contrib_options_list = []
     contrib_data_list = request.json
     username = session.get('username', None)
-    edits_recorded = 0
-
-    # The most recent rev_id will be stored in latest_base_rev_id
-    # Default is 0 meaning there is none and the edit failed
-    latest_base_rev_id = 0
-    # We get the session and app credetials for edits on Commons
 
     campaign_id = contrib_data_list[0]['campaign_id']
     if not username:
@@ -817,103 +691,59 @@ def postContribution():
         return redirect(url_for('campaigns.contributeToCampaign', id=campaign_id))
 
     user = User.query.filter_by(username=username).first()
-    contrib_list = []
-    suggestion_list = []
     for data in contrib_data_list:
-        valid_actions = [
-            "wbsetclaim",
-            "wbremoveclaims",
-            "wbsetlabel"
-        ]
-        if data["api_options"]["action"] not in valid_actions:
+        if not contributions.is_valid_edit(data):
             abort(400)
-        # Don't create a new contribution if it's an edit
-        if data['edit_action'] != 'edit':
-            contribution = Contribution(user=user,
-                                        campaign_id=int(campaign_id),
-                                        file=data['image'],
-                                        edit_action=data['edit_action'],
-                                        edit_type=data['edit_type'],
-                                        country=data['country'],
-                                        depict_item=data.get('depict_item'),
-                                        depict_prominent=data.get('depict_prominent'),
-                                        caption_language=data.get('caption_language'),
-                                        caption_text=data.get('caption_text'),
-                                        date=datetime.date(datetime.utcnow()))
-            contrib_list.append(contribution)
-
-        # Also create a new suggestion if depict item was suggested
-        suggestion_keys = ['google_vision', 'metadata_to_concept']
-        if any(key in data for key in suggestion_keys):
-            suggestion = Suggestion(campaign_id=campaign_id,
-                                    file_name=data['image'],
-                                    depict_item=data['depict_item'],
-                                    google_vision=data.get('google_vision'),
-                                    google_vision_confidence=data.get('google_vision_confidence'),
-                                    metadata_to_concept=data.get('metadata_to_concept'),
-                                    metadata_to_concept_confidence=data.get('metadata_to_concept_confidence'),
-                                    update_status=1,
-                                    user_id=user.id)
-            suggestion_list.append(suggestion)
-
-    # We write the api_options for the contributions into a list
-    for contrib_data in contrib_data_list:
-        contrib_options_list.append(contrib_data['api_options'])
-
-    for i in range(len(contrib_options_list)):
-        # We make an api call with the current contribution data and get baserevid
-        if "ISA_DEV" in app.config and app.config["ISA_DEV"]:
-            # Just pretend that everything went fine without touching
-            # commons.
-            lastrevid = 1
-            return make_response(str(lastrevid), 200)
-
-        csrf_token, api_auth_token = generate_csrf_token(
-            app.config['CONSUMER_KEY'], app.config['CONSUMER_SECRET'],
-            session.get('access_token')['key'],
-            session.get('access_token')['secret']
-        )
-
         # The initial claim is not found in second requests
-        if 'initial_claim' not in contrib_data_list[i].keys():
-            contrib_data_list[i]['initial_claim'] = session.get('initial_claim')
-        lastrevid = make_edit_api_call(csrf_token,
-                                       api_auth_token,
-                                       contrib_data_list[i])
-        if lastrevid is not None:
-            edits_recorded += 1
-            # We check if the previous edit was successfull
-            # We then add the contribution to the db session
-            if len(contrib_list) > 0:
-                db.session.add(contrib_list[i])
-
-            # Check that there are still elements in the list in order to pop
-            if len(contrib_options_list) > 1:
-                # We take out the first element of the data list
-                contrib_options_list.pop(0)
-
-                # We assign the baserevid of the next data list of api_options
-                # If there is a next element in the data list
-                next_api_options = contrib_options_list[0]
-                next_api_options['baserevid'] = lastrevid
-        else:
-            return make_response("Failure", 400)
-        # We store the latest revision id to be sent to client
-        latest_base_rev_id = lastrevid
+        if 'initial_claim' not in data.keys():
+            data['initial_claim'] = session.get('initial_claim')
 
-    #  Before we commit changes we add the suggestions:
-    for suggestion in suggestion_list:
-        db.session.add(suggestion)
+    if "ISA_DEV" in app.config and app.config["ISA_DEV"]:
+        # Just pretend that everything went fine without touching
+        # commons.
+        lastrevid = 1
+        return make_response(str(lastrevid), 200)
 
-    # We attempt to save the changes to db if we have contributions
-    if len(contrib_list) > 0:
-        if commit_changes_to_db():
-            return (str(latest_base_rev_id))
-    # edit was made but not recorded in db
-    if edits_recorded > 0:
-        return (str(latest_base_rev_id))
+    if app.config.get('ASYNC_CONTRIBUTIONS'):
+        # Make the edits in the background, the client polls for the
+        # result with the job id.
+        job = contributions.make_edits_task.delay(contrib_data_list, user.id, session.get('access_token'))
+        return make_response(jsonify({'job_id': job.id}), 202)
 
-    return make_response("Failure", 400)
+    results = contributions.make_edits(contrib_data_list, user.id, session.get('access_token'))
+    if any(result['status'] != contributions.DONE for result in results):
+        return make_response("Failure", 400)
+
+    # We send the latest revision id to the client
+    return str(results[-1]['revision_id'])
+
+
+@campaigns.route('/api/post-contribution/<string:job_id>', methods=['GET'])
+def getContributionStatus(job_id):
+    username = session.get('username', None)
+    if not username:
+        return make_response(jsonify({'error': gettext('You need to login to participate')}), 401)
+
+    job = AsyncResult(job_id, app=celery_app)
+    state = job.state
+    if state == 'SUCCESS':
+        info = job.result
+    elif state == 'PROGRESS':
+        info = job.info
+    elif state == 'FAILURE':
+        info = {}
+    else:
+        # Unknown job ids are reported as pending by Celery
+        return jsonify({'state': state, 'edits': [], 'revision_id': None})
+
+    user = User.query.filter_by(username=username).first()
+    if info and info.get('user_id') != user.id:
+        abort(404)
+    return jsonify({
+        'state': state,
+        'edits': info.get('edits', []),
+        'revision_id': info.get('revision_id')
+    })
 
 
 @campaigns.route('/api/search-depicts/<int:id>')
@@ -937,8 +767,6 @@ def searchDepicts(id):
     if search_term and len(search_term) > 200:
         return make_response(jsonify({'error': gettext('Search term too long')}), 400)
 
-    headers = {'User-Agent': 'ISA/1.0 (contact: https://www.mediawiki.org/wiki/User:IsaBot)'}
-
     # If no search term provided, return top depicts for campaign
     if search_term is None or search_term == '':
         top_depicts = (Contribution.query
@@ -957,8 +785,8 @@ def searchDepicts(id):
             return jsonify({"results": None})
 
         try:
-            resp = requests.get(
-                url=app.config['WIKIDATA_SEARCH_API_URL'],
+            resp = api_client.get(
+                app.config['WIKIDATA_SEARCH_API_URL'],
                 params={
                     'action': 'wbgetentities',
                     'format': 'json',
@@ -968,8 +796,9 @@ def searchDepicts(id):
                     'languagefallback': '',
                     'origin': '*'
                 },
-                headers=headers,
-                timeout=8
+                timeout=8,
+                retries=api_client.INTERACTIVE_RETRIES,
+                max_wait=api_client.INTERACTIVE_MAX_WAIT
             )
             resp.raise_for_status()
             depict_details = resp.json()
@@ -1001,8 +830,8 @@ def searchDepicts(id):
 
     # Otherwise perform a search on Wikidata
     try:
-        resp = requests.get(
-            url=app.config['WIKIDATA_SEARCH_API_URL'],
+        resp = api_client.get(
+            app.config['WIKIDATA_SEARCH_API_URL'],
             params={
                 'search': search_term,
                 'action': 'wbsearchentities',
@@ -1011,8 +840,9 @@ def searchDepicts(id):
                 'uselang': user_lang,
                 'origin': '*'
             },
-            headers=headers,
-            timeout=8
+            timeout=8,
+            retries=api_client.INTERACTIVE_RETRIES,
+            max_wait=api_client.INTERACTIVE_MAX_WAIT
         )
         resp.raise_for_status()
         search_result = resp.json()
@@ -1044,22 +874,14 @@ def searchDepicts(id):
 
 @campaigns.route('/campaigns/<int:id>/download_csv')
 def downloadAllCampaignStats(id):
-
     campaign = Campaign.query.get(id)
-    stats_file_directory = os.getcwd() + '/campaign_stats_files/' + str(campaign.id)
-
-    # We create the all_stats download file
-    # The field in the stats file will be as thus
-    all_stats_fields = ['username', 'file', 'edit_type', 'edit_action', 'country', 'depict_item',
-                        'depict_prominent', 'caption_text', 'caption_language', 'date']
-    campaign_all_stats_data = get_all_camapaign_stats_data(id)
-    stats_csv_file = create_campaign_all_stats_csv(stats_file_directory,
-                                                   convert_latin_to_english(campaign.campaign_name),
-                                                   all_stats_fields, campaign_all_stats_data)
-    if stats_csv_file:
-        return send_file(stats_file_directory + '/' + stats_csv_file, as_attachment=True)
-    else:
-        flash('Download may be unavailable now', 'info')
+    if not campaign:
+        abort(404)
+    export_format = request.args.get('format', 'csv')
+    if not export.is_available(export_format):
+        return make_response(jsonify({'error': gettext('Invalid "format" parameter')}), 400)
+    # The contributions are written to the response while they are read
+    return export.export_response(campaign, export_format)
 
 
 @campaigns.route('/campaigns/<int:campaign_id>/images', defaults={'country_name': None})
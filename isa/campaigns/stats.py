@@ -0,0 +1,317 @@
+"""Campaign contribution statistics
+
+The statistics are read from the contribution rollup, which has the
+number of contributions per campaign, day, user, country, caption
+language and edit type, and from the counters in the campaign table.
+Both are updated when contributions are recorded. The rollup can be
+rebuilt from the contributions with the rebuild_campaign_stats
+maintenance script and the counters are reconciled periodically.
+
+"""
+
+from collections import Counter
+import logging
+
+from celery import shared_task
+from sqlalchemy import func
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from isa import db
+from isa.models import Campaign, Contribution, ContributionRollup, User
+from isa.utils.distribution import Distribution
+
+# Columns that identify a row in the rollup.
+ROLLUP_KEY = ['campaign_id', 'date', 'user_id', 'country', 'caption_language', 'edit_type']
+# Number of contributors in the top contributors list.
+TOP_CONTRIBUTORS = 5
+# Number of rollup rows fetched at a time when adding up statistics.
+ROWS_PER_FETCH = 1000
+
+
+def record_contributions(contributions):
+    """
+    Update the stats for new contributions
+
+    Adds the contributions to the rollup and to the contribution and
+    participant counters of their campaigns. The counters are updated
+    in the database (x = x + n), so concurrent updates are not lost. The
+    changes are made in the current session and committed with it, so
+    call this before committing the contributions.
+
+    Keyword arguments:
+    contributions -- Contribution objects that were added to the session.
+    """
+    if not contributions:
+        return
+
+    # Make sure that ids from relationships are set
+    db.session.flush()
+    new_participants = _new_participants(contributions)
+    add_to_rollup(contributions)
+    contributions_per_campaign = Counter(int(c.campaign_id) for c in contributions)
+    for campaign_id, count in contributions_per_campaign.items():
+        Campaign.query.filter_by(id=campaign_id).update({
+            Campaign.campaign_contributions: func.coalesce(Campaign.campaign_contributions, 0) + count,
+            Campaign.campaign_participants: (func.coalesce(Campaign.campaign_participants, 0)
+                                             + new_participants[campaign_id])
+        }, synchronize_session=False)
+
+
+def add_to_rollup(contributions):
+    """
+    Add contributions to the rollup
+
+    The changes are made in the current session and committed with it, so
+    call this before committing the contributions.
+
+    Keyword arguments:
+    contributions -- Contribution objects that were added to the session.
+    """
+    if not contributions:
+        return
+
+    # Make sure that ids from relationships are set
+    db.session.flush()
+    counts = Counter(_rollup_key(contribution) for contribution in contributions)
+    rows = [dict(zip(ROLLUP_KEY, key), contributions=count) for key, count in counts.items()]
+    db.session.execute(_upsert_statement(rows))
+
+
+def reconcile_campaign_counters(campaign_ids=None):
+    """
+    Set campaign counters to the counts of their contributions
+
+    Does not commit.
+
+    Keyword arguments:
+    campaign_ids -- Only reconcile campaigns with these ids. If None, all
+      campaigns are reconciled. Defaults to None.
+
+    Returns:
+    The number of campaigns whose counters were wrong.
+    """
+    counts_query = (db.session.query(Contribution.campaign_id,
+                                     func.count(Contribution.id),
+                                     func.count(func.distinct(Contribution.user_id)))
+                    .group_by(Contribution.campaign_id))
+    campaigns_query = db.session.query(Campaign.id, Campaign.campaign_contributions, Campaign.campaign_participants)
+    if campaign_ids is not None:
+        counts_query = counts_query.filter(Contribution.campaign_id.in_(campaign_ids))
+        campaigns_query = campaigns_query.filter(Campaign.id.in_(campaign_ids))
+    counts = {campaign_id: (contributions, participants) for campaign_id, contributions, participants in counts_query}
+
+    corrected = 0
+    for campaign_id, contributions, participants in campaigns_query.all():
+        expected = counts.get(campaign_id, (0, 0))
+        if (contributions, participants) != expected:
+            Campaign.query.filter_by(id=campaign_id).update({
+                Campaign.campaign_contributions: expected[0],
+                Campaign.campaign_participants: expected[1]
+            }, synchronize_session=False)
+            corrected += 1
+    return corrected
+
+
+@shared_task
+def reconcile_campaign_counters_task():
+    """
+    Reconcile the counters for all campaigns
+
+    Run periodically by Celery beat, to correct counters that have
+    drifted, e.g. because contributions were removed.
+    """
+    corrected = reconcile_campaign_counters()
+    db.session.commit()
+    if corrected:
+        logging.info("Corrected contribution counters for {} campaigns.".format(corrected))
+    return corrected
+
+
+def rebuild_rollup(campaign_ids=None):
+    """
+    Rebuild the rollup from the contributions
+
+    Does not commit.
+
+    Keyword arguments:
+    campaign_ids -- Only rebuild for campaigns with these ids. If None,
+      all campaigns are rebuilt. Defaults to None.
+
+    Returns:
+    The number of rows in the rebuilt rollup.
+    """
+    delete_query = ContributionRollup.query
+    if campaign_ids is not None:
+        delete_query = delete_query.filter(ContributionRollup.campaign_id.in_(campaign_ids))
+    delete_query.delete(synchronize_session=False)
+
+    key_columns = [
+        Contribution.campaign_id,
+        Contribution.date,
+        Contribution.user_id,
+        func.coalesce(Contribution.country, ''),
+        func.coalesce(Contribution.caption_language, ''),
+        Contribution.edit_type
+    ]
+    select_query = db.session.query(*key_columns, func.count(Contribution.id)).group_by(*key_columns)
+    if campaign_ids is not None:
+        select_query = select_query.filter(Contribution.campaign_id.in_(campaign_ids))
+    result = db.session.execute(
+        ContributionRollup.__table__.insert().from_select(ROLLUP_KEY + ['contributions'], select_query.statement)
+    )
+    return result.rowcount
+
+
+def get_campaign_stats(campaign_id, start_date=None, end_date=None):
+    """
+    Get contribution statistics for a campaign
+
+    The rollup rows of the campaign are read with one query and all the
+    statistics are added up from them in a single pass.
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+    start_date -- Only count contributions made on or after this date.
+      Defaults to None.
+    end_date -- Only count contributions made on or before this date.
+      Defaults to None.
+
+    Returns:
+    A dict with the total number of contributions, the contributions
+    per date, per top contributor, per language, per country and per
+    contribution type, and a summary of the distribution of the
+    contributions over the contributors.
+    """
+    filters = [ContributionRollup.campaign_id == campaign_id]
+    if start_date:
+        filters.append(ContributionRollup.date >= start_date)
+    if end_date:
+        filters.append(ContributionRollup.date <= end_date)
+    rows_query = (db.session.query(ContributionRollup.date,
+                                   User.username,
+                                   ContributionRollup.country,
+                                   ContributionRollup.caption_language,
+                                   ContributionRollup.edit_type,
+                                   ContributionRollup.contributions)
+                  .outerjoin(User, User.id == ContributionRollup.user_id)
+                  .filter(*filters))
+
+    total_contributions = 0
+    per_date = Counter()
+    per_user = Counter()
+    per_language = Counter()
+    per_country = Counter()
+    per_type = Counter()
+    for row in rows_query.yield_per(ROWS_PER_FETCH):
+        total_contributions += row.contributions
+        per_date[row.date] += row.contributions
+        if row.edit_type:
+            per_type[row.edit_type] += row.contributions
+        if row.username is not None:
+            per_user[row.username] += row.contributions
+        if row.caption_language:
+            per_language[row.caption_language] += row.contributions
+        if row.country:
+            per_country[row.country] += row.contributions
+
+    return {
+        'total_contributions': total_contributions,
+        'datewise_data': [
+            {'date': day.strftime('%Y-%m-%d'), 'count': count} for day, count in sorted(per_date.items())
+        ],
+        'top_contributors': [
+            {'username': username, 'count': count}
+            for username, count in _largest_counts(per_user)[:TOP_CONTRIBUTORS]
+        ],
+        'language_stats': [
+            {'language': language, 'count': count} for language, count in _largest_counts(per_language)
+        ],
+        'country_distribution': [
+            {'country': country, 'count': count} for country, count in _largest_counts(per_country)
+        ],
+        'contribution_types': [
+            {'type': edit_type, 'count': count} for edit_type, count in _largest_counts(per_type)
+        ],
+        'contributor_distribution': Distribution.from_counts(per_user.values()).describe()
+    }
+
+
+def _largest_counts(counts):
+    """
+    Sort counts with the largest first
+
+    Values with the same count are sorted by value, so that the order
+    doesn't depend on the database.
+
+    Keyword arguments:
+    counts -- Counter to sort.
+
+    Returns:
+    List of (value, count) tuples.
+    """
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def _new_participants(contributions):
+    """
+    Count users that contribute to a campaign for the first time
+
+    Call before the contributions are added to the rollup.
+
+    Keyword arguments:
+    contributions -- New contributions.
+
+    Returns:
+    Counter with the number of new participants per campaign id.
+    """
+    users_per_campaign = {}
+    for contribution in contributions:
+        users_per_campaign.setdefault(int(contribution.campaign_id), set()).add(contribution.user_id)
+
+    new_participants = Counter()
+    for campaign_id, user_ids in users_per_campaign.items():
+        previous_users = {
+            user_id for user_id, in (db.session.query(ContributionRollup.user_id)
+                                     .filter(ContributionRollup.campaign_id == campaign_id,
+                                             ContributionRollup.user_id.in_(user_ids))
+                                     .distinct())
+        }
+        new_participants[campaign_id] = len(user_ids - previous_users)
+    return new_participants
+
+
+def _rollup_key(contribution):
+    return (
+        int(contribution.campaign_id),
+        contribution.date,
+        contribution.user_id,
+        contribution.country or '',
+        contribution.caption_language or '',
+        contribution.edit_type
+    )
+
+
+def _upsert_statement(rows):
+    """
+    Create a statement that adds to the counts of rollup rows
+
+    Rows that don't exist are inserted.
+
+    Keyword arguments:
+    rows -- Dicts with the key columns and the number of contributions
+      to add.
+    """
+    table = ContributionRollup.__table__
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        statement = mysql.insert(table).values(rows)
+        return statement.on_duplicate_key_update(
+            contributions=table.c.contributions + statement.inserted.contributions
+        )
+
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    statement = insert(table).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=ROLLUP_KEY,
+        set_={'contributions': table.c.contributions + statement.excluded.contributions}
+    )
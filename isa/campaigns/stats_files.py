@@ -0,0 +1,204 @@
+"""Campaign statistics files
+
+CSV files with the country and contributor statistics of a campaign are
+written to campaign_stats_files/<campaign id> by a Celery task, not
+while the campaign page is rendered. The files are only rewritten when
+the campaign's contributions or name have changed. The data version they
+were written for is kept in a version file next to them.
+
+"""
+
+import json
+import logging
+import os
+
+from celery import shared_task
+import redis
+
+from isa import app
+from isa.campaigns.utils import (create_campaign_country_stats_csv, create_campaign_contributor_stats_csv,
+                                 get_campaign_country_data, get_contributor_leaderboard, get_stats_file_name)
+from isa.models import Campaign
+from isa.utils import cache
+
+STATS_FILES_DIRECTORY = 'campaign_stats_files'
+VERSION_FILE = 'version'
+COUNTRY_FIELDS = ['rank', 'country', 'images_improved']
+CONTRIBUTOR_FIELDS = ['rank', 'username', 'images_improved']
+# Don't start another task to write a campaign's files for this many
+# seconds after one was started, unless it has finished.
+PENDING_TTL = 600
+
+
+def get_stats_directory(campaign_id):
+    """
+    Get the directory for the statistics files of a campaign
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+    """
+    return os.path.join(os.getcwd(), STATS_FILES_DIRECTORY, str(campaign_id))
+
+
+def get_data_version(campaign):
+    """
+    Get the version of a campaign's statistics data
+
+    The contribution counter of the campaign is increased for each new
+    contribution, so it changes whenever the statistics do. The file
+    names are included too, since they change when the campaign is
+    renamed.
+
+    Keyword arguments:
+    campaign -- The campaign.
+    """
+    return json.dumps([campaign.campaign_contributions or 0, *get_stats_file_names(campaign.campaign_name)])
+
+
+def read_version(campaign_id):
+    """
+    Read the data version that the statistics files were written for
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+
+    Returns:
+    The version as a string, or None if the files haven't been written.
+    """
+    try:
+        with open(os.path.join(get_stats_directory(campaign_id), VERSION_FILE), encoding='UTF-8') as version_file:
+            return version_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def get_stats_file_names(campaign_name):
+    """
+    Get the names of the statistics files for a campaign
+
+    Keyword arguments:
+    campaign_name -- The campaign name.
+
+    Returns:
+    Tuple with the names of the country file and the contributor file.
+    """
+    return (get_stats_file_name(campaign_name, 'country_stats'),
+            get_stats_file_name(campaign_name, 'stats'))
+
+
+def update_stats_files(campaign):
+    """
+    Start a task to write the statistics files if they are out of date
+
+    This doesn't wait for the task, so until it's done the files have
+    the previous data or don't exist yet. Only one task is started at a
+    time for a campaign.
+
+    Keyword arguments:
+    campaign -- The campaign.
+
+    Returns:
+    True if a task was started.
+    """
+    if read_version(campaign.id) == get_data_version(campaign):
+        return False
+    pending_key = _pending_key(campaign.id)
+    try:
+        if not cache.get_backend().add(pending_key, '1', PENDING_TTL):
+            # A task will write the files
+            return False
+    except redis.RedisError:
+        logging.exception("Could not check for a pending stats files task.")
+    try:
+        write_stats_files_task.delay(campaign.id)
+    except Exception:
+        # The files are written on a later visit
+        logging.exception("Could not start writing stats files for campaign {}.".format(campaign.id))
+        _clear_pending(campaign.id)
+        return False
+    return True
+
+
+def write_stats_files(campaign_id):
+    """
+    Write the statistics files for a campaign if they are out of date
+
+    Every file is replaced atomically and the version file is written
+    last, so concurrent writers and readers don't see partial files.
+    Files with other names, from before the campaign was renamed, are
+    removed.
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+
+    Returns:
+    True if the files were written, False if they were up to date or the
+    campaign doesn't exist.
+    """
+    campaign = Campaign.query.get(campaign_id)
+    if campaign is None:
+        return False
+
+    # Read the version before the data. If contributions are added in the
+    # meantime, the files are written again for the next version.
+    version = get_data_version(campaign)
+    if read_version(campaign_id) == version:
+        return False
+
+    directory = get_stats_directory(campaign_id)
+    os.makedirs(directory, exist_ok=True)
+    country_stats_data = get_campaign_country_data(
+        campaign_id, per_page=None,
+        distinct_files=app.config.get('STATS_COUNT_DISTINCT_FILES', False)
+    )
+    create_campaign_country_stats_csv(directory, campaign.campaign_name, COUNTRY_FIELDS, country_stats_data)
+    contributor_stats_data = [
+        {'rank': row.rank, 'username': row.username, 'images_improved': row.images_improved}
+        for row in get_contributor_leaderboard(campaign_id)
+    ]
+    create_campaign_contributor_stats_csv(directory, campaign.campaign_name, CONTRIBUTOR_FIELDS,
+                                          contributor_stats_data)
+    _remove_stale_files(directory, get_stats_file_names(campaign.campaign_name))
+    _write_version(directory, version)
+    return True
+
+
+@shared_task
+def write_stats_files_task(campaign_id):
+    """
+    Write the statistics files for a campaign in the background
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+    """
+    try:
+        return write_stats_files(campaign_id)
+    finally:
+        _clear_pending(campaign_id)
+
+
+def _pending_key(campaign_id):
+    return '{}stats-files-pending:{}'.format(cache.KEY_PREFIX, campaign_id)
+
+
+def _clear_pending(campaign_id):
+    try:
+        cache.get_backend().delete(_pending_key(campaign_id))
+    except redis.RedisError:
+        logging.exception("Could not clear the pending stats files task.")
+
+
+def _remove_stale_files(directory, file_names):
+    for file_name in os.listdir(directory):
+        if file_name.endswith('.csv') and file_name not in file_names:
+            try:
+                os.remove(os.path.join(directory, file_name))
+            except FileNotFoundError:
+                pass
+
+
+def _write_version(directory, version):
+    temporary_path = os.path.join(directory, '{}.{}.tmp'.format(VERSION_FILE, os.getpid()))
+    with open(temporary_path, 'w', encoding='UTF-8') as version_file:
+        version_file.write(version)
+    os.replace(temporary_path, os.path.join(directory, VERSION_FILE))
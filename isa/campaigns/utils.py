@@ -1,23 +1,36 @@
 import json
+import math
+import os
 import sys
 import csv
+import tempfile
+import threading
+import time
 import pycountry
-import requests
 import mwoauth
 import unicodedata
 
 from datetime import datetime
 from flask import request, session
 from mwoauth import ConsumerToken, Handshaker
-from operator import itemgetter
 from requests_oauthlib import OAuth1
+from sqlalchemy import Integer, cast, func
 
 from isa import app, db
-from isa.models import Contribution, User
-from isa.users.utils import (get_all_users_contribution_data_per_campaign, get_user_ranking)
+from isa.models import Contribution, ContributionRollup, User
+from isa.utils import api_client
 
 
 API_URL = "https://commons.wikimedia.org/w/api.php"
+# Use a cached CSRF token for at most this many seconds. Can be
+# overridden with CSRF_TOKEN_TTL in the config.
+CSRF_TOKEN_TTL = 3600
+
+# CSRF tokens keyed by the user's access token, as (token, expiry time).
+_csrf_tokens = {}
+_csrf_tokens_lock = threading.Lock()
+# Number of contributors per page in the campaign table when not given.
+DEFAULT_PER_PAGE = 20
 
 
 def get_country_from_code(country_code):
@@ -79,41 +92,41 @@ def combine_campaign_content(content_list):
     return campaign_content
 
 
-def get_all_camapaign_stats_data(campaign_id):
+def get_stats_file_name(campaign_name, suffix):
     """
-    provides all contributions related to a campaign
+    Get the name of a statistics file for a campaign
 
     Keyword arguments:
-    campaign_id -- The id of the campaign in question
+    campaign_name -- The campaign name
+    suffix -- Suffix for the kind of statistics, e.g. "country_stats"
     """
-    all_campaign_stats_data = []
-    all_campaign_stats = Contribution.query.filter_by(campaign_id=campaign_id).all()
-    for campaign_stat in all_campaign_stats:
-        campaign_stat_data = {}
-        campaign_stat_data['username'] = campaign_stat.user.username
-        campaign_stat_data['file'] = campaign_stat.file
-        campaign_stat_data['edit_type'] = campaign_stat.edit_type
-        campaign_stat_data['edit_action'] = campaign_stat.edit_action
-        campaign_stat_data['country'] = campaign_stat.country
-        campaign_stat_data['depict_item'] = campaign_stat.depict_item
-        campaign_stat_data['depict_prominent'] = campaign_stat.depict_prominent
-        campaign_stat_data['caption_text'] = campaign_stat.caption_text
-        campaign_stat_data['caption_language'] = campaign_stat.caption_language
-        campaign_stat_data['date'] = campaign_stat.date
-        all_campaign_stats_data.append(campaign_stat_data)
-    return all_campaign_stats_data
+    return campaign_name.replace(' ', '_') + '_' + suffix + '.csv'
 
 
-def get_all_camapign_stats_data(campaign_id):
-    """Backward-compatible alias for get_all_camapaign_stats_data.
-
-    The original helper was named get_all_camapaign_stats_data, but the
-    test suite imports get_all_camapign_stats_data (note the swapped
-    letters). This thin wrapper preserves existing behavior while
-    satisfying the test import without changing external APIs.
+def write_csv_file(file_path, fields, rows):
     """
+    Write a CSV file, replacing an existing file atomically
 
-    return get_all_camapaign_stats_data(campaign_id)
+    The rows are written to a temporary file in the same directory which
+    is then renamed, so that readers never see a partially written file.
+
+    Keyword arguments:
+    file_path -- Path of the file to write
+    fields -- Fields to add to the csv header
+    rows -- Dicts with the values for each row
+    """
+    directory = os.path.dirname(file_path)
+    with tempfile.NamedTemporaryFile('w', encoding='UTF-8', dir=directory,
+                                     suffix='.tmp', delete=False) as csv_file:
+        try:
+            writer = csv.DictWriter(csv_file, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        except Exception:
+            csv_file.close()
+            os.remove(csv_file.name)
+            raise
+    os.replace(csv_file.name, file_path)
 
 
 def create_campaign_country_stats_csv(stats_file_directory, campaign_name,
@@ -127,16 +140,9 @@ def create_campaign_country_stats_csv(stats_file_directory, campaign_name,
     country_fields -- Fields to add to the csv header
     country_stats_data -- Country data for csv file
     """
-    file_directory = stats_file_directory + '/' + campaign_name.replace(' ', '_') + '_country_stats.csv'
-    # We build the campaign statistucs file here with the country stats stats
-    with open(file_directory, 'w', encoding='UTF-8') as csv_file:
-        writer = csv.writer(csv_file)
-        fields = country_fields
-        writer = csv.DictWriter(csv_file, fieldnames=fields)
-        writer.writeheader()
-        writer.writerows(country_stats_data)
-    csv_file.close()
-    return campaign_name.replace(' ', '_') + '_country_stats.csv'
+    file_name = get_stats_file_name(campaign_name, 'country_stats')
+    write_csv_file(stats_file_directory + '/' + file_name, country_fields, country_stats_data)
+    return file_name
 
 
 def create_campaign_contributor_stats_csv(stats_file_directory, campaign_name,
@@ -150,45 +156,23 @@ def create_campaign_contributor_stats_csv(stats_file_directory, campaign_name,
     country_fields -- Fields to add to the csv header
     country_stats_data -- Contributor data for csv file
     """
-    # We build the campaign statistucs file here with the country stats stats
-    file_directory = stats_file_directory + '/' + campaign_name.replace(' ', '_') + '_stats.csv'
-    with open(file_directory, 'w', encoding='UTF-8') as contrib_csv_file:
-        writer = csv.writer(contrib_csv_file)
-        fields = contributor_fields
-        writer = csv.DictWriter(contrib_csv_file, fieldnames=fields)
-        writer.writeheader()
-        writer.writerows(contributor_stats_data)
-    contrib_csv_file.close()
-    return campaign_name.replace(' ', '_') + '_stats.csv'
+    file_name = get_stats_file_name(campaign_name, 'stats')
+    write_csv_file(stats_file_directory + '/' + file_name, contributor_fields, contributor_stats_data)
+    return file_name
 
 
-def create_campaign_all_stats_csv(stats_file_directory, campaign_name, all_stats_fields,
-                                  campaign_all_stats_data):
-    """
-    Create CSV file with contributor statistics for a campaign
-
-    Keyword arguments:
-    stats_file_directory -- The directory to save the csv file
-    campaign_name -- The campaign name
-    country_fields -- Fields to add to the csv header
-    country_stats_data -- All campaign stats data for csv file
-    """
-    # We build the campaign statistucs file here with the country stats stats
-    file_directory = stats_file_directory + '/' + campaign_name.replace(' ', '_') + '_all_stats.csv'
-    with open(file_directory, 'w', encoding='UTF-8') as all_stats_csv_file:
-        writer = csv.writer(all_stats_csv_file)
-        fields = all_stats_fields
-        writer = csv.DictWriter(all_stats_csv_file, fieldnames=fields)
-        writer.writeheader()
-        writer.writerows(campaign_all_stats_data)
-    all_stats_csv_file.close()
-    return campaign_name.replace(' ', '_') + '_all_stats.csv'
+class BadTokenException(Exception):
+    pass
 
 
 def generate_csrf_token(app_key, app_secret, user_key, user_secret):
     """
     Generate CSRF token for edit request
 
+    Tokens are cached per user access token, so that a user making
+    several edits only needs one token request. A cached token is used
+    for at most CSRF_TOKEN_TTL seconds (set in the config).
+
     Keyword arguments:
     app_key -- The application api auth key
     app_secret -- The application api auth secret
@@ -198,19 +182,40 @@ def generate_csrf_token(app_key, app_secret, user_key, user_secret):
     # We authenticate the user using the keys
     auth = OAuth1(app_key, app_secret, user_key, user_secret)
 
+    cache_key = (user_key, user_secret)
+    with _csrf_tokens_lock:
+        cached_token = _csrf_tokens.get(cache_key)
+    if cached_token is not None and cached_token[1] > time.monotonic():
+        return cached_token[0], auth
+
     # Get token
-    token_request = requests.get(API_URL, params={
+    token_request = api_client.get(API_URL, params={
         'action': 'query',
         'meta': 'tokens',
         'format': 'json',
-    }, auth=auth)
+    }, auth=auth, retries=api_client.INTERACTIVE_RETRIES, max_wait=api_client.INTERACTIVE_MAX_WAIT)
     token_request.raise_for_status()
 
     # We get the CSRF token from the result to be used in editing
     CSRF_TOKEN = token_request.json()['query']['tokens']['csrftoken']
+    expires = time.monotonic() + app.config.get('CSRF_TOKEN_TTL', CSRF_TOKEN_TTL)
+    with _csrf_tokens_lock:
+        _csrf_tokens[cache_key] = (CSRF_TOKEN, expires)
     return CSRF_TOKEN, auth
 
 
+def invalidate_csrf_token(user_key, user_secret):
+    """
+    Remove a user's CSRF token from the cache
+
+    Keyword arguments:
+    user_key -- User auth key generated at login
+    user_secret -- User secret generated at login
+    """
+    with _csrf_tokens_lock:
+        _csrf_tokens.pop((user_key, user_secret), None)
+
+
 def make_edit_api_call(csrf_token, api_auth_token, contribution_data):
     """
     Make edit API call to make changes to an image on Commons.
@@ -222,8 +227,13 @@ def make_edit_api_call(csrf_token, api_auth_token, contribution_data):
     user_secret -- User secret generated in token at login
     username -- username in session
     params -- APi configuration data from front end
+
+    Exceptions:
+    BadTokenException -- When Commons doesn't accept the CSRF token.
     """
-    params = contribution_data['api_options']
+    # Copy the options, so that the same edit can be sent again with a
+    # new token.
+    params = dict(contribution_data['api_options'])
     edit_type = contribution_data['edit_type']
     edit_action = contribution_data['edit_action']
     campaign_id = contribution_data['campaign_id']
@@ -240,9 +250,14 @@ def make_edit_api_call(csrf_token, api_auth_token, contribution_data):
 
     # This is the actual edit post request
     # We sign that with the authentication
-    response = requests.post(API_URL, data=params, auth=api_auth_token)
+    response = api_client.post(API_URL, data=params, auth=api_auth_token,
+                               retries=api_client.INTERACTIVE_RETRIES,
+                               max_wait=api_client.INTERACTIVE_MAX_WAIT)
     if response.status_code == 200:
         result = response.json()
+        if result.get('error', {}).get('code') == 'badtoken':
+            raise BadTokenException(result['error'].get('info'))
+
         revision_id = None
         if edit_type == 'depicts':
             page_info = result.get('pageinfo')
@@ -255,135 +270,138 @@ def make_edit_api_call(csrf_token, api_auth_token, contribution_data):
         return revision_id
 
 
-def get_country_ranking(all_contrystats_data, country):
-    """
-    Get a particular Country's ranking
-
-    Keyword arguments:
-    all_contry_stats_data -- sorted list of all country by their contributions
-    country -- the country whic's ranking is to be obtained
-    """
-
-    index = next((i for i, item in enumerate(all_contrystats_data) if item['country'] == country), -1)
-    return index + 1  # we shift from 0
-
-
-def get_country_improved_file_count(campaign_contributions, country):
-    """
-    Count improved files per country in ca campaign
-
-    Keyword arguments:
-    campaign_contributions -- Contributions in said campaign
-    country -- The country whose images are counted
-    """
-    country_improved_files = []
-    for contribution in campaign_contributions:
-        if contribution.country == country:
-            country_improved_files.append(contribution.file)
-    return len(country_improved_files)
-
-
-# TODO: Transfer all these methods to the campaign blueprint
-def get_campaign_country_data(campaign_id, page=1, per_page=10):
+def get_campaign_country_data(campaign_id, page=1, per_page=10, distinct_files=False):
     """
     Fetch campaign country data
 
+    Contributions are counted per country over the whole campaign and the
+    countries are ranked by their counts. The counts are read from the
+    contribution rollup, unless distinct files are counted.
+
     Keyword arguments:
     campaign_id -- Campaign country for said campaign
-    """
-    # Holds contribution countries for campaign with id: campaign_id
-    contribution_countries = []
-
-    # Holds all countries and images imaproved per country
-    all_country_statistics_data = []
-
-    # We get all the campaign contributions
-    # Support pagination for campaign contributions
-    pagination = Contribution.query.filter_by(campaign_id=campaign_id).paginate(page=page, per_page=per_page, error_out=False)
-    campaign_contributions = pagination.items
-    # We then iterate to get the countries
-    for contribution in campaign_contributions:
-        if contribution.country != "":
-            contribution_countries.append(contribution.country)
-    contribution_countries = set(contribution_countries)
+    page -- Page of countries to get. Defaults to 1.
+    per_page -- Number of countries per page. If None, all countries are
+      returned. Defaults to 10.
+    distinct_files -- If True, count each file once per country, however
+      many times it was edited. The rollup doesn't have the files, so
+      they are counted from the contributions. Defaults to False.
+
+    Returns:
+    List of dicts with country, images_improved and rank, sorted by rank.
+    """
+    if distinct_files:
+        images_improved = func.count(func.distinct(Contribution.file))
+        country_counts = (
+            db.session.query(
+                Contribution.country.label('country'),
+                images_improved.label('images_improved'),
+                func.rank().over(order_by=images_improved.desc()).label('rank'))
+            .filter(Contribution.campaign_id == campaign_id, Contribution.country != '')
+            .group_by(Contribution.country)
+            .subquery()
+        )
+    else:
+        images_improved = cast(func.sum(ContributionRollup.contributions), Integer)
+        country_counts = (
+            db.session.query(
+                ContributionRollup.country.label('country'),
+                images_improved.label('images_improved'),
+                func.rank().over(order_by=images_improved.desc()).label('rank'))
+            .filter(ContributionRollup.campaign_id == campaign_id, ContributionRollup.country != '')
+            .group_by(ContributionRollup.country)
+            .subquery()
+        )
+    query = (db.session.query(country_counts)
+             .order_by(country_counts.c.rank, country_counts.c.country))
+    if per_page is not None:
+        query = query.limit(per_page).offset(((page or 1) - 1) * per_page)
+    return [
+        {'country': row.country, 'images_improved': row.images_improved, 'rank': row.rank}
+        for row in query
+    ]
+
+
+def get_contributor_leaderboard(campaign_id):
+    """
+    Get a query for the contributors to a campaign, in order of rank
+
+    Contributors are ranked by the number of contributions they made in
+    the campaign, which are added up from the contribution rollup.
+    Contributors with the same number of contributions share a rank.
 
-    for country in contribution_countries:
-        country_stats_data = {
-            'country': country,
-            'images_improved': get_country_improved_file_count(campaign_contributions, country)
-        }
-        all_country_statistics_data.append(country_stats_data)
-    all_country_statistics_data = sorted(all_country_statistics_data,
-                                         key=itemgetter('images_improved'), reverse=True)
+    Keyword arguments:
+    campaign_id -- Campaign id for said campaign
 
-    for country_stats_data in all_country_statistics_data:
-        country_stats_data['rank'] = get_country_ranking(all_country_statistics_data, country_stats_data['country'])
-    return all_country_statistics_data
+    Returns:
+    Query for rows with username, images_improved and rank.
+    """
+    contribution_count = cast(func.sum(ContributionRollup.contributions), Integer)
+    ranked_contributors = (
+        db.session.query(
+            ContributionRollup.user_id.label('user_id'),
+            contribution_count.label('images_improved'),
+            func.rank().over(order_by=contribution_count.desc()).label('rank'))
+        .filter(ContributionRollup.campaign_id == campaign_id)
+        .group_by(ContributionRollup.user_id)
+        .subquery()
+    )
+    return (
+        db.session.query(User.username, ranked_contributors.c.images_improved, ranked_contributors.c.rank)
+        .join(ranked_contributors, User.id == ranked_contributors.c.user_id)
+        .order_by(ranked_contributors.c.rank, User.username)
+    )
 
 
 def get_table_stats(campaign_id, username, page, per_page):
     """
     Fetch campaign table stats
 
+    Contributors are ranked by the number of contributions they made in
+    the campaign. Contributors with the same number of contributions
+    share a rank.
+
     Keyword arguments:
     campaign_id -- Campaign id for said campaign
     username -- username of the current user who's stats will be shown
-    """
-    # participantids for this campaign
-    campaign_user_names = []
-
-    # We are querrying all the users who participate in the campaign
-    # Get all unique usernames who contributed to this campaign
-    user_query = (
-        User.query
-        .join(Contribution, User.id == Contribution.user_id)
-        .filter(Contribution.campaign_id == campaign_id)
-        .group_by(User.id)
-        .order_by(db.func.count(Contribution.id).desc())
-    )
-    try:
-        contribs_for_campaign = user_query.paginate(page=page, per_page=per_page, error_out=False)
-        # If the requested page is out of range, fallback to page 1
-        if page > contribs_for_campaign.pages and contribs_for_campaign.pages > 0:
-            contribs_for_campaign = user_query.paginate(page=1, per_page=per_page, error_out=False)
-    except Exception:
-        # If any error occurs (e.g., no results), fallback to page 1
-        contribs_for_campaign = user_query.paginate(page=1, per_page=per_page, error_out=False)
-
-    for campaign_contribution in contribs_for_campaign.items:
-        campaign_user_names.append(campaign_contribution.username)
-    # we get the unique ids so as not to count an id twice
-    campaign_user_names_set = set(campaign_user_names)
-    # We then re-initialize the ids array
-    campaign_user_names = []
-    # We now obtain the ranking for all the users in the system and their files improved
-    all_camapaign_users_list = []
-    #  We iterate the individual participants id in a campaign and get the user info
-    for user_name in campaign_user_names_set:
-        user = User.query.filter_by(username=user_name).first()
-        all_camapaign_users_list.append(user)
-        
-    # We get the users and their contribution data
-    all_contributors_data = get_all_users_contribution_data_per_campaign(all_camapaign_users_list, campaign_id)
-    current_user_rank = get_user_ranking(all_contributors_data, username)
-
-    # We add rank to all contributor's data
-    for user_data in all_contributors_data:
-        user_data['rank'] = get_user_ranking(all_contributors_data, user_data['username'])
+    page -- Page of contributors to get. Out of range pages fall back to
+      the first page.
+    per_page -- Number of contributors per page
+    """
+    leaderboard = get_contributor_leaderboard(campaign_id)
+    per_page = per_page or DEFAULT_PER_PAGE
+    campaign_editors = leaderboard.count()
+    pages = math.ceil(campaign_editors / per_page)
+    # If the requested page is out of range, fallback to page 1
+    if page is None or page < 1 or page > pages:
+        page = 1
+    all_contributors_data = [
+        {'username': row.username, 'images_improved': row.images_improved, 'rank': row.rank}
+        for row in leaderboard.limit(per_page).offset((page - 1) * per_page)
+    ]
+
+    current_user_rank = 0
+    if username:
+        current_user = leaderboard.filter(User.username == username).first()
+        if current_user is not None:
+            current_user_rank = current_user.rank
 
     # We get all the campaign coountry sorted data
-    all_campaign_country_statistics_data = get_campaign_country_data(campaign_id, page, per_page)
+    all_campaign_country_statistics_data = get_campaign_country_data(
+        campaign_id, page, per_page,
+        distinct_files=app.config.get('STATS_COUNT_DISTINCT_FILES', False)
+    )
 
     campaign_table_stats = {}
     campaign_table_stats['all_contributors_data'] = all_contributors_data
     campaign_table_stats['all_campaign_country_statistics_data'] = all_campaign_country_statistics_data
     campaign_table_stats['current_user_rank'] = current_user_rank
-    campaign_table_stats['campaign_editors'] = len(campaign_user_names_set)
+    campaign_table_stats['campaign_editors'] = campaign_editors
     campaign_table_stats['page_info'] = {
         'page': page,
         'per_page': per_page,
-        'total': contribs_for_campaign.total,
-        'pages': contribs_for_campaign.pages,
+        'total': campaign_editors,
+        'pages': pages,
     }
     return campaign_table_stats
 
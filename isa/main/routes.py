@@ -3,63 +3,84 @@ from datetime import date
 
 from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify
 from flask_login import current_user
-from sqlalchemy import text, func, extract, or_
-from isa import  db
-import statistics
-# from isa import app, db, gettext
+from sqlalchemy import text, func, or_
+from isa import app, db
 
 from isa import gettext
 from isa.users.utils import add_user_to_db
-from isa.models import Contribution, Campaign
-import time
-
-# Simple in-memory cache to avoid recomputing heavy stats when multiple
-# endpoints are requested in parallel. TTL is short to keep data fresh.
-_stats_cache = {
-    'ts': 0,
-    'data': None
-}
+from isa.main.yearly_stats import get_yearly_stats, year_stats
+from isa.models import Campaign, ContributionRollup
+from isa.utils import cache
+
+# Cache the stats to avoid recomputing them when multiple endpoints are
+# requested in parallel. TTL is short to keep data fresh, and can be
+# overridden with GLOBAL_STATS_CACHE_TTL in the config.
 _STATS_CACHE_TTL = 30  # seconds
+# The homepage stats are cached the same way.
+_HOMEPAGE_STATS_CACHE_TTL = 60  # seconds
 
 
 def _get_homepage_stats():
-    """Return small set of homepage stats with lightweight queries."""
+    """
+    Return small set of homepage stats, cached for a short TTL.
+
+    The TTL can be overridden with HOMEPAGE_STATS_CACHE_TTL in the
+    config.
+    """
+    return cache.get_or_refresh('homepage_stats', _compute_homepage_stats,
+                                app.config.get('HOMEPAGE_STATS_CACHE_TTL', _HOMEPAGE_STATS_CACHE_TTL))
+
+
+def _compute_homepage_stats():
+    """
+    Compute the homepage stats with lightweight queries.
+
+    The contributions are counted with the campaign counters and the
+    languages with the contribution rollup, rather than by reading all
+    contributions.
+    """
     today = date.today()
     active_campaigns = db.session.query(func.count(Campaign.id)).filter(
         Campaign.start_date <= today,
         or_(Campaign.end_date == None, Campaign.end_date >= today)
     ).scalar() or 0
 
-    contributions_count = db.session.query(func.count(Contribution.id)).scalar() or 0
+    contributions_count = db.session.query(
+        func.sum(func.coalesce(Campaign.campaign_contributions, 0))
+    ).scalar() or 0
 
     languages_count = db.session.query(
-        func.count(func.distinct(Contribution.caption_language))
+        func.count(func.distinct(ContributionRollup.caption_language))
     ).filter(
-        Contribution.caption_language.isnot(None),
-        Contribution.caption_language != ''
+        ContributionRollup.caption_language != ''
     ).scalar() or 0
 
     return {
         "active_campaigns": active_campaigns,
-        "contributions_count": contributions_count,
+        "contributions_count": int(contributions_count),
         "languages_count": languages_count,
     }
 
 
 def _compute_stats_cached():
-    """Compute stats and cache result for a short TTL."""
-    now = time.time()
-    if _stats_cache['data'] and (now - _stats_cache['ts'] < _STATS_CACHE_TTL):
-        return _stats_cache['data']
+    """
+    Return stats cached for a short TTL.
+
+    The cache is shared by the workers when it uses Redis or files. Only
+    one worker computes the stats at a time, and the others get the
+    previous stats until it's done.
+    """
+    return cache.get_or_refresh('global_stats', _compute_stats,
+                                app.config.get('GLOBAL_STATS_CACHE_TTL', _STATS_CACHE_TTL))
 
-    # Build stats (extracted from previous implementation)
+
+def _compute_stats():
+    """Compute stats for all contributions, per year."""
     try:
-        min_max_years = db.session.query(
-            func.min(extract('year', Contribution.date)),
-            func.max(extract('year', Contribution.date))
-        ).one()
+        stats_per_year = get_yearly_stats()
+        years_with_contributions = [year for year, s in stats_per_year.items() if s["num_contributions"] > 0]
 
-        if not min_max_years[0]:
+        if not years_with_contributions:
             # No contributions found — return a structured empty response so
             # frontend can display a friendly empty-state instead of empty charts.
             empty_stats = {
@@ -70,66 +91,15 @@ def _compute_stats_cached():
                 "averages": {"years": [], "average": [], "median": []},
                 "detailed_stats": {}
             }
-            _stats_cache['data'] = empty_stats
-            _stats_cache['ts'] = now
             return empty_stats
 
-        start_year = int(min_max_years[0])
-        end_year = int(min_max_years[1])
+        start_year = min(years_with_contributions)
+        end_year = max(years_with_contributions)
         all_years = list(range(start_year, end_year + 1))
 
-        yearly_stats = {}
-
-        for year in all_years:
-            contributions_this_year = db.session.query(Contribution).filter(
-                extract('year', Contribution.date) == year
-            )
-            total_contributions = contributions_this_year.count()
-
-            if total_contributions == 0:
-                yearly_stats[year] = {
-                    "num_contributions": 0, "num_contributors": 0,
-                    "max_contributions": 0, "min_contributions": 0,
-                    "avg_contributions": 0, "median_contributions": 0,
-                    "top_5_share": 0, "top_10_share": 0, "top_20_share": 0,
-                }
-                continue
-
-            num_contributors = db.session.query(func.count(func.distinct(Contribution.user_id))).filter(
-                extract('year', Contribution.date) == year
-            ).scalar()
-
-            contribs_per_user_query = db.session.query(
-                func.count(Contribution.id).label('contrib_count')
-            ).filter(
-                extract('year', Contribution.date) == year
-            ).group_by(
-                Contribution.user_id
-            ).subquery()
-
-            contribs_per_user = [c.contrib_count for c in db.session.query(contribs_per_user_query).all()]
-            contribs_per_user.sort(reverse=True)
-
-            total_users = len(contribs_per_user)
-            idx_5_percent = max(1, round(total_users * 0.05))
-            idx_10_percent = max(1, round(total_users * 0.10))
-            idx_20_percent = max(1, round(total_users * 0.20))
-
-            contribs_top_5 = sum(contribs_per_user[:idx_5_percent])
-            contribs_top_10 = sum(contribs_per_user[:idx_10_percent])
-            contribs_top_20 = sum(contribs_per_user[:idx_20_percent])
-
-            yearly_stats[year] = {
-                "num_contributions": total_contributions,
-                "num_contributors": num_contributors,
-                "max_contributions": contribs_per_user[0] if contribs_per_user else 0,
-                "min_contributions": contribs_per_user[-1] if contribs_per_user else 0,
-                "avg_contributions": round(statistics.mean(contribs_per_user)) if contribs_per_user else 0,
-                "median_contributions": round(statistics.median(contribs_per_user)) if contribs_per_user else 0,
-                "top_5_share": round((contribs_top_5 / total_contributions) * 100) if total_contributions > 0 else 0,
-                "top_10_share": round((contribs_top_10 / total_contributions) * 100) if total_contributions > 0 else 0,
-                "top_20_share": round((contribs_top_20 / total_contributions) * 100) if total_contributions > 0 else 0,
-            }
+        yearly_stats = {
+            year: stats_per_year.get(year) or year_stats() for year in all_years
+        }
 
         growth_trends = {
             "years": [str(y) for y in all_years],
@@ -164,11 +134,20 @@ def _compute_stats_cached():
 
             yoy_years.append(str(year))
 
-        distribution = {str(y): {"top_5_share": s.get('top_5_share'), "top_10_share": s.get('top_10_share'), "top_20_share": s.get('top_20_share')} for y, s in yearly_stats.items()}
+        distribution = {
+            str(y): {
+                "top_5_share": s.get('top_5_share'),
+                "top_10_share": s.get('top_10_share'),
+                "top_20_share": s.get('top_20_share'),
+                "gini": s.get('gini'),
+                "histogram": s.get('histogram', [])
+            } for y, s in yearly_stats.items()
+        }
         averages = {
             "years": [str(y) for y in all_years],
             "average": [yearly_stats.get(y, {}).get("avg_contributions", 0) for y in all_years],
-            "median": [yearly_stats.get(y, {}).get("median_contributions", 0) for y in all_years]
+            "median": [yearly_stats.get(y, {}).get("median_contributions", 0) for y in all_years],
+            "p90": [yearly_stats.get(y, {}).get("p90_contributions", 0) for y in all_years]
         }
 
         final_response = {
@@ -186,8 +165,6 @@ def _compute_stats_cached():
         # Mark that we have data so frontend can distinguish empty responses.
         final_response["has_data"] = True
 
-        _stats_cache['data'] = final_response
-        _stats_cache['ts'] = now
         return final_response
     except Exception as e:
         print(f"Error building stats: {e}")
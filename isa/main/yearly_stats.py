@@ -0,0 +1,162 @@
+"""Contribution stats per year, for all campaigns
+
+Stats for years that have ended don't change, so they are kept in the
+yearly_stats table. It is written by a periodic Celery task. Only the
+current year, and ended years that aren't in the table yet, are computed
+from the contributions when the stats are requested.
+
+"""
+
+from collections import Counter
+from datetime import date
+import json
+import logging
+
+from celery import shared_task
+from sqlalchemy import extract, func
+
+from isa import db
+from isa.models import Contribution, YearlyStats
+from isa.utils.distribution import Distribution
+
+
+def contribution_histograms_by_year(start_date=None, end_date=None):
+    """
+    Get the distribution of contributions over users for each year
+
+    The contributions are counted per user and the users are counted per
+    number of contributions in the database, so only the histogram of
+    each year is read.
+
+    The dates are compared to the date column itself, so that the index
+    on it can be used.
+
+    Keyword arguments:
+    start_date -- Only count contributions made on or after this date.
+      Defaults to None.
+    end_date -- Only count contributions made before this date. Defaults
+      to None.
+
+    Returns:
+    Dict with a (Distribution, number of contributors) tuple for each
+    year. Contributions without a user count as one user in the
+    distribution, but not as a contributor.
+    """
+    year = extract('year', Contribution.date)
+    per_user = (db.session.query(year.label('year'),
+                                 Contribution.user_id.label('user_id'),
+                                 func.count(Contribution.id).label('contributions'))
+                .group_by(year, Contribution.user_id))
+    if start_date is not None:
+        per_user = per_user.filter(Contribution.date >= start_date)
+    if end_date is not None:
+        per_user = per_user.filter(Contribution.date < end_date)
+    per_user = per_user.subquery()
+    query = (db.session.query(per_user.c.year,
+                              per_user.c.contributions,
+                              func.count(),
+                              func.count(per_user.c.user_id))
+             .group_by(per_user.c.year, per_user.c.contributions))
+
+    histograms = {}
+    contributors = Counter()
+    for row_year, contributions, users, year_contributors in query:
+        histograms.setdefault(int(row_year), {})[contributions] = users
+        contributors[int(row_year)] += year_contributors
+    return {
+        row_year: (Distribution(histogram), contributors[row_year])
+        for row_year, histogram in histograms.items()
+    }
+
+
+def year_stats(distribution=None, num_contributors=0):
+    """
+    Compute the stats for one year
+
+    Keyword arguments:
+    distribution -- Distribution of the year's contributions over users.
+      Defaults to None, for a year without contributions.
+    num_contributors -- Number of users that contributed in the year.
+      Defaults to 0.
+
+    Returns:
+    Dict with the number of contributions and contributors, the min,
+    max, average, median and 90th percentile of the contributions per
+    user, the share of the contributions made by the top 5, 10 and 20%
+    of the users, the Gini coefficient and the histogram of the
+    contributions per user.
+    """
+    distribution = distribution or Distribution()
+    return {
+        "num_contributions": distribution.total,
+        "num_contributors": num_contributors,
+        "max_contributions": distribution.max(),
+        "min_contributions": distribution.min(),
+        "avg_contributions": round(distribution.mean()),
+        "median_contributions": round(distribution.median()),
+        "p90_contributions": round(distribution.quantile(0.9)),
+        "top_5_share": round(distribution.top_share(0.05) * 100),
+        "top_10_share": round(distribution.top_share(0.10) * 100),
+        "top_20_share": round(distribution.top_share(0.20) * 100),
+        "gini": round(distribution.gini(), 3),
+        "histogram": distribution.histogram(),
+    }
+
+
+def write_snapshot(today=None):
+    """
+    Write the stats for all years that have ended to the snapshot
+
+    Every ended year from the first one with contributions is written,
+    including years without contributions. Does not commit.
+
+    Keyword arguments:
+    today -- The current date. Defaults to today.
+
+    Returns:
+    The number of years written.
+    """
+    current_year = (today or date.today()).year
+    histograms = contribution_histograms_by_year(end_date=date(current_year, 1, 1))
+    YearlyStats.query.delete(synchronize_session=False)
+    if not histograms:
+        return 0
+
+    years = range(min(histograms), current_year)
+    db.session.add_all([
+        YearlyStats(year=year, stats=json.dumps(year_stats(*histograms.get(year, ()))))
+        for year in years
+    ])
+    return len(years)
+
+
+@shared_task
+def write_snapshot_task():
+    """
+    Write the snapshot of the yearly stats
+
+    Run periodically by Celery beat. All ended years are written again,
+    to include contributions that were changed since the last run.
+    """
+    years = write_snapshot()
+    db.session.commit()
+    logging.info("Wrote yearly stats for {} years.".format(years))
+    return years
+
+
+def get_yearly_stats():
+    """
+    Get the stats for each year
+
+    The stats of the years in the snapshot are read from it. The stats of
+    later years are computed from the contributions.
+
+    Returns:
+    Dict with the stats for each year, as returned by year_stats().
+    Years before the first contribution aren't included.
+    """
+    yearly_stats = {row.year: json.loads(row.stats) for row in YearlyStats.query}
+    start_date = date(max(yearly_stats) + 1, 1, 1) if yearly_stats else None
+    for year, (distribution, num_contributors) in contribution_histograms_by_year(start_date=start_date).items():
+        yearly_stats[year] = year_stats(distribution, num_contributors)
+    return yearly_stats
@@ -0,0 +1,35 @@
+"""Rebuilds the contribution rollup and counters used for campaign stats
+
+The rollup and the campaign counters are updated when contributions are
+recorded. Run this to fill them for contributions that were added in
+another way, or if they have diverged from the contributions.
+
+"""
+
+import argparse
+
+from isa import db
+from isa.campaigns import stats
+from isa.models import Campaign
+from isa.utils import cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--campaign-ids",
+        "-i",
+        type=int,
+        nargs="*",
+        help="Rebuild only for the campaigns with these ids.",
+        metavar="ID"
+    )
+    args = parser.parse_args()
+
+    rows = stats.rebuild_rollup(args.campaign_ids or None)
+    corrected = stats.reconcile_campaign_counters(args.campaign_ids or None)
+    db.session.commit()
+    for campaign_id in args.campaign_ids or [campaign.id for campaign in Campaign.query]:
+        cache.invalidate_campaign(campaign_id)
+    print("Rollup rebuilt with {} rows.".format(rows))
+    print("Counters corrected for {} campaigns.".format(corrected))
@@ -37,6 +37,20 @@ if __name__ == "__main__":
         help="Do not update campaigns with these ids.",
         metavar="ID"
     )
+    parser.add_argument(
+        "--incremental",
+        "-n",
+        action="store_true",
+        help=(
+            "Only add new images and remove images that are no longer "
+            "in the categories, instead of replacing all images."
+        )
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Start from the beginning even if a previous update failed."
+    )
     args = parser.parse_args()
 
     query = Campaign.query
@@ -49,4 +63,16 @@ if __name__ == "__main__":
     campaigns = query.all()
 
     for campaign in campaigns:
-        image_updater.update(campaign.id)
+        try:
+            result = image_updater.update(campaign.id, args.incremental, not args.no_resume)
+        except image_updater.UpdateInProgressException:
+            print("Campaign {}: already being updated.".format(campaign.id))
+            continue
+        if result is None:
+            print("Campaign {}: update failed.".format(campaign.id))
+        else:
+            print("Campaign {}: {} images added, {} removed.".format(
+                campaign.id,
+                result["added"],
+                result["removed"]
+            ))
@@ -29,6 +29,16 @@ class User(db.Model, UserMixin):
 
 
 class Contribution(db.Model):
+    __table_args__ = (
+        # Campaign exports, counter reconciliation and top depicts.
+        db.Index('ix_contribution_campaign_id_user_id', 'campaign_id', 'user_id'),
+        db.Index('ix_contribution_campaign_id_edit_type', 'campaign_id', 'edit_type'),
+        # User contributions, usually within a date range.
+        db.Index('ix_contribution_user_id_date', 'user_id', 'date'),
+        # Yearly stats for all campaigns.
+        db.Index('ix_contribution_date', 'date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -59,6 +69,57 @@ class Contribution(db.Model):
         return self[index]
 
 
+class ContributionRollup(db.Model):
+    """Number of contributions per campaign, day, user, country, caption
+    language and edit type
+
+    Kept up to date when contributions are recorded, so that campaign
+    stats don't need to aggregate all the campaign's contributions.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('campaign_id', 'date', 'user_id', 'country', 'caption_language', 'edit_type',
+                            name='uq_contribution_rollup_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    country = db.Column(db.String(50), nullable=False, default='')
+    caption_language = db.Column(db.String(5), nullable=False, default='')
+    edit_type = db.Column(db.String(10), nullable=False)
+    contributions = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        # This is what is shown when object is printed
+        return "ContributionRollup({}, {}, {}, {}, {}, {}, {})".format(
+               self.campaign_id,
+               self.date,
+               self.user_id,
+               self.country,
+               self.caption_language,
+               self.edit_type,
+               self.contributions)
+
+
+class YearlyStats(db.Model):
+    """Stats for all contributions made in a year that has ended
+
+    Written by a periodic task, so that the global stats don't need to
+    aggregate the contributions of past years.
+    """
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # The stats as JSON
+    stats = db.Column(db.Text, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        # This is what is shown when object is printed
+        return "YearlyStats({}, {})".format(
+               self.year,
+               self.updated)
+
+
 class Campaign(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     campaign_name = db.Column(db.String(200), nullable=False)
@@ -101,6 +162,11 @@ class Campaign(db.Model):
 
 
 class Image(db.Model):
+    __table_args__ = (
+        # Images for a campaign, optionally in a country, ordered by page.
+        db.Index('ix_image_campaign_id_country_id_page_id', 'campaign_id', 'country_id', 'page_id'),
+    )
+
     id = db.Column(db.Integer, nullable=False, primary_key=True)
     page_id = db.Column(db.Integer, nullable=False)
     campaign_id = db.Column(
@@ -131,6 +197,12 @@ class Country(db.Model):
 
 
 class Suggestion(db.Model, UserMixin):
+    __table_args__ = (
+        # Rejected suggestions for a file, by user or by depicted item.
+        db.Index('ix_suggestion_user_id_file_name_update_status', 'user_id', 'file_name', 'update_status'),
+        db.Index('ix_suggestion_file_name_depict_item_update_status', 'file_name', 'depict_item', 'update_status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, index=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
     file_name = db.Column(db.String(240), nullable=False)
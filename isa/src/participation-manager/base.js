@@ -8,6 +8,9 @@
 
 import {flashMessage, getUrlParameters, getHtmlStripped} from '../utils';
 
+// Milliseconds between requests for the status of a contribution job
+var CONTRIBUTION_POLL_INTERVAL = 1000;
+
 export function ParticipationManager(images, campaignId, wikiLovesCountry, isUserLoggedIn) {
     var imageIndex = 0,
         initialData = {depicts: [], captions: []},
@@ -252,6 +255,13 @@ export function ParticipationManager(images, campaignId, wikiLovesCountry, isUse
             headers: {
                 "X-CSRFToken": csrf_token,
             },
+        }).then(function(response) {
+            // When contributions are made in the background the server
+            // sends a job id, which we poll until the edits are done
+            if (response && response.job_id) {
+                return waitForContributionJob(response.job_id);
+            }
+            return response;
         }).done(function(response) {
             // Contribution accepted by server, now we can update initial data
             // Button states will return to disabled
@@ -274,6 +284,37 @@ export function ParticipationManager(images, campaignId, wikiLovesCountry, isUse
         })
     }
 
+    // Poll the status of a contribution job until all edits are made.
+    // Resolves with the revision id of the last edit and is rejected if
+    // any edit failed.
+    function waitForContributionJob(jobId) {
+        var deferred = $.Deferred();
+        function poll() {
+            $.get({
+                url: '../../api/post-contribution/' + jobId
+            }).done(function(status) {
+                if (status.state === 'SUCCESS') {
+                    var failed = status.edits.some(function(edit) {
+                        return edit.status !== 'done';
+                    });
+                    if (failed) {
+                        deferred.reject(status);
+                    } else {
+                        deferred.resolve(status.revision_id);
+                    }
+                } else if (status.state === 'FAILURE') {
+                    deferred.reject(status);
+                } else {
+                    setTimeout(poll, CONTRIBUTION_POLL_INTERVAL);
+                }
+            }).fail(function(error) {
+                deferred.reject(error);
+            });
+        }
+        poll();
+        return deferred.promise();
+    }
+
     /////////// Image utilities ///////////
 
     function getImageFileInfo () {
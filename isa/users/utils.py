@@ -64,13 +64,25 @@ def get_user_ranking(all_contributors_data, username):
     """
     Get a particular user's ranking
 
+    Users with the same number of images improved share a rank, like
+    RANK() in the campaign leaderboard.
+
     Keyword arguments:
     all_contributors_data -- sorted list of all users by their contributions
     username -- the user who's ranking is to be obtained
-    """
 
-    index = next((i for i, item in enumerate(all_contributors_data) if item['username'] == username), -1)
-    return index + 1  # we shift from 0
+    Returns:
+    The rank, or 0 if the user isn't in the list.
+    """
+    rank = 0
+    previous_value = None
+    for position, item in enumerate(all_contributors_data, start=1):
+        if item['images_improved'] != previous_value:
+            rank = position
+            previous_value = item['images_improved']
+        if item['username'] == username:
+            return rank
+    return 0
 
 
 def get_user_contrbition_per_campaign(username, campaign_id):
@@ -0,0 +1,245 @@
+"""Shared HTTP client for the MediaWiki and Wikidata APIs
+
+All outbound API requests go through one session, so that connections
+to each host are kept alive and reused. Requests get the ISA User-Agent
+and a timeout. Failed requests are retried with exponential backoff and
+jitter, and when the server asks us to wait, through maxlag errors,
+Retry-After or HTTP 429/503, we wait as long as it asks, up to
+BACKOFF_MAX seconds.
+
+Requests made while a user waits for the response should pass
+retries=INTERACTIVE_RETRIES and max_wait=INTERACTIVE_MAX_WAIT, so that a
+web worker isn't held up for long. Only background tasks should use the
+defaults.
+
+"""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from isa import app
+
+
+USER_AGENT = 'ISA/1.0 (contact: https://www.mediawiki.org/wiki/User:IsaBot)'
+# Wait this long (in seconds) for the server before giving up.
+DEFAULT_TIMEOUT = 10
+# Retry a request at most this many times.
+MAX_RETRIES = 5
+# Retry requests made while a user waits at most this many times.
+INTERACTIVE_RETRIES = 1
+# Don't retry requests made while a user waits when the server asks us
+# to wait longer than this many seconds.
+INTERACTIVE_MAX_WAIT = 10
+# Wait about this long (in seconds) before the first retry. The wait is
+# doubled for each retry, up to BACKOFF_MAX.
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Keep at most this many connections open per host. Can be overridden
+# with HTTP_POOL_SIZE in the config.
+DEFAULT_POOL_SIZE = 10
+# HTTP statuses that mean that the server wants us to try again later.
+RETRY_STATUSES = (429, 503)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Get the session shared by all API requests
+
+    Returns:
+    A requests.Session with connection pools for each host.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = app.config.get("HTTP_POOL_SIZE", DEFAULT_POOL_SIZE)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+            _session = session
+        return _session
+
+
+def get(url, params=None, auth=None, timeout=DEFAULT_TIMEOUT, retries=MAX_RETRIES, maxlag=None, max_wait=None):
+    """
+    Send a GET request
+
+    Timeouts and connection errors are retried.
+
+    Keyword arguments:
+    url -- URL to send the request to.
+    params -- Query parameters. Defaults to None.
+    auth -- Authentication for the request, e.g. OAuth1. Defaults to
+      None.
+    timeout -- Seconds to wait for the server. Defaults to
+      DEFAULT_TIMEOUT.
+    retries -- The maximum number of retries. Defaults to MAX_RETRIES.
+    maxlag -- If set, add the MediaWiki maxlag parameter with this
+      value, so that the request is refused while the database replicas
+      lag more than this many seconds. Use for requests that are not
+      made on behalf of a waiting user. Defaults to None.
+    max_wait -- If set, return the response instead of retrying when the
+      server asks us to wait longer than this many seconds. Defaults to
+      None.
+
+    Returns:
+    The response.
+
+    Exceptions:
+    requests.RequestException -- When the request fails after all
+      retries.
+    """
+    params = dict(params or {})
+    if maxlag is not None:
+        params["maxlag"] = maxlag
+    return _request(
+        "GET",
+        url,
+        retry_on_error=True,
+        retries=retries,
+        max_wait=max_wait,
+        params=params,
+        auth=auth,
+        timeout=timeout
+    )
+
+
+def post(url, data=None, auth=None, timeout=DEFAULT_TIMEOUT, retries=MAX_RETRIES, max_wait=None):
+    """
+    Send a POST request
+
+    Only retried when the server asks for it. Timeouts and connection
+    errors are not retried, since the request may have been carried out.
+
+    Keyword arguments:
+    url -- URL to send the request to.
+    data -- Form data. Defaults to None.
+    auth -- Authentication for the request, e.g. OAuth1. Defaults to
+      None.
+    timeout -- Seconds to wait for the server. Defaults to
+      DEFAULT_TIMEOUT.
+    retries -- The maximum number of retries. Defaults to MAX_RETRIES.
+    max_wait -- If set, return the response instead of retrying when the
+      server asks us to wait longer than this many seconds. Defaults to
+      None.
+
+    Returns:
+    The response.
+
+    Exceptions:
+    requests.RequestException -- When the request fails.
+    """
+    return _request(
+        "POST",
+        url,
+        retry_on_error=False,
+        retries=retries,
+        max_wait=max_wait,
+        data=data,
+        auth=auth,
+        timeout=timeout
+    )
+
+
+def _request(method, url, retry_on_error, retries, max_wait=None, **kwargs):
+    """
+    Send a request, retrying when needed
+
+    Keyword arguments:
+    method -- HTTP method.
+    url -- URL to send the request to.
+    retry_on_error -- If True, retry on timeouts and connection errors.
+    retries -- The maximum number of retries.
+    max_wait -- If set, don't retry when the server asks us to wait
+      longer than this many seconds. Defaults to None.
+    kwargs -- Passed on to requests.Session.request().
+
+    Returns:
+    The response.
+    """
+    session = get_session()
+    attempt = 0
+    while True:
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not retry_on_error or attempt >= retries:
+                raise
+
+            delay = _backoff(attempt)
+            logging.debug("{} request to {} failed ({}), retrying in {:.1f} seconds.".format(
+                method, url, e, delay
+            ))
+        else:
+            delay = _requested_delay(response)
+            if delay is None or attempt >= retries:
+                return response
+            if max_wait is not None and delay > max_wait:
+                logging.warning("Server asked to retry {} request to {} in {:.1f} seconds, not retrying.".format(
+                    method, url, delay
+                ))
+                return response
+
+            delay = min(max(delay, _backoff(attempt)), BACKOFF_MAX)
+            logging.debug("Server asked to retry {} request to {} in {:.1f} seconds.".format(
+                method, url, delay
+            ))
+        attempt += 1
+        time.sleep(delay)
+
+
+def _requested_delay(response):
+    """
+    Get how long the server wants us to wait before retrying
+
+    Keyword arguments:
+    response -- Response from the server.
+
+    Returns:
+    The delay in seconds, 0 if the server wants a retry without saying
+    when, or None if the request shouldn't be retried.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None and response.status_code not in RETRY_STATUSES:
+        return None
+
+    if retry_after is not None and response.status_code == 200:
+        # MediaWiki sends Retry-After with maxlag errors, which have
+        # status 200. Make sure that's what this is.
+        try:
+            error = response.json().get("error", {})
+        except ValueError:
+            return None
+        if error.get("code") != "maxlag":
+            return None
+
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _backoff(attempt):
+    """
+    Get the delay before a retry
+
+    Doubles for each attempt, with random jitter so that clients that
+    failed at the same time don't retry at the same time.
+
+    Keyword arguments:
+    attempt -- The number of retries so far.
+
+    Returns:
+    The delay in seconds.
+    """
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
@@ -0,0 +1,455 @@
+"""Cache for statistics responses
+
+Entries are kept in Redis, so that all workers share them, when
+CACHE_REDIS_URL is set in the config or when Celery uses a Redis broker.
+Otherwise they are kept in memory, for each process. The backend can
+also be chosen with CACHE_BACKEND: "memory", "redis" or "file". The
+file backend keeps entries in CACHE_DIRECTORY, shared by the workers on
+one host.
+
+Entries for a campaign include the campaign's generation in their key.
+The generation is increased when contributions are recorded, which makes
+all the campaign's entries invalid at once. Entries also expire after a
+while, so that they don't stay in the cache forever.
+
+Values that are expensive to compute can be cached with
+get_or_refresh(), which lets only one worker compute a value at a time
+and serves the previous value to the others meanwhile.
+
+"""
+
+from collections import Counter, OrderedDict
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import redis
+
+from isa import app
+
+KEY_PREFIX = 'isa:cache:'
+# Keep entries for at most this many seconds. Can be overridden with
+# STATS_CACHE_TTL in the config.
+DEFAULT_TTL = 300
+# Keep at most this many entries in the memory backend.
+MEMORY_MAX_ENTRIES = 1024
+# Wait this long (in seconds) for Redis before computing without the
+# cache.
+REDIS_TIMEOUT = 1
+# Default directory for the file backend, relative to the working
+# directory. Can be overridden with CACHE_DIRECTORY in the config.
+DEFAULT_DIRECTORY = 'cache'
+# Keep values from get_or_refresh() this many seconds after they expire,
+# to serve them while they are being computed again.
+STALE_TTL = 3600
+# Let one worker compute a value for at most this many seconds before
+# others compute it too.
+REFRESH_TIMEOUT = 60
+# Check this often (in seconds) whether another worker has computed a
+# value.
+REFRESH_POLL_INTERVAL = 0.1
+# Remove expired entries from the file backend's directory at most this
+# often (in seconds), for each process.
+FILE_PRUNE_INTERVAL = 300
+
+_backend = None
+_backend_lock = threading.Lock()
+# Hits and misses with the file backend, which are counted in each
+# process instead of in a locked file
+_local_counters = Counter()
+_local_counters_lock = threading.Lock()
+
+
+class MemoryBackend:
+    """
+    Keeps entries in a dict, removing the least recently used first
+
+    Counters, like the generations, are kept separately and never
+    removed.
+    """
+
+    def __init__(self, max_entries=MEMORY_MAX_ENTRIES):
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def _set(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+class RedisBackend:
+    """Keeps entries in Redis"""
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url, socket_timeout=REDIS_TIMEOUT,
+                                            socket_connect_timeout=REDIS_TIMEOUT)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=ttl or None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._client.set(key, value, ex=ttl or None, nx=True))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+
+class FileBackend:
+    """
+    Keeps entries in files, one for each key
+
+    Files are replaced atomically and counters are updated under a file
+    lock, so the backend can be shared by processes on the same host.
+    Expired entries are removed when they are read, and every
+    FILE_PRUNE_INTERVAL seconds when entries are written.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._next_prune = time.monotonic() + FILE_PRUNE_INTERVAL
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='UTF-8') as entry_file:
+                value, expires = json.load(entry_file)
+                inode = os.fstat(entry_file.fileno()).st_ino
+        except (FileNotFoundError, ValueError):
+            return None
+        if expires is not None and expires <= time.time():
+            self._remove_expired(path, inode)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        with tempfile.NamedTemporaryFile('w', encoding='UTF-8', dir=self._directory,
+                                         suffix='.tmp', delete=False) as entry_file:
+            json.dump(self._entry(value, ttl), entry_file)
+        os.replace(entry_file.name, self._path(key))
+        if time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + FILE_PRUNE_INTERVAL
+            self.prune()
+
+    def add(self, key, value, ttl=None):
+        path = self._path(key)
+        for _ in range(2):
+            try:
+                with open(path, 'x', encoding='UTF-8') as entry_file:
+                    json.dump(self._entry(value, ttl), entry_file)
+                return True
+            except FileExistsError:
+                if self.get(key) is not None:
+                    return False
+                # The existing entry has expired
+                self.delete(key)
+        return False
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def incr(self, key):
+        with open(self._path(key) + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            value = int(self.get(key) or 0) + 1
+            self.set(key, value)
+        return value
+
+    def prune(self):
+        """
+        Remove expired entries
+
+        Returns:
+        The number of entries removed.
+        """
+        removed = 0
+        now = time.time()
+        for file_name in os.listdir(self._directory):
+            path = os.path.join(self._directory, file_name)
+            if file_name.endswith('.tmp'):
+                # Left behind by a process that stopped while writing
+                try:
+                    if os.path.getmtime(path) < now - STALE_TTL:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if file_name.endswith('.lock'):
+                continue
+            try:
+                with open(path, encoding='UTF-8') as entry_file:
+                    _, expires = json.load(entry_file)
+                    inode = os.fstat(entry_file.fileno()).st_ino
+            except (FileNotFoundError, ValueError):
+                continue
+            if expires is not None and expires <= now and self._remove_expired(path, inode):
+                removed += 1
+        return removed
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha1(key.encode('UTF-8')).hexdigest())
+
+    @staticmethod
+    def _remove_expired(path, inode):
+        """
+        Remove an expired entry's file, unless it has been replaced since
+        it was read
+        """
+        try:
+            if os.stat(path).st_ino != inode:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    @staticmethod
+    def _entry(value, ttl):
+        return [value, time.time() + ttl if ttl else None]
+
+
+def get_backend():
+    """
+    Get the backend that the cache uses
+
+    Returns:
+    The backend set with CACHE_BACKEND in the config. If it isn't set, a
+    RedisBackend if a Redis URL is configured, otherwise a
+    MemoryBackend.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            url = app.config.get('CACHE_REDIS_URL')
+            if url is None:
+                broker_url = app.config.get('CELERY', {}).get('broker_url', '')
+                if broker_url.startswith(('redis://', 'rediss://')):
+                    url = broker_url
+            backend = app.config.get('CACHE_BACKEND', 'redis' if url else 'memory')
+            if backend == 'redis':
+                _backend = RedisBackend(url or 'redis://localhost')
+            elif backend == 'file':
+                _backend = FileBackend(app.config.get('CACHE_DIRECTORY', DEFAULT_DIRECTORY))
+            else:
+                _backend = MemoryBackend()
+        return _backend
+
+
+def get_generation(campaign_id):
+    """
+    Get the current generation of a campaign's entries
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+    """
+    return int(get_backend().get(_generation_key(campaign_id)) or 0)
+
+
+def invalidate_campaign(campaign_id):
+    """
+    Make all cached entries for a campaign invalid
+
+    Errors from the backend are logged, not raised, so that recording
+    contributions doesn't fail when the cache is unavailable.
+
+    Keyword arguments:
+    campaign_id -- Id of the campaign.
+    """
+    try:
+        get_backend().incr(_generation_key(campaign_id))
+    except redis.RedisError:
+        logging.exception("Could not invalidate the cache for campaign {}.".format(campaign_id))
+
+
+def get_or_compute(name, campaign_id, params, compute):
+    """
+    Get a cached value, or compute and cache it
+
+    If the backend is unavailable, the value is computed without the
+    cache.
+
+    Keyword arguments:
+    name -- Name for the kind of value, e.g. the endpoint.
+    campaign_id -- Id of the campaign that the value is for.
+    params -- Dict with the parameters that the value depends on.
+    compute -- Function that computes the value. The value must be
+      serializable as JSON.
+
+    Returns:
+    The value.
+    """
+    backend = get_backend()
+    try:
+        key = '{}{}:{}:{}:{}'.format(KEY_PREFIX, name, campaign_id, get_generation(campaign_id),
+                                     json.dumps(params, sort_keys=True, default=str))
+        cached = backend.get(key)
+    except redis.RedisError:
+        logging.exception("Could not read from the cache.")
+        return compute()
+
+    if cached is not None:
+        _count('hits')
+        return json.loads(cached)
+
+    _count('misses')
+    value = compute()
+    try:
+        backend.set(key, json.dumps(value), app.config.get('STATS_CACHE_TTL', DEFAULT_TTL))
+    except redis.RedisError:
+        logging.exception("Could not write to the cache.")
+    return value
+
+
+def get_or_refresh(name, compute, ttl):
+    """
+    Get a cached value, or compute and cache it with one worker at a time
+
+    While a worker computes the value, the others get the expired value
+    if there is one. If there isn't, they wait for the worker to finish,
+    at most REFRESH_TIMEOUT seconds. If the backend is unavailable, the
+    value is computed without the cache.
+
+    Keyword arguments:
+    name -- Name of the value.
+    compute -- Function that computes the value. The value must be
+      serializable as JSON. If it returns None, nothing is cached.
+    ttl -- Seconds that the value is fresh.
+
+    Returns:
+    The value.
+    """
+    backend = get_backend()
+    key = KEY_PREFIX + name
+    lock_key = key + ':lock'
+    try:
+        entry = _load_entry(backend.get(key))
+        if entry is not None and entry['expires'] > time.time():
+            _count('hits')
+            return entry['value']
+
+        _count('misses')
+        deadline = time.monotonic() + REFRESH_TIMEOUT
+        while not backend.add(lock_key, '1', REFRESH_TIMEOUT):
+            if entry is not None:
+                # Another worker is computing the value
+                return entry['value']
+            if time.monotonic() >= deadline:
+                return compute()
+            time.sleep(REFRESH_POLL_INTERVAL)
+            entry = _load_entry(backend.get(key))
+            if entry is not None:
+                return entry['value']
+    except redis.RedisError:
+        logging.exception("Could not read from the cache.")
+        return compute()
+
+    try:
+        # The value may have been computed since it was read
+        entry = _load_entry(backend.get(key))
+        if entry is not None and entry['expires'] > time.time():
+            return entry['value']
+        value = compute()
+        if value is not None:
+            backend.set(key, json.dumps({'value': value, 'expires': time.time() + ttl}), ttl + STALE_TTL)
+        return value
+    except redis.RedisError:
+        logging.exception("Could not use the cache.")
+        return compute()
+    finally:
+        try:
+            backend.delete(lock_key)
+        except redis.RedisError:
+            pass
+
+
+def get_counters():
+    """
+    Get the number of cache hits and misses
+
+    With the file backend, only the hits and misses of this process are
+    counted.
+
+    Returns:
+    A dict with "hits" and "misses".
+    """
+    backend = get_backend()
+    if isinstance(backend, FileBackend):
+        with _local_counters_lock:
+            return {counter: _local_counters[counter] for counter in ('hits', 'misses')}
+    return {counter: int(backend.get(KEY_PREFIX + counter) or 0) for counter in ('hits', 'misses')}
+
+
+def _count(counter):
+    backend = get_backend()
+    if isinstance(backend, FileBackend):
+        # Updating a file under a lock for every read would cost more than
+        # the read itself
+        with _local_counters_lock:
+            _local_counters[counter] += 1
+        return
+    try:
+        backend.incr(KEY_PREFIX + counter)
+    except redis.RedisError:
+        pass
+
+
+def _load_entry(cached):
+    return json.loads(cached) if cached is not None else None
+
+
+def _generation_key(campaign_id):
+    return '{}generation:{}'.format(KEY_PREFIX, campaign_id)
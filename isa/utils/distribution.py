@@ -0,0 +1,164 @@
+"""Distribution of contributions over users
+
+A distribution is kept as a histogram: the number of users for each
+number of contributions. There are far fewer distinct numbers of
+contributions than users, so quantiles, top shares and the Gini
+coefficient are computed from the histogram, without a sorted list of
+all the users' contributions.
+
+"""
+
+from bisect import bisect_right
+from collections import Counter
+from itertools import accumulate
+
+
+class Distribution:
+    """Numbers of contributions per user, as a histogram"""
+
+    def __init__(self, histogram=None):
+        """
+        Keyword arguments:
+        histogram -- Mapping from a number of contributions to the number
+          of users with that many contributions. Defaults to None, for an
+          empty distribution.
+        """
+        histogram = histogram or {}
+        self._values = sorted(value for value, users in histogram.items() if value > 0 and users > 0)
+        self._users = [histogram[value] for value in self._values]
+        # Number of users with at most each value
+        self._cumulative_users = list(accumulate(self._users))
+        self.num_users = self._cumulative_users[-1] if self._values else 0
+        self.total = sum(value * users for value, users in zip(self._values, self._users))
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        Make a distribution from the number of contributions of each user
+
+        Keyword arguments:
+        counts -- Iterable with the number of contributions of each user.
+          It's read once.
+        """
+        return cls(Counter(counts))
+
+    def min(self):
+        return self._values[0] if self._values else 0
+
+    def max(self):
+        return self._values[-1] if self._values else 0
+
+    def mean(self):
+        return self.total / self.num_users if self.num_users else 0
+
+    def quantile(self, q):
+        """
+        Get a quantile, interpolating linearly between values
+
+        This is the same as statistics.median() for q=0.5.
+
+        Keyword arguments:
+        q -- The quantile, between 0 and 1.
+
+        Returns:
+        The value, or 0 if the distribution is empty.
+        """
+        if not self.num_users:
+            return 0
+        position = (self.num_users - 1) * q
+        index = int(position)
+        lower = self._value_at(index)
+        if index == position:
+            return lower
+        return lower + (self._value_at(index + 1) - lower) * (position - index)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def top_share(self, fraction):
+        """
+        Get the share of the contributions made by the top users
+
+        Keyword arguments:
+        fraction -- The fraction of the users with the most contributions,
+          e.g. 0.05 for the top 5%. At least one user is counted.
+
+        Returns:
+        The share between 0 and 1, or 0 if the distribution is empty.
+        """
+        if not self.total:
+            return 0
+        remaining = max(1, round(self.num_users * fraction))
+        top_contributions = 0
+        for value, users in zip(reversed(self._values), reversed(self._users)):
+            counted = min(users, remaining)
+            top_contributions += value * counted
+            remaining -= counted
+            if remaining == 0:
+                break
+        return top_contributions / self.total
+
+    def gini(self):
+        """
+        Get the Gini coefficient
+
+        Returns:
+        0 if all users made the same number of contributions, close to 1
+        if one user made almost all of them.
+        """
+        if not self.total:
+            return 0
+        # Sum of rank * value, with the users ranked from the fewest
+        # contributions. The users with the same value have consecutive
+        # ranks.
+        weighted_sum = 0
+        previous_users = 0
+        for value, users, cumulative_users in zip(self._values, self._users, self._cumulative_users):
+            rank_sum = users * previous_users + users * (users + 1) // 2
+            weighted_sum += value * rank_sum
+            previous_users = cumulative_users
+        n = self.num_users
+        return 2 * weighted_sum / (n * self.total) - (n + 1) / n
+
+    def histogram(self):
+        """
+        Count the users in buckets that double in size: 1, 2-3, 4-7 etc.
+
+        Returns:
+        List of dicts with the "min" and "max" contributions of each
+        bucket and its number of "users", up to the last non-empty
+        bucket.
+        """
+        users_per_bucket = Counter()
+        for value, users in zip(self._values, self._users):
+            users_per_bucket[value.bit_length() - 1] += users
+        return [
+            {'min': 2 ** bucket, 'max': 2 ** (bucket + 1) - 1, 'users': users_per_bucket[bucket]}
+            for bucket in range(max(users_per_bucket) + 1 if users_per_bucket else 0)
+        ]
+
+    def describe(self):
+        """
+        Summarize the distribution
+
+        Returns:
+        JSON serializable dict with the number of users, the mean, median
+        and 90th percentile, the share of the contributions made by the
+        top 5, 10 and 20% of the users (as percentages), the Gini
+        coefficient and the histogram.
+        """
+        return {
+            'num_users': self.num_users,
+            'mean': round(self.mean(), 1),
+            'median': round(self.median(), 1),
+            'p90': round(self.quantile(0.9), 1),
+            'top_5_share': round(self.top_share(0.05) * 100),
+            'top_10_share': round(self.top_share(0.10) * 100),
+            'top_20_share': round(self.top_share(0.20) * 100),
+            'gini': round(self.gini(), 3),
+            'histogram': self.histogram()
+        }
+
+    def _value_at(self, index):
+        """Get the value of the user at an index, from the fewest contributions"""
+        return self._values[bisect_right(self._cumulative_users, index)]
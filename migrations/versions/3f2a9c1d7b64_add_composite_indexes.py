@@ -0,0 +1,38 @@
+"""add composite indexes
+
+Revision ID: 3f2a9c1d7b64
+Revises: c8b4669f574b
+Create Date: 2026-10-18 10:12:41.318207
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b64'
+down_revision = 'c8b4669f574b'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_contribution_campaign_id_date', 'contribution', ['campaign_id', 'date']),
+    ('ix_contribution_campaign_id_user_id', 'contribution', ['campaign_id', 'user_id']),
+    ('ix_contribution_campaign_id_edit_type', 'contribution', ['campaign_id', 'edit_type']),
+    ('ix_contribution_campaign_id_caption_language', 'contribution', ['campaign_id', 'caption_language']),
+    ('ix_contribution_user_id_date', 'contribution', ['user_id', 'date']),
+    ('ix_contribution_date', 'contribution', ['date']),
+    ('ix_image_campaign_id_country_id_page_id', 'image', ['campaign_id', 'country_id', 'page_id']),
+    ('ix_suggestion_user_id_file_name_update_status', 'suggestion', ['user_id', 'file_name', 'update_status']),
+    ('ix_suggestion_file_name_depict_item_update_status', 'suggestion', ['file_name', 'depict_item', 'update_status']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
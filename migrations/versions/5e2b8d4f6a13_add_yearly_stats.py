@@ -0,0 +1,31 @@
+"""add yearly stats
+
+Revision ID: 5e2b8d4f6a13
+Revises: 9b1e5d2c4a07
+Create Date: 2026-10-18 15:24:51.208317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2b8d4f6a13'
+down_revision = '9b1e5d2c4a07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The table is filled by the periodic yearly stats task
+    op.create_table(
+        'yearly_stats',
+        sa.Column('year', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('stats', sa.Text(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('year')
+    )
+
+
+def downgrade():
+    op.drop_table('yearly_stats')
@@ -0,0 +1,34 @@
+"""drop unused contribution indexes
+
+Campaign stats are read from the contribution rollup, so contributions
+are no longer filtered by campaign and date or caption language.
+
+Revision ID: 6c3a1f8e2d95
+Revises: 5e2b8d4f6a13
+Create Date: 2026-10-18 17:02:36.514870
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6c3a1f8e2d95'
+down_revision = '5e2b8d4f6a13'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_contribution_campaign_id_date', 'contribution', ['campaign_id', 'date']),
+    ('ix_contribution_campaign_id_caption_language', 'contribution', ['campaign_id', 'caption_language']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.drop_index(name, table_name=table)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.create_index(name, table, columns, unique=False)
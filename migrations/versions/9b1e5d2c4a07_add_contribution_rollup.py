@@ -0,0 +1,48 @@
+"""add contribution rollup
+
+Revision ID: 9b1e5d2c4a07
+Revises: 3f2a9c1d7b64
+Create Date: 2026-10-18 11:02:17.594410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1e5d2c4a07'
+down_revision = '3f2a9c1d7b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'contribution_rollup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('campaign_id', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('country', sa.String(length=50), nullable=False),
+        sa.Column('caption_language', sa.String(length=5), nullable=False),
+        sa.Column('edit_type', sa.String(length=10), nullable=False),
+        sa.Column('contributions', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['campaign_id'], ['campaign.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('campaign_id', 'date', 'user_id', 'country', 'caption_language', 'edit_type',
+                            name='uq_contribution_rollup_key')
+    )
+    # Fill the rollup with the existing contributions
+    op.execute(
+        "INSERT INTO contribution_rollup "
+        "(campaign_id, date, user_id, country, caption_language, edit_type, contributions) "
+        "SELECT campaign_id, date, user_id, COALESCE(country, ''), COALESCE(caption_language, ''), "
+        "edit_type, COUNT(id) "
+        "FROM contribution "
+        "GROUP BY campaign_id, date, user_id, COALESCE(country, ''), COALESCE(caption_language, ''), edit_type"
+    )
+
+
+def downgrade():
+    op.drop_table('contribution_rollup')
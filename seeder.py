@@ -7,7 +7,8 @@ from faker import Faker
 # This assumes your Flask 'app' and 'db' instances are created in a file named 'isa.py'
 # or are available from the 'isa' package.
 from isa import app, db
-from isa.models import User, Campaign, Contribution,Suggestion,Image
+from isa.campaigns import stats
+from isa.models import User, Campaign, Contribution, ContributionRollup, Suggestion, Image, YearlyStats
 
 # --- Configuration ---
 NUM_USERS = 50
@@ -36,6 +37,10 @@ def seed_data():
 
         # --- 1. Clean up existing data ---
         print("Deleting existing data...")
+        # Delete the stats computed from the contributions (the rollup
+        # depends on Campaign and User)
+        ContributionRollup.query.delete()
+        YearlyStats.query.delete()
         Contribution.query.delete()
 
         # Delete images before campaigns (depends on Campaign)
@@ -125,6 +130,15 @@ def seed_data():
         db.session.commit()
         print(f"{len(contributions)} contributions created.")
 
+        # --- 5. Compute the stats ---
+        # bulk_save_objects() bypasses record_contributions(), so the
+        # rollup and the campaign counters are computed afterwards
+        print("Computing campaign stats...")
+        stats.rebuild_rollup()
+        stats.reconcile_campaign_counters()
+        db.session.commit()
+        print("Campaign stats computed.")
+
         print("\nDatabase seeding complete!")
 
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Unit tests for the shared API client
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+import requests
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa.utils import api_client
+
+
+def make_response(status_code=200, headers=None, json_data=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.json.return_value = json_data or {}
+    return response
+
+
+@mock.patch('isa.utils.api_client.time.sleep')
+class TestApiClient(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        patcher = mock.patch('isa.utils.api_client.get_session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_retries_connection_errors(self, sleep):
+        ok = make_response()
+        self.session.request.side_effect = [requests.ConnectionError(), requests.Timeout(), ok]
+        self.assertIs(api_client.get('https://example.org', retries=5), ok)
+        self.assertEqual(self.session.request.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_get_raises_after_retries(self, sleep):
+        self.session.request.side_effect = requests.ConnectionError()
+        with self.assertRaises(requests.ConnectionError):
+            api_client.get('https://example.org', retries=2)
+        self.assertEqual(self.session.request.call_count, 3)
+
+    def test_post_does_not_retry_connection_errors(self, sleep):
+        self.session.request.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            api_client.post('https://example.org', data={})
+        self.assertEqual(self.session.request.call_count, 1)
+
+    def test_waits_as_long_as_server_asks(self, sleep):
+        ok = make_response()
+        self.session.request.side_effect = [
+            make_response(429, {'Retry-After': '7'}),
+            ok
+        ]
+        self.assertIs(api_client.post('https://example.org', data={}), ok)
+        self.assertGreaterEqual(sleep.call_args.args[0], 7)
+
+    def test_does_not_wait_longer_than_max_wait(self, sleep):
+        response = make_response(503, {'Retry-After': '600'})
+        self.session.request.return_value = response
+        self.assertIs(api_client.get('https://example.org', max_wait=api_client.INTERACTIVE_MAX_WAIT), response)
+        self.assertEqual(self.session.request.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_waits_at_most_backoff_max(self, sleep):
+        ok = make_response()
+        self.session.request.side_effect = [make_response(503, {'Retry-After': '600'}), ok]
+        self.assertIs(api_client.get('https://example.org'), ok)
+        sleep.assert_called_once_with(api_client.BACKOFF_MAX)
+
+    def test_interactive_retries(self, sleep):
+        self.session.request.return_value = make_response(429, {'Retry-After': '1'})
+        api_client.post('https://example.org', data={}, retries=api_client.INTERACTIVE_RETRIES)
+        self.assertEqual(self.session.request.call_count, 2)
+
+    def test_retries_maxlag_error(self, sleep):
+        lagged = make_response(
+            headers={'Retry-After': '5'},
+            json_data={'error': {'code': 'maxlag', 'info': 'Waiting for a database server'}}
+        )
+        ok = make_response(json_data={'query': {}})
+        self.session.request.side_effect = [lagged, ok]
+        self.assertIs(api_client.get('https://example.org', maxlag=5), ok)
+        self.assertEqual(self.session.request.call_args.kwargs['params'], {'maxlag': 5})
+
+    def test_does_not_retry_other_responses(self, sleep):
+        response = make_response(
+            headers={'Retry-After': '5'},
+            json_data={'error': {'code': 'badtoken'}}
+        )
+        self.session.request.return_value = response
+        self.assertIs(api_client.get('https://example.org'), response)
+        self.assertEqual(self.session.request.call_count, 1)
+        sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Unit tests for the statistics response cache
+
+from datetime import date
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import redis
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa import app, db
+from isa.campaigns import contributions
+from isa.models import Campaign, User
+from isa.utils import cache
+
+
+class TestMemoryBackend(unittest.TestCase):
+
+    def test_removes_least_recently_used(self):
+        backend = cache.MemoryBackend(max_entries=2)
+        backend.set('a', '1')
+        backend.set('b', '2')
+        backend.get('a')
+        backend.set('c', '3')
+        self.assertEqual(backend.get('a'), '1')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('c'), '3')
+
+    def test_entries_expire(self):
+        backend = cache.MemoryBackend()
+        with mock.patch('isa.utils.cache.time.monotonic', return_value=100):
+            backend.set('a', '1', ttl=10)
+        with mock.patch('isa.utils.cache.time.monotonic', return_value=109):
+            self.assertEqual(backend.get('a'), '1')
+        with mock.patch('isa.utils.cache.time.monotonic', return_value=110):
+            self.assertIsNone(backend.get('a'))
+
+    def test_counters_are_not_removed(self):
+        backend = cache.MemoryBackend(max_entries=1)
+        backend.incr('counter')
+        backend.set('a', '1')
+        backend.set('b', '2')
+        self.assertEqual(backend.incr('counter'), 2)
+
+
+class TestFileBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = cache.FileBackend(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_set_and_get(self):
+        self.assertIsNone(self.backend.get('a'))
+        self.backend.set('a', '{"x": 1}')
+        self.assertEqual(self.backend.get('a'), '{"x": 1}')
+        # Another backend in the same directory sees the entry
+        self.assertEqual(cache.FileBackend(self.directory).get('a'), '{"x": 1}')
+        self.backend.delete('a')
+        self.assertIsNone(self.backend.get('a'))
+
+    def test_entries_expire(self):
+        with mock.patch('isa.utils.cache.time.time', return_value=100):
+            self.backend.set('a', '1', ttl=10)
+            self.assertTrue(self.backend.add('lock', '1', ttl=10))
+        with mock.patch('isa.utils.cache.time.time', return_value=110):
+            self.assertIsNone(self.backend.get('a'))
+            self.assertTrue(self.backend.add('lock', '1', ttl=10))
+
+    def test_removes_expired_entries(self):
+        with mock.patch('isa.utils.cache.time.time', return_value=100):
+            self.backend.set('a', '1', ttl=10)
+            self.backend.set('b', '2', ttl=10)
+            self.backend.set('c', '3', ttl=20)
+        with mock.patch('isa.utils.cache.time.time', return_value=110):
+            self.assertIsNone(self.backend.get('a'))
+            self.assertEqual(len(os.listdir(self.directory)), 2)
+            self.assertEqual(self.backend.prune(), 1)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(self.backend._path('c'))])
+
+    def test_prunes_when_writing(self):
+        with mock.patch('isa.utils.cache.time.time', return_value=100):
+            self.backend.set('a', '1', ttl=10)
+        self.backend._next_prune = 0
+        self.backend.set('b', '2')
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(self.backend._path('b'))])
+
+    def test_add(self):
+        self.assertTrue(self.backend.add('lock', '1'))
+        self.assertFalse(self.backend.add('lock', '1'))
+        self.backend.delete('lock')
+        self.assertTrue(self.backend.add('lock', '1'))
+
+    def test_incr(self):
+        self.assertEqual(self.backend.incr('counter'), 1)
+        self.assertEqual(self.backend.incr('counter'), 2)
+        self.assertEqual(self.backend.get('counter'), 2)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        cache._backend = cache.MemoryBackend()
+        self.compute = mock.Mock(return_value={'total_contributions': 1})
+
+    def test_get_or_compute(self):
+        for _ in range(2):
+            value = cache.get_or_compute('stats', 1, {'page': 1}, self.compute)
+            self.assertEqual(value, {'total_contributions': 1})
+        self.compute.assert_called_once_with()
+        self.assertEqual(cache.get_counters(), {'hits': 1, 'misses': 1})
+
+    def test_get_or_compute_for_other_parameters(self):
+        cache.get_or_compute('stats', 1, {'page': 1}, self.compute)
+        cache.get_or_compute('stats', 1, {'page': 2}, self.compute)
+        cache.get_or_compute('stats', 2, {'page': 1}, self.compute)
+        self.assertEqual(self.compute.call_count, 3)
+
+    def test_counts_in_memory_with_file_backend(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache._backend = cache.FileBackend(directory)
+        with mock.patch.object(cache, '_local_counters', cache.Counter()):
+            cache.get_or_compute('stats', 1, {}, self.compute)
+            cache.get_or_compute('stats', 1, {}, self.compute)
+            self.assertEqual(cache.get_counters(), {'hits': 1, 'misses': 1})
+        # Only the entry is written
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+    def test_invalidate_campaign(self):
+        cache.get_or_compute('stats', 1, {}, self.compute)
+        cache.get_or_compute('stats', 2, {}, self.compute)
+        cache.invalidate_campaign(1)
+        cache.get_or_compute('stats', 1, {}, self.compute)
+        cache.get_or_compute('stats', 2, {}, self.compute)
+        self.assertEqual(self.compute.call_count, 3)
+
+    def test_computes_when_backend_is_unavailable(self):
+        backend = mock.Mock()
+        backend.get.side_effect = redis.ConnectionError()
+        cache._backend = backend
+        self.assertEqual(cache.get_or_compute('stats', 1, {}, self.compute), {'total_contributions': 1})
+        cache.invalidate_campaign(1)
+
+
+class TestGetOrRefresh(unittest.TestCase):
+
+    def setUp(self):
+        cache._backend = cache.MemoryBackend()
+        self.compute = mock.Mock(return_value={'years': [2020]})
+
+    def _store(self, value, expires):
+        cache.get_backend().set(cache.KEY_PREFIX + 'stats', json.dumps({'value': value, 'expires': expires}))
+
+    def test_caches_for_ttl(self):
+        with mock.patch('isa.utils.cache.time.time', return_value=100):
+            cache.get_or_refresh('stats', self.compute, 30)
+        with mock.patch('isa.utils.cache.time.time', return_value=129):
+            self.assertEqual(cache.get_or_refresh('stats', self.compute, 30), {'years': [2020]})
+        self.assertEqual(self.compute.call_count, 1)
+        with mock.patch('isa.utils.cache.time.time', return_value=130):
+            cache.get_or_refresh('stats', self.compute, 30)
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_does_not_cache_none(self):
+        self.compute.return_value = None
+        cache.get_or_refresh('stats', self.compute, 30)
+        cache.get_or_refresh('stats', self.compute, 30)
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_serves_stale_value_while_refreshing(self):
+        self._store({'years': [2019]}, 0)
+        # Another worker is computing the value
+        cache.get_backend().add(cache.KEY_PREFIX + 'stats:lock', '1')
+        self.assertEqual(cache.get_or_refresh('stats', self.compute, 30), {'years': [2019]})
+        self.compute.assert_not_called()
+
+    def test_waits_for_other_worker(self):
+        cache.get_backend().add(cache.KEY_PREFIX + 'stats:lock', '1')
+        timer = threading.Timer(0.05, self._store, ({'years': [2021]}, 10 ** 10))
+        timer.start()
+        with mock.patch('isa.utils.cache.REFRESH_POLL_INTERVAL', 0.01):
+            self.assertEqual(cache.get_or_refresh('stats', self.compute, 30), {'years': [2021]})
+        timer.join()
+        self.compute.assert_not_called()
+
+    def test_computes_after_refresh_timeout(self):
+        cache.get_backend().add(cache.KEY_PREFIX + 'stats:lock', '1')
+        with mock.patch('isa.utils.cache.REFRESH_TIMEOUT', 0), \
+                mock.patch('isa.utils.cache.REFRESH_POLL_INTERVAL', 0):
+            self.assertEqual(cache.get_or_refresh('stats', self.compute, 30), {'years': [2020]})
+
+    def test_releases_lock(self):
+        cache.get_or_refresh('stats', self.compute, 30)
+        self.assertTrue(cache.get_backend().add(cache.KEY_PREFIX + 'stats:lock', '1'))
+
+
+class TestCachedRoutes(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+        cache._backend = cache.MemoryBackend()
+
+        self.user = User(username='alice', caption_languages='en', depicts_language='en')
+        db.session.add(self.user)
+        db.session.commit()
+        campaign = Campaign(campaign_name='Test Campaign',
+                            categories='[]',
+                            start_date=date(2020, 2, 1),
+                            manager_id=self.user.id,
+                            short_description='',
+                            long_description='',
+                            creation_date=date(2020, 2, 1))
+        db.session.add(campaign)
+        db.session.commit()
+        self.campaign_id = campaign.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def _total_contributions(self):
+        response = app.test_client().get('/api/campaigns/{}/stats_by_date'.format(self.campaign_id))
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['total_contributions']
+
+    def test_new_contribution_invalidates_stats(self):
+        self.assertEqual(self._total_contributions(), 0)
+        self.assertEqual(self._total_contributions(), 0)
+        self.assertEqual(cache.get_counters(), {'hits': 1, 'misses': 1})
+
+        contributions._record_contribution(self.user, {
+            'campaign_id': self.campaign_id,
+            'image': 'File:Test.jpg',
+            'edit_action': 'add',
+            'edit_type': 'captions',
+            'country': '',
+            'caption_language': 'en',
+            'caption_text': 'A test'
+        })
+        self.assertEqual(self._total_contributions(), 1)
+
+        response = app.test_client().get('/api/stats-cache')
+        self.assertEqual(response.get_json(), {'hits': 1, 'misses': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,7 @@ import unittest
 from unittest import mock
 
 from flask import session
+import requests
 
 # Ensure the project root (containing the "isa" package) is on sys.path
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -18,7 +19,10 @@ if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
 from isa import app, db
+from isa.campaigns import contributions
+from isa.campaigns.utils import BadTokenException
 from isa.models import Campaign, User, Contribution, Suggestion
+from isa.utils import cache
 
 
 class TestCampaignRoutes(unittest.TestCase):
@@ -37,6 +41,8 @@ class TestCampaignRoutes(unittest.TestCase):
 
         self.app = app.test_client()
         db.create_all()
+        # Don't use cached stats from other tests
+        cache._backend = cache.MemoryBackend()
 
         # Minimal manager user to satisfy Campaign FK
         manager = User(username='TestUsername', caption_languages='en', depicts_language='en')
@@ -229,7 +235,7 @@ class TestCampaignRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get_json(), {'results': None})
 
-    @mock.patch('isa.campaigns.routes.requests.get')
+    @mock.patch('isa.campaigns.routes.api_client.get')
     def test_search_depicts_with_term_success(self, mocked_get):
         # Simulate a Wikidata search result
         mocked_response = mock.Mock()
@@ -295,8 +301,8 @@ class TestCampaignRoutes(unittest.TestCase):
             'api_options': {'action': 'wbsetclaim'}
         }]
 
-        with mock.patch('isa.campaigns.routes.generate_csrf_token') as mocked_csrf, \
-                mock.patch('isa.campaigns.routes.make_edit_api_call') as mocked_edit:
+        with mock.patch('isa.campaigns.contributions.generate_csrf_token') as mocked_csrf, \
+                mock.patch('isa.campaigns.contributions.make_edit_api_call') as mocked_edit:
             mocked_csrf.return_value = ('token', 'auth')
             mocked_edit.return_value = 123
             response = self.app.post('/api/post-contribution', json=payload)
@@ -309,6 +315,161 @@ class TestCampaignRoutes(unittest.TestCase):
         contrib = Contribution.query.filter_by(user_id=user.id).first()
         self.assertIsNotNone(contrib)
 
+    def test_post_contribution_fetches_token_once(self):
+        self._login()
+        with self.app.session_transaction() as sess:
+            sess['access_token'] = {'key': 'test', 'secret': 'test'}
+
+        original_isa_dev = app.config.get('ISA_DEV', False)
+        app.config['ISA_DEV'] = False
+        app.config['CONSUMER_KEY'] = 'dummy'
+        app.config['CONSUMER_SECRET'] = 'dummy'
+
+        payload = [{
+            'campaign_id': self.test_campaign_id,
+            'image': 'File:Test.jpg',
+            'edit_action': 'add',
+            'edit_type': 'depicts',
+            'country': 'Testland',
+            'api_options': {'action': 'wbsetclaim'}
+        } for _ in range(3)]
+
+        with mock.patch('isa.campaigns.contributions.generate_csrf_token') as mocked_csrf, \
+                mock.patch('isa.campaigns.contributions.make_edit_api_call') as mocked_edit:
+            mocked_csrf.return_value = ('token', 'auth')
+            # The first edit fails with a stale token and is retried.
+            mocked_edit.side_effect = [BadTokenException(), 1, 2, 3]
+            response = self.app.post('/api/post-contribution', json=payload)
+
+        app.config['ISA_DEV'] = original_isa_dev
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode('utf-8'), '3')
+        self.assertEqual(mocked_csrf.call_count, 2)
+        self.assertEqual(mocked_edit.call_count, 4)
+        # Each edit is based on the revision made by the previous one.
+        base_revisions = [call.args[2]['api_options'].get('baserevid') for call in mocked_edit.call_args_list]
+        self.assertEqual(base_revisions, [None, None, 1, 2])
+        self.assertEqual(Contribution.query.count(), 3)
+
+    def test_post_contribution_records_suggestions_for_made_edits(self):
+        self._login()
+        with self.app.session_transaction() as sess:
+            sess['access_token'] = {'key': 'test', 'secret': 'test'}
+
+        original_isa_dev = app.config.get('ISA_DEV', False)
+        app.config['ISA_DEV'] = False
+        app.config['CONSUMER_KEY'] = 'dummy'
+        app.config['CONSUMER_SECRET'] = 'dummy'
+
+        payload = [{
+            'campaign_id': self.test_campaign_id,
+            'image': 'File:Test.jpg',
+            'edit_action': 'add',
+            'edit_type': 'depicts',
+            'country': 'Testland',
+            'depict_item': depict_item,
+            'google_vision': 1,
+            'api_options': {'action': 'wbsetclaim'}
+        } for depict_item in ['Q1', 'Q2', 'Q3']]
+
+        with mock.patch('isa.campaigns.contributions.generate_csrf_token') as mocked_csrf, \
+                mock.patch('isa.campaigns.contributions.make_edit_api_call') as mocked_edit:
+            mocked_csrf.return_value = ('token', 'auth')
+            # The second edit fails, so the third one is skipped.
+            mocked_edit.side_effect = [1, None]
+            response = self.app.post('/api/post-contribution', json=payload)
+
+        app.config['ISA_DEV'] = original_isa_dev
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([suggestion.depict_item for suggestion in Suggestion.query], ['Q1'])
+
+    def test_post_contribution_request_error_keeps_made_edits(self):
+        user = self._login()
+        payload = [{
+            'campaign_id': self.test_campaign_id,
+            'image': 'File:Test.jpg',
+            'edit_action': 'add',
+            'edit_type': 'depicts',
+            'country': 'Testland',
+            'api_options': {'action': 'wbsetclaim'}
+        } for _ in range(3)]
+        reported = []
+
+        with mock.patch('isa.campaigns.contributions.generate_csrf_token') as mocked_csrf, \
+                mock.patch('isa.campaigns.contributions.make_edit_api_call') as mocked_edit:
+            mocked_csrf.return_value = ('token', 'auth')
+            mocked_edit.side_effect = [1, requests.Timeout()]
+            results = contributions.make_edits(payload, user.id, {'key': 'test', 'secret': 'test'},
+                                               on_edit=lambda results: reported.append(list(results)))
+
+        self.assertEqual([result['status'] for result in results],
+                         [contributions.DONE, contributions.FAILED, contributions.SKIPPED])
+        self.assertEqual(results[0]['revision_id'], 1)
+        self.assertEqual(reported[-1], results)
+        self.assertEqual(Contribution.query.count(), 1)
+
+        # The route reports the failure without an error
+        with self.app.session_transaction() as sess:
+            sess['access_token'] = {'key': 'test', 'secret': 'test'}
+        original_isa_dev = app.config.get('ISA_DEV', False)
+        app.config['ISA_DEV'] = False
+        app.config['CONSUMER_KEY'] = 'dummy'
+        app.config['CONSUMER_SECRET'] = 'dummy'
+        try:
+            with mock.patch('isa.campaigns.contributions.generate_csrf_token') as mocked_csrf:
+                mocked_csrf.side_effect = requests.ConnectionError()
+                response = self.app.post('/api/post-contribution', json=payload)
+        finally:
+            app.config['ISA_DEV'] = original_isa_dev
+        self.assertEqual(response.status_code, 400)
+
+    def test_post_contribution_async_returns_job_id(self):
+        self._login()
+        with self.app.session_transaction() as sess:
+            sess['access_token'] = {'key': 'test', 'secret': 'test'}
+
+        original_isa_dev = app.config.get('ISA_DEV', False)
+        app.config['ISA_DEV'] = False
+        app.config['ASYNC_CONTRIBUTIONS'] = True
+        payload = [{
+            'campaign_id': self.test_campaign_id,
+            'image': 'File:Test.jpg',
+            'edit_action': 'add',
+            'edit_type': 'depicts',
+            'country': 'Testland',
+            'api_options': {'action': 'wbsetclaim'}
+        }]
+        try:
+            with mock.patch('isa.campaigns.contributions.make_edits_task.delay') as mocked_delay:
+                mocked_delay.return_value.id = 'job-1'
+                response = self.app.post('/api/post-contribution', json=payload)
+        finally:
+            app.config['ISA_DEV'] = original_isa_dev
+            app.config.pop('ASYNC_CONTRIBUTIONS')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json(), {'job_id': 'job-1'})
+        self.assertEqual(mocked_delay.call_args.args[2], {'key': 'test', 'secret': 'test'})
+        # Nothing is recorded until the edits are made.
+        self.assertEqual(Contribution.query.count(), 0)
+
+    def test_contribution_status_reports_edits(self):
+        user = self._login()
+        edits = [{'status': 'done', 'revision_id': 5}, {'status': 'pending', 'revision_id': None}]
+        with mock.patch('isa.campaigns.routes.AsyncResult') as mocked_result:
+            mocked_result.return_value.state = 'PROGRESS'
+            mocked_result.return_value.info = {'user_id': user.id, 'edits': edits, 'revision_id': 5}
+            response = self.app.get('/api/post-contribution/job-1')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json(), {'state': 'PROGRESS', 'edits': edits, 'revision_id': 5})
+
+            # Other users can't see the job.
+            mocked_result.return_value.info = {'user_id': user.id + 1, 'edits': edits, 'revision_id': 5}
+            response = self.app.get('/api/post-contribution/job-1')
+            self.assertEqual(response.status_code, 404)
+
     def test_save_reject_suggestion_requires_login(self):
         response = self.app.post('/api/reject-suggestion', json={})
         self.assertEqual(response.status_code, 401)
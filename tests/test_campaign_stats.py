@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# Unit tests for campaign stats and the contribution rollup
+
+from datetime import date
+import os
+import sys
+import unittest
+
+from sqlalchemy import event
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa import app, db
+from isa.campaigns import stats
+from isa.models import Campaign, Contribution, ContributionRollup, User
+from isa.utils import cache
+
+
+class TestCampaignStats(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+        # Don't use cached stats from other tests
+        cache._backend = cache.MemoryBackend()
+
+        self.alice = User(username='alice', caption_languages='en', depicts_language='en')
+        self.bob = User(username='bob', caption_languages='en', depicts_language='en')
+        db.session.add_all([self.alice, self.bob])
+        db.session.commit()
+
+        campaign = Campaign(campaign_name='Test Campaign',
+                            categories='[]',
+                            start_date=date(2020, 2, 1),
+                            manager_id=self.alice.id,
+                            short_description='',
+                            long_description='',
+                            creation_date=date(2020, 2, 1))
+        db.session.add(campaign)
+        db.session.commit()
+        self.campaign_id = campaign.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def _contribution(self, user, day, edit_type='captions', country='', caption_language=None):
+        return Contribution(user=user,
+                            campaign_id=self.campaign_id,
+                            file='File:Test.jpg',
+                            edit_type=edit_type,
+                            edit_action='add',
+                            country=country,
+                            caption_language=caption_language,
+                            date=day)
+
+    def _add_contributions(self):
+        contributions = [
+            self._contribution(self.alice, date(2020, 3, 1), country='Ghana', caption_language='en'),
+            self._contribution(self.alice, date(2020, 3, 1), country='Ghana', caption_language='en'),
+            self._contribution(self.alice, date(2020, 3, 2), edit_type='depicts', country='Ghana'),
+            self._contribution(self.bob, date(2020, 3, 2), country='Sweden', caption_language='sv'),
+        ]
+        db.session.add_all(contributions)
+        stats.record_contributions(contributions)
+        db.session.commit()
+
+    def test_add_to_rollup_merges_rows(self):
+        self._add_contributions()
+        # Both of alice's captions on the first day are in one row.
+        self.assertEqual(ContributionRollup.query.count(), 3)
+
+        more = [self._contribution(self.alice, date(2020, 3, 1), country='Ghana', caption_language='en')]
+        db.session.add_all(more)
+        stats.add_to_rollup(more)
+        db.session.commit()
+        row = ContributionRollup.query.filter_by(user_id=self.alice.id, date=date(2020, 3, 1)).one()
+        self.assertEqual(row.contributions, 3)
+
+    def test_get_campaign_stats(self):
+        self._add_contributions()
+        campaign_stats = stats.get_campaign_stats(self.campaign_id)
+
+        self.assertEqual(campaign_stats['total_contributions'], 4)
+        self.assertEqual(campaign_stats['datewise_data'], [
+            {'date': '2020-03-01', 'count': 2},
+            {'date': '2020-03-02', 'count': 2},
+        ])
+        self.assertEqual(campaign_stats['top_contributors'], [
+            {'username': 'alice', 'count': 3},
+            {'username': 'bob', 'count': 1},
+        ])
+        self.assertEqual(campaign_stats['language_stats'], [
+            {'language': 'en', 'count': 2},
+            {'language': 'sv', 'count': 1},
+        ])
+        self.assertEqual(campaign_stats['country_distribution'], [
+            {'country': 'Ghana', 'count': 3},
+            {'country': 'Sweden', 'count': 1},
+        ])
+        self.assertEqual(campaign_stats['contribution_types'], [
+            {'type': 'captions', 'count': 3},
+            {'type': 'depicts', 'count': 1},
+        ])
+        distribution = campaign_stats['contributor_distribution']
+        self.assertEqual(distribution['num_users'], 2)
+        self.assertEqual(distribution['median'], 2)
+        self.assertEqual(distribution['top_5_share'], 75)
+        self.assertEqual(distribution['gini'], 0.25)
+
+    def test_get_campaign_stats_skips_empty_edit_type(self):
+        self._add_contributions()
+        contributions = [self._contribution(self.bob, date(2020, 3, 3), edit_type='')]
+        db.session.add_all(contributions)
+        stats.record_contributions(contributions)
+        db.session.commit()
+
+        campaign_stats = stats.get_campaign_stats(self.campaign_id)
+        self.assertEqual(campaign_stats['total_contributions'], 5)
+        self.assertEqual(campaign_stats['contribution_types'], [
+            {'type': 'captions', 'count': 3},
+            {'type': 'depicts', 'count': 1},
+        ])
+
+    def test_get_campaign_stats_runs_one_query(self):
+        self._add_contributions()
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            stats.get_campaign_stats(self.campaign_id)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+        self.assertEqual(len(statements), 1)
+
+    def test_get_campaign_stats_in_date_range(self):
+        self._add_contributions()
+        campaign_stats = stats.get_campaign_stats(self.campaign_id, start_date=date(2020, 3, 2))
+        self.assertEqual(campaign_stats['total_contributions'], 2)
+        self.assertCountEqual(campaign_stats['top_contributors'], [
+            {'username': 'alice', 'count': 1},
+            {'username': 'bob', 'count': 1},
+        ])
+
+    def test_rebuild_rollup_matches_incremental(self):
+        self._add_contributions()
+        incremental = stats.get_campaign_stats(self.campaign_id)
+
+        # A contribution that was recorded without updating the rollup
+        db.session.add(self._contribution(self.bob, date(2020, 3, 3), edit_type='depicts'))
+        db.session.commit()
+        self.assertEqual(stats.get_campaign_stats(self.campaign_id), incremental)
+
+        rows = stats.rebuild_rollup([self.campaign_id])
+        db.session.commit()
+
+        self.assertEqual(rows, 4)
+        rebuilt = stats.get_campaign_stats(self.campaign_id)
+        self.assertEqual(rebuilt['total_contributions'], 5)
+        self.assertEqual(rebuilt['datewise_data'][:2], incremental['datewise_data'])
+
+    def test_record_contributions_updates_counters(self):
+        self._add_contributions()
+        campaign = Campaign.query.get(self.campaign_id)
+        self.assertEqual(campaign.campaign_contributions, 4)
+        self.assertEqual(campaign.campaign_participants, 2)
+
+        # A returning contributor is not counted again.
+        more = [self._contribution(self.bob, date(2020, 4, 1))]
+        db.session.add_all(more)
+        stats.record_contributions(more)
+        db.session.commit()
+        db.session.refresh(campaign)
+        self.assertEqual(campaign.campaign_contributions, 5)
+        self.assertEqual(campaign.campaign_participants, 2)
+
+    def test_reconcile_campaign_counters(self):
+        self._add_contributions()
+        Campaign.query.filter_by(id=self.campaign_id).update({'campaign_contributions': 100,
+                                                              'campaign_participants': 0})
+        db.session.commit()
+
+        self.assertEqual(stats.reconcile_campaign_counters(), 1)
+        db.session.commit()
+        campaign = Campaign.query.get(self.campaign_id)
+        db.session.refresh(campaign)
+        self.assertEqual(campaign.campaign_contributions, 4)
+        self.assertEqual(campaign.campaign_participants, 2)
+        # Nothing to correct the second time.
+        self.assertEqual(stats.reconcile_campaign_counters(), 0)
+
+    def test_campaign_page_does_not_write(self):
+        self._add_contributions()
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            response = app.test_client().get('/campaigns/{}'.format(self.campaign_id))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([s for s in statements if s.lstrip().upper().startswith(('UPDATE', 'INSERT', 'DELETE'))])
+
+    def test_stats_by_date_route_reads_rollup(self):
+        self._add_contributions()
+        response = app.test_client().get(
+            '/api/campaigns/{}/stats_by_date?end_date=2020-03-01'.format(self.campaign_id)
+        )
+        self.assertEqual(response.status_code, 200)
+        payload = response.get_json()
+        self.assertEqual(payload['total_contributions'], 2)
+        self.assertEqual(payload['language_stats'], [{'language': 'en', 'count': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
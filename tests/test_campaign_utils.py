@@ -5,15 +5,26 @@
 
 import unittest
 import datetime
+import re
+from unittest import mock
+
+from sqlalchemy import event
 
 from isa import app, db
 from isa.campaigns.utils import (
     get_country_from_code,
     convert_latin_to_english,
     compute_campaign_status,
-    get_all_camapign_stats_data,
+    get_table_stats,
+    get_campaign_country_data,
+    generate_csrf_token,
+    invalidate_csrf_token,
+    make_edit_api_call,
+    BadTokenException,
+    _csrf_tokens,
 )
-from isa.models import Contribution, Campaign
+from isa.campaigns import stats as campaign_stats
+from isa.models import Contribution, Campaign, User
 
 
 class TestCampaignUtils(unittest.TestCase):
@@ -30,6 +41,7 @@ class TestCampaignUtils(unittest.TestCase):
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        _csrf_tokens.clear()
 
     def test_get_country_from_code(self):
         country = get_country_from_code('CM')
@@ -44,16 +56,148 @@ class TestCampaignUtils(unittest.TestCase):
         campaign_status = compute_campaign_status(end_date)
         self.assertTrue(campaign_status)
 
-    def test_get_all_camapign_stats_data(self):
-        campaign_stats_users = []
-        contribution_users = []
-        campaign_contributions = Contribution.query.filter_by(campaign_id=1).all()
-        all_campaign_stats_data = get_all_camapign_stats_data(1)
-        for contribution in campaign_contributions:
-            contribution_users.append(contribution.username)
-        for stats in all_campaign_stats_data:
-            campaign_stats_users.append(stats['username'])
-        self.assertEqual(campaign_stats_users, contribution_users)
+    def _add_campaign_contributions(self, contribution_counts):
+        manager = User(username='Manager', caption_languages='en', depicts_language='en')
+        db.session.add(manager)
+        db.session.commit()
+        campaign = Campaign(campaign_name='Test Campaign',
+                            categories='[]',
+                            start_date=datetime.date(2020, 2, 1),
+                            manager_id=manager.id,
+                            short_description='',
+                            long_description='',
+                            creation_date=datetime.date(2020, 2, 1))
+        db.session.add(campaign)
+        db.session.commit()
+        contributions = []
+        for username, count in contribution_counts.items():
+            user = User(username=username, caption_languages='en', depicts_language='en')
+            db.session.add(user)
+            db.session.commit()
+            for i in range(count):
+                contributions.append(Contribution(user_id=user.id,
+                                                  campaign_id=campaign.id,
+                                                  file='File:{}.jpg'.format(i),
+                                                  edit_type='depicts',
+                                                  edit_action='add',
+                                                  country='',
+                                                  date=datetime.date(2020, 3, 1)))
+        db.session.add_all(contributions)
+        campaign_stats.record_contributions(contributions)
+        db.session.commit()
+        return campaign.id
+
+    def test_get_table_stats_ranks_contributors(self):
+        campaign_id = self._add_campaign_contributions({'alice': 3, 'bob': 1, 'carol': 3, 'dave': 2})
+
+        first_page = get_table_stats(campaign_id, 'dave', 1, 2)
+        self.assertEqual(first_page['all_contributors_data'], [
+            {'username': 'alice', 'images_improved': 3, 'rank': 1},
+            {'username': 'carol', 'images_improved': 3, 'rank': 1},
+        ])
+        # The current user's rank is found even when not on the page.
+        self.assertEqual(first_page['current_user_rank'], 3)
+        self.assertEqual(first_page['campaign_editors'], 4)
+        self.assertEqual(first_page['page_info'], {'page': 1, 'per_page': 2, 'total': 4, 'pages': 2})
+
+        second_page = get_table_stats(campaign_id, 'nobody', 2, 2)
+        self.assertEqual([data['rank'] for data in second_page['all_contributors_data']], [3, 4])
+        self.assertEqual(second_page['current_user_rank'], 0)
+
+        # Out of range pages fall back to the first one.
+        self.assertEqual(get_table_stats(campaign_id, None, 5, 2)['page_info']['page'], 1)
+
+    def test_get_campaign_country_data_counts_whole_campaign(self):
+        campaign_id = self._add_campaign_contributions({'alice': 2})
+        alice = User.query.filter_by(username='alice').first()
+        contributions = [
+            Contribution(user_id=alice.id, campaign_id=campaign_id, file=file_name,
+                         edit_type='captions', edit_action='add', country=country,
+                         date=datetime.date(2020, 3, 1))
+            for country, file_name in [('Ghana', 'File:a.jpg'), ('Ghana', 'File:a.jpg'), ('Ghana', 'File:b.jpg'),
+                                       ('Sweden', 'File:c.jpg'), ('Nepal', 'File:d.jpg'), ('Nepal', 'File:e.jpg')]
+        ]
+        db.session.add_all(contributions)
+        campaign_stats.record_contributions(contributions)
+        db.session.commit()
+
+        self.assertEqual(get_campaign_country_data(campaign_id, per_page=None), [
+            {'country': 'Ghana', 'images_improved': 3, 'rank': 1},
+            {'country': 'Nepal', 'images_improved': 2, 'rank': 2},
+            {'country': 'Sweden', 'images_improved': 1, 'rank': 3},
+        ])
+        self.assertEqual(get_campaign_country_data(campaign_id, distinct_files=True, per_page=None), [
+            {'country': 'Ghana', 'images_improved': 2, 'rank': 1},
+            {'country': 'Nepal', 'images_improved': 2, 'rank': 1},
+            {'country': 'Sweden', 'images_improved': 1, 'rank': 3},
+        ])
+        # Ranks are over all countries, not just the page.
+        self.assertEqual(get_campaign_country_data(campaign_id, page=2, per_page=2), [
+            {'country': 'Sweden', 'images_improved': 1, 'rank': 3},
+        ])
+
+    def test_get_table_stats_query_count_is_bounded(self):
+        campaign_id = self._add_campaign_contributions({'user{}'.format(i): i + 1 for i in range(20)})
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            table_stats = get_table_stats(campaign_id, 'user3', 1, 20)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        self.assertEqual(len(table_stats['all_contributors_data']), 20)
+        # Count, page and current user's rank for the contributors and
+        # one query for the countries, however many contributors.
+        self.assertLessEqual(len(statements), 4)
+        # The counts are read from the rollup, not the contributions
+        self.assertFalse([args for args in statements if re.search(r'\bcontribution\b(?!_)', args[2])])
+
+    @mock.patch('isa.campaigns.utils.api_client.get')
+    def test_generate_csrf_token_is_cached(self, mocked_get):
+        mocked_get.return_value.json.return_value = {'query': {'tokens': {'csrftoken': 'token+\\'}}}
+        token, _ = generate_csrf_token('app', 'secret', 'user', 'user-secret')
+        cached_token, auth = generate_csrf_token('app', 'secret', 'user', 'user-secret')
+        self.assertEqual(cached_token, token)
+        self.assertIsNotNone(auth)
+        self.assertEqual(mocked_get.call_count, 1)
+
+        # Tokens are cached per user.
+        generate_csrf_token('app', 'secret', 'other-user', 'other-secret')
+        self.assertEqual(mocked_get.call_count, 2)
+
+        invalidate_csrf_token('user', 'user-secret')
+        generate_csrf_token('app', 'secret', 'user', 'user-secret')
+        self.assertEqual(mocked_get.call_count, 3)
+
+    @mock.patch('isa.campaigns.utils.api_client.get')
+    def test_generate_csrf_token_expires(self, mocked_get):
+        mocked_get.return_value.json.return_value = {'query': {'tokens': {'csrftoken': 'token+\\'}}}
+        app.config['CSRF_TOKEN_TTL'] = 0
+        try:
+            generate_csrf_token('app', 'secret', 'user', 'user-secret')
+            generate_csrf_token('app', 'secret', 'user', 'user-secret')
+        finally:
+            app.config.pop('CSRF_TOKEN_TTL')
+        self.assertEqual(mocked_get.call_count, 2)
+
+    @mock.patch('isa.campaigns.utils.api_client.post')
+    def test_make_edit_api_call_bad_token(self, mocked_post):
+        mocked_post.return_value.status_code = 200
+        mocked_post.return_value.json.return_value = {'error': {'code': 'badtoken', 'info': 'Invalid CSRF token.'}}
+        contribution_data = {
+            'api_options': {'action': 'wbsetlabel'},
+            'edit_type': 'caption',
+            'edit_action': 'add',
+            'campaign_id': 1
+        }
+        with self.assertRaises(BadTokenException):
+            make_edit_api_call('token', 'auth', contribution_data)
+        # The options can be sent again.
+        self.assertEqual(contribution_data['api_options'], {'action': 'wbsetlabel'})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Unit tests for the distribution of contributions over users
+
+import os
+import random
+import statistics
+import sys
+import unittest
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa.utils.distribution import Distribution
+
+
+class TestDistribution(unittest.TestCase):
+
+    def test_empty(self):
+        distribution = Distribution()
+        self.assertEqual(distribution.num_users, 0)
+        self.assertEqual(distribution.describe(), {
+            'num_users': 0, 'mean': 0, 'median': 0, 'p90': 0, 'top_5_share': 0, 'top_10_share': 0,
+            'top_20_share': 0, 'gini': 0, 'histogram': []
+        })
+
+    def test_matches_sorted_list(self):
+        counts = [random.Random(seed).randint(1, 50) for seed in range(101)]
+        distribution = Distribution.from_counts(counts)
+        ordered = sorted(counts)
+
+        self.assertEqual(distribution.total, sum(counts))
+        self.assertEqual((distribution.min(), distribution.max()), (ordered[0], ordered[-1]))
+        self.assertAlmostEqual(distribution.mean(), statistics.mean(counts))
+        self.assertEqual(distribution.median(), statistics.median(counts))
+        self.assertEqual(Distribution.from_counts(counts[:100]).median(), statistics.median(counts[:100]))
+        self.assertEqual(distribution.quantile(0.9), statistics.quantiles(counts, n=10, method='inclusive')[-1])
+
+        top = max(1, round(len(counts) * 0.1))
+        self.assertAlmostEqual(distribution.top_share(0.1), sum(ordered[-top:]) / sum(counts))
+
+        mean_difference = sum(abs(a - b) for a in counts for b in counts) / len(counts) ** 2
+        self.assertAlmostEqual(distribution.gini(), mean_difference / (2 * statistics.mean(counts)))
+
+    def test_gini(self):
+        self.assertEqual(Distribution({5: 10}).gini(), 0)
+        self.assertAlmostEqual(Distribution({1: 1, 3: 1}).gini(), 0.25)
+
+    def test_histogram(self):
+        distribution = Distribution({1: 3, 2: 1, 3: 2, 9: 1})
+        self.assertEqual(distribution.histogram(), [
+            {'min': 1, 'max': 1, 'users': 3},
+            {'min': 2, 'max': 3, 'users': 3},
+            {'min': 4, 'max': 7, 'users': 0},
+            {'min': 8, 'max': 15, 'users': 1},
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
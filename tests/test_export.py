@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Unit tests for the campaign contribution export
+
+import csv
+from datetime import date
+import gzip
+import io
+import json
+import os
+import sys
+import unittest
+
+from sqlalchemy import event
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa import app, db
+from isa.campaigns import export
+from isa.models import Campaign, Contribution, User
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+
+        alice = User(username='alice', caption_languages='en', depicts_language='en')
+        bob = User(username='bob', caption_languages='en', depicts_language='en')
+        db.session.add_all([alice, bob])
+        db.session.commit()
+
+        campaign = Campaign(campaign_name='Tëst Campaign',
+                            categories='[]',
+                            start_date=date(2020, 2, 1),
+                            manager_id=alice.id,
+                            short_description='',
+                            long_description='',
+                            creation_date=date(2020, 2, 1))
+        db.session.add(campaign)
+        db.session.commit()
+        self.campaign_id = campaign.id
+
+        db.session.add_all([
+            Contribution(user=alice, campaign_id=self.campaign_id, file='File:A.jpg', edit_type='captions',
+                         edit_action='add', country='Ghana', caption_language='en', caption_text='A cat',
+                         date=date(2020, 3, 1)),
+            Contribution(user=bob, campaign_id=self.campaign_id, file='File:B.jpg', edit_type='depicts',
+                         edit_action='add', country='', depict_item='Q146', depict_prominent=True,
+                         date=date(2020, 3, 2)),
+            Contribution(user=alice, campaign_id=self.campaign_id, file='File:C.jpg', edit_type='depicts',
+                         edit_action='remove', country='Ghana', depict_item='Q144', depict_prominent=False,
+                         date=date(2020, 3, 3)),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_get_contribution_rows_in_batches(self):
+        batches = list(export.get_contribution_rows(self.campaign_id, batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertEqual(tuple(batches[0][0]), ('alice', 'File:A.jpg', 'captions', 'add', 'Ghana', None,
+                                                None, 'A cat', 'en', date(2020, 3, 1)))
+        self.assertEqual([row.username for batch in batches for row in batch], ['alice', 'bob', 'alice'])
+
+    def test_download_csv(self):
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            if 'contribution' in statement.lower():
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            response = app.test_client().get('/campaigns/{}/download_csv'.format(self.campaign_id))
+            data = response.get_data(as_text=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename=Test_Campaign_all_stats.csv')
+        rows = list(csv.DictReader(io.StringIO(data)))
+        self.assertEqual(list(rows[0].keys()), export.EXPORT_FIELDS)
+        self.assertEqual(rows[1], {
+            'username': 'bob', 'file': 'File:B.jpg', 'edit_type': 'depicts', 'edit_action': 'add',
+            'country': '', 'depict_item': 'Q146', 'depict_prominent': 'True', 'caption_text': '',
+            'caption_language': '', 'date': '2020-03-02'
+        })
+        self.assertEqual(len(rows), 3)
+        # All the rows are read with one query, without loading each user
+        self.assertEqual(len([s for s in statements if 'user' in s.lower()]), 1)
+
+    def test_download_csv_gz(self):
+        response = app.test_client().get('/campaigns/{}/download_csv?format=csv.gz'.format(self.campaign_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename=Test_Campaign_all_stats.csv.gz')
+        data = gzip.decompress(response.get_data())
+        plain_response = app.test_client().get('/campaigns/{}/download_csv'.format(self.campaign_id))
+        self.assertEqual(data, plain_response.get_data())
+
+    def test_download_ndjson(self):
+        response = app.test_client().get('/campaigns/{}/download_csv?format=ndjson'.format(self.campaign_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1], {
+            'username': 'bob', 'file': 'File:B.jpg', 'edit_type': 'depicts', 'edit_action': 'add',
+            'country': '', 'depict_item': 'Q146', 'depict_prominent': True, 'caption_text': None,
+            'caption_language': None, 'date': '2020-03-02'
+        })
+
+    @unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+    def test_download_parquet(self):
+        response = app.test_client().get('/campaigns/{}/download_csv?format=parquet'.format(self.campaign_id))
+        self.assertEqual(response.status_code, 200)
+        table = export.pyarrow.parquet.read_table(io.BytesIO(response.get_data()))
+        self.assertEqual(table.column_names, export.EXPORT_FIELDS)
+        self.assertEqual(table.column('username').to_pylist(), ['alice', 'bob', 'alice'])
+        self.assertEqual(table.column('date').to_pylist()[1], date(2020, 3, 2))
+
+    def test_download_unknown_format(self):
+        response = app.test_client().get('/campaigns/{}/download_csv?format=xls'.format(self.campaign_id))
+        self.assertEqual(response.status_code, 400)
+
+    def test_download_csv_unknown_campaign(self):
+        response = app.test_client().get('/campaigns/999/download_csv')
+        self.assertEqual(response.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
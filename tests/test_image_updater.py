@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Unit tests for updating campaign images
+
+from datetime import datetime
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa import app, db
+from isa.campaigns import image_updater
+from isa.campaigns.image_updater import (CategoryCrawler, CountryCache, ImageBuffer,
+                                        ImageUpdater, UpdateImageException)
+from isa.models import Campaign, Country, Image, User
+from isa.utils import cache
+
+
+# Category members returned by the fake API, keyed by category and
+# continue string.
+CATEGORY_PAGES = {
+    ("Category:Images from Wiki Loves Earth 2020", None): {
+        "query": {"categorymembers": [
+            {"type": "subcat", "title": "Category:Images from Wiki Loves Earth 2020 in Sweden", "pageid": 1},
+            {"type": "subcat", "title": "Category:Images from Wiki Loves Earth 2020 in Ghana", "pageid": 2},
+            {"type": "file", "title": "File:Without country.jpg", "pageid": 3},
+        ]}
+    },
+    ("Category:Images from Wiki Loves Earth 2020 in Sweden", None): {
+        "query": {"categorymembers": [
+            {"type": "file", "title": "File:Lake.jpg", "pageid": 10},
+            {"type": "file", "title": "File:Notes.pdf", "pageid": 11},
+        ]},
+        "continue": {"cmcontinue": "page2"}
+    },
+    ("Category:Images from Wiki Loves Earth 2020 in Sweden", "page2"): {
+        "query": {"categorymembers": [
+            {"type": "file", "title": "File:Forest.png", "pageid": 12},
+            {"type": "subcat", "title": "Category:Images from Wiki Loves Earth 2020 in Ghana", "pageid": 2},
+        ]}
+    },
+    ("Category:Images from Wiki Loves Earth 2020 in Ghana", None): {
+        "query": {"categorymembers": [
+            {"type": "file", "title": "File:Beach.JPG", "pageid": 20},
+        ]}
+    },
+}
+
+
+def fake_api_get(parameters, retries=0):
+    return CATEGORY_PAGES[(parameters["cmtitle"], parameters.get("cmcontinue"))]
+
+
+class TestImageUpdater(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        self.checkpoint_dir = tempfile.TemporaryDirectory()
+        app.config['IMAGE_UPDATER_CHECKPOINT_DIR'] = self.checkpoint_dir.name
+        db.create_all()
+
+        manager = User(username='TestUsername', caption_languages='en', depicts_language='en')
+        db.session.add(manager)
+        db.session.commit()
+
+        campaign = Campaign(
+            campaign_name='Wiki Loves Earth 2020',
+            categories='[{"name":"Images from Wiki Loves Earth 2020","depth":"0"}]',
+            start_date=datetime.strptime('2020-02-01', '%Y-%m-%d'),
+            manager_id=manager.id,
+            short_description='Test campaign for unit test purposes',
+            long_description='',
+            creation_date=datetime.now().date(),
+            campaign_type=1)
+        db.session.add(campaign)
+        db.session.commit()
+        self.campaign_id = campaign.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.config.pop('IMAGE_UPDATER_WORKERS', None)
+        app.config.pop('IMAGE_UPDATER_CHECKPOINT_DIR', None)
+        self.checkpoint_dir.cleanup()
+
+    def _update(self, workers, incremental=False):
+        app.config['IMAGE_UPDATER_WORKERS'] = workers
+        with mock.patch.object(ImageUpdater, '_api_get', side_effect=fake_api_get) as api_get:
+            self.result = ImageUpdater(self.campaign_id, incremental).update_images()
+        images = {
+            (image.page_id, image.country.name)
+            for image in Image.query.filter_by(campaign_id=self.campaign_id)
+        }
+        return images, api_get.call_count
+
+    def test_update_images_sequential(self):
+        images, requests_sent = self._update(workers=1)
+        self.assertEqual(images, {(10, 'Sweden'), (12, 'Sweden'), (20, 'Ghana')})
+        self.assertEqual(requests_sent, 4)
+
+    def test_update_images_concurrent_matches_sequential(self):
+        sequential_images, _ = self._update(workers=1)
+        concurrent_images, requests_sent = self._update(workers=4)
+        self.assertEqual(concurrent_images, sequential_images)
+        # Each category page is only requested once.
+        self.assertEqual(requests_sent, 4)
+
+    def test_update_images_sets_status_and_count(self):
+        self._update(workers=4)
+        campaign = Campaign.query.get(self.campaign_id)
+        self.assertEqual(campaign.update_status, image_updater.DONE)
+        self.assertEqual(campaign.campaign_images, 3)
+        self.assertEqual(Country.query.count(), 2)
+
+    def test_update_images_incremental(self):
+        full_images, _ = self._update(workers=1)
+        ghana = Country.query.filter_by(name='Ghana').first()
+        kept_ids = {image.id for image in Image.query.filter(Image.page_id.in_([10, 12]))}
+        # An image that was removed from the categories and one that
+        # was added since the last update.
+        db.session.add(Image(page_id=99, campaign_id=self.campaign_id, country_id=ghana.id))
+        Image.query.filter_by(page_id=20).delete()
+        db.session.commit()
+
+        images, _ = self._update(workers=2, incremental=True)
+
+        self.assertEqual(images, full_images)
+        self.assertEqual(self.result, {'added': 1, 'removed': 1})
+        # Images that are still in the categories are kept.
+        self.assertTrue(kept_ids <= {image.id for image in Image.query})
+        self.assertEqual(Campaign.query.get(self.campaign_id).campaign_images, 3)
+
+    def test_update_waits_for_running_update(self):
+        cache._backend = cache.MemoryBackend()
+        running = image_updater.UpdateLock(self.campaign_id)
+        self.assertTrue(running.acquire())
+        with mock.patch.object(ImageUpdater, '_api_get', side_effect=fake_api_get) as api_get:
+            with self.assertRaises(image_updater.UpdateInProgressException):
+                image_updater.update(self.campaign_id)
+            # The task doesn't retry
+            self.assertIsNone(image_updater.update_task.apply(args=(self.campaign_id,)).result)
+            api_get.assert_not_called()
+
+            running.release()
+            self.assertIsNotNone(image_updater.update(self.campaign_id))
+        # The lock is released after the update
+        self.assertTrue(image_updater.UpdateLock(self.campaign_id).acquire())
+
+    def test_update_lock_is_only_released_by_holder(self):
+        cache._backend = cache.MemoryBackend()
+        first = image_updater.UpdateLock(self.campaign_id)
+        second = image_updater.UpdateLock(self.campaign_id)
+        self.assertTrue(first.acquire())
+        second.release()
+        self.assertFalse(second.acquire())
+
+    @mock.patch('isa.campaigns.image_updater.CHECKPOINT_INTERVAL', 0)
+    def test_update_images_resumes_from_checkpoint(self):
+        app.config['IMAGE_UPDATER_WORKERS'] = 1
+        failing_category = "Category:Images from Wiki Loves Earth 2020 in Ghana"
+
+        def failing_api_get(parameters, retries=0):
+            if parameters["cmtitle"] == failing_category:
+                raise UpdateImageException("API request failed.")
+            return fake_api_get(parameters)
+
+        with mock.patch.object(ImageUpdater, '_api_get', side_effect=failing_api_get):
+            with self.assertRaises(UpdateImageException):
+                ImageUpdater(self.campaign_id).update_images()
+
+        with mock.patch.object(ImageUpdater, '_api_get', side_effect=fake_api_get) as api_get:
+            result = ImageUpdater(self.campaign_id).update_images()
+
+        # The root category was processed before the failure, so only
+        # its subcategories are requested again.
+        requested = [call.args[0]["cmtitle"] for call in api_get.call_args_list]
+        self.assertIn(failing_category, requested)
+        self.assertNotIn("Category:Images from Wiki Loves Earth 2020", requested)
+        self.assertEqual(result['added'], 3)
+        page_ids = sorted(image.page_id for image in Image.query.filter_by(campaign_id=self.campaign_id))
+        self.assertEqual(page_ids, [10, 12, 20])
+        self.assertEqual(os.listdir(self.checkpoint_dir.name), [])
+
+    def test_category_crawler_yields_pages(self):
+        root = "Category:Images from Wiki Loves Earth 2020"
+        processed = {root}
+        crawler = CategoryCrawler(fake_api_get, [(root, 1, None)], processed, workers=2)
+        pages = []
+        for category, files in crawler:
+            self.assertLessEqual(len(crawler._in_flight), 2)
+            pages.append((category, [member["pageid"] for member in files]))
+
+        self.assertEqual(len(pages), 4)
+        self.assertIn((root, [3]), pages)
+        self.assertIn(("Category:Images from Wiki Loves Earth 2020 in Sweden", [10, 11]), pages)
+        self.assertIn(("Category:Images from Wiki Loves Earth 2020 in Sweden", [12]), pages)
+        self.assertEqual(crawler.pending, [])
+        self.assertEqual(len(processed), 3)
+
+    def test_image_buffer_flushes_rows_and_counts(self):
+        buffer = ImageBuffer(self.campaign_id, size=2)
+        buffer.add(1)
+        self.assertFalse(buffer.is_full())
+        buffer.add(2)
+        self.assertTrue(buffer.is_full())
+        buffer.flush()
+        buffer.add(3)
+        buffer.flush()
+        db.session.commit()
+
+        self.assertEqual(buffer.count, 3)
+        self.assertFalse(buffer.is_full())
+        page_ids = [image.page_id for image in Image.query.filter_by(campaign_id=self.campaign_id)]
+        self.assertEqual(sorted(page_ids), [1, 2, 3])
+
+    def test_update_images_reuses_existing_country(self):
+        sweden = Country(name='Sweden')
+        db.session.add(sweden)
+        db.session.commit()
+
+        self._update(workers=1)
+        self.assertEqual(Country.query.filter_by(name='Sweden').count(), 1)
+        image = Image.query.filter_by(page_id=10).first()
+        self.assertEqual(image.country_id, sweden.id)
+
+    def test_country_cache_adds_missing_countries(self):
+        db.session.add(Country(name='Sweden'))
+        db.session.commit()
+
+        cache = CountryCache()
+        ids = cache.get_ids({'Sweden', 'Ghana', 'Nepal'})
+        db.session.commit()
+
+        self.assertEqual(set(ids), {'Sweden', 'Ghana', 'Nepal'})
+        self.assertEqual(Country.query.count(), 3)
+        for name, country_id in ids.items():
+            self.assertEqual(Country.query.get(country_id).name, name)
+        # Known countries are not added again.
+        self.assertEqual(cache.get_ids(['Ghana']), {'Ghana': ids['Ghana']})
+        self.assertEqual(Country.query.count(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
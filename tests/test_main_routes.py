@@ -3,18 +3,23 @@
 # Author: Eugene Egbe
 # Unit tests for the routes in the isa tool
 
+from datetime import date
 import json
 import os
 import sys
 import unittest
 
+from sqlalchemy import event
+
 # Ensure project root (containing the `isa` package) is on sys.path
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
 from isa import app, db
-from isa.main.routes import _stats_cache
+from isa.campaigns import stats as campaign_stats
+from isa.main.routes import _compute_stats, _get_homepage_stats
+from isa.utils import cache
 from isa.models import User, Campaign, Contribution
 
 
@@ -33,8 +38,7 @@ class TestMain(unittest.TestCase):
         db.create_all()
 
         # Reset in-memory stats cache before each test to avoid cross-test leakage
-        _stats_cache['data'] = None
-        _stats_cache['ts'] = 0
+        cache._backend = cache.MemoryBackend()
 
     # executed after each test
     def tearDown(self):
@@ -187,5 +191,121 @@ class TestMain(unittest.TestCase):
         self.assertGreaterEqual(len(detailed.keys()), 1)
 
 
+class TestYearlyStats(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+        cache._backend = cache.MemoryBackend()
+
+        users = [User(username='user{}'.format(i), caption_languages='en', depicts_language='en') for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        campaign = Campaign(campaign_name='Test Campaign', categories='[]', manager_id=users[0].id,
+                            short_description='', long_description='',
+                            start_date=date(2019, 1, 1), creation_date=date(2019, 1, 1))
+        db.session.add(campaign)
+        db.session.commit()
+
+        # 2019: 3, 1 and 1 contributions. 2020: none. 2021: 2 by one user.
+        contributions = [(users[0], date(2019, 1, 1))] * 3 + [(users[1], date(2019, 12, 31)),
+                                                             (users[2], date(2019, 6, 1)),
+                                                             (users[0], date(2021, 1, 1)),
+                                                             (users[0], date(2021, 5, 1))]
+        for i, (user, day) in enumerate(contributions):
+            db.session.add(Contribution(user=user, campaign_id=campaign.id, file='File:{}.jpg'.format(i),
+                                        edit_type='captions', edit_action='add', country='', date=day))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_compute_stats(self):
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            stats = _compute_stats()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+        # The snapshot and the contributions are read once, however many
+        # years there are
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(stats['growth_trends'], {
+            'years': ['2019', '2020', '2021'],
+            'contributions': [5, 0, 2],
+            'contributors': [3, 0, 1]
+        })
+        self.assertEqual(stats['detailed_stats']['2019'], {
+            'num_contributions': 5, 'num_contributors': 3,
+            'max_contributions': 3, 'min_contributions': 1,
+            'avg_contributions': 2, 'median_contributions': 1,
+            'p90_contributions': 3,
+            'top_5_share': 60, 'top_10_share': 60, 'top_20_share': 60,
+            'gini': 0.267,
+            'histogram': [{'min': 1, 'max': 1, 'users': 2}, {'min': 2, 'max': 3, 'users': 1}],
+        })
+        self.assertEqual(stats['distribution']['2020']['histogram'], [])
+        self.assertEqual(stats['averages']['p90'], [3, 0, 2])
+        self.assertEqual(stats['yoy_change']['contribution_change'], [-100, 0])
+
+
+class TestHomepageStats(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+        cache._backend = cache.MemoryBackend()
+
+        user = User(username='testuser', caption_languages='en', depicts_language='en')
+        db.session.add(user)
+        db.session.commit()
+        campaign = Campaign(campaign_name='Test Campaign', categories='[]', manager_id=user.id,
+                            short_description='', long_description='',
+                            start_date=date(2020, 1, 1), creation_date=date(2020, 1, 1))
+        db.session.add(campaign)
+        db.session.commit()
+        contributions = [
+            Contribution(user=user, campaign_id=campaign.id, file='File:{}.jpg'.format(i), edit_type='captions',
+                         edit_action='add', country='', caption_language=language, date=date(2020, 3, 1))
+            for i, language in enumerate(['en', 'sv', 'en', None])
+        ]
+        db.session.add_all(contributions)
+        campaign_stats.record_contributions(contributions)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_homepage_stats_are_cached(self):
+        self.assertEqual(_get_homepage_stats(), {
+            'active_campaigns': 1,
+            'contributions_count': 4,
+            'languages_count': 2
+        })
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            response = app.test_client().get('/')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([s for s in statements if 'contribution' in s.lower()])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Checks that the hot stats and image queries use the composite indexes.
+#
+# The query plans are read with EXPLAIN QUERY PLAN, so these tests only
+# run against SQLite. The indexes are defined in isa/models.py and added
+# by the 3f2a9c1d7b64 migration. Where the query is issued by a function,
+# the statements it executes are captured and explained.
+
+from contextlib import contextmanager
+from datetime import date
+import os
+import sys
+import unittest
+
+from sqlalchemy import event
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa import app, db
+from isa.campaigns import export, stats
+from isa.main import yearly_stats
+from isa.models import Contribution, Image, Suggestion
+
+# SQLite names the index of the uq_contribution_rollup_key constraint itself.
+ROLLUP_KEY_INDEX = 'sqlite_autoindex_contribution_rollup_1'
+
+
+@unittest.skipUnless(app.config['SQLALCHEMY_TEST_DATABASE_URI'].startswith('sqlite'),
+                     'Query plans are checked with SQLite')
+class TestQueryPlans(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def assertUsesIndex(self, query, index_name):
+        statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+        self.assertIn(index_name, self._explain(str(statement)))
+
+    def assertStatementUsesIndex(self, statements, table, *index_names):
+        """Check that the captured statements reading from a table use one of the indexes"""
+        plans = [self._explain(statement, parameters)
+                 for statement, parameters in statements if 'FROM {}'.format(table) in statement]
+        self.assertTrue(plans)
+        for plan in plans:
+            self.assertTrue(any(index_name in plan for index_name in index_names), plan)
+
+    def _explain(self, statement, parameters=()):
+        plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        return ' '.join(row[-1] for row in plan)
+
+    @contextmanager
+    def captured_statements(self):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+    def test_campaign_stats(self):
+        with self.captured_statements() as statements:
+            stats.get_campaign_stats(1, date(2020, 1, 1), date(2020, 12, 31))
+        self.assertStatementUsesIndex(statements, 'contribution_rollup', ROLLUP_KEY_INDEX)
+
+    def test_new_participants(self):
+        contribution = Contribution(campaign_id=1, user_id=1)
+        with self.captured_statements() as statements:
+            stats._new_participants([contribution])
+        self.assertStatementUsesIndex(statements, 'contribution_rollup', ROLLUP_KEY_INDEX)
+
+    def test_campaign_export(self):
+        with self.captured_statements() as statements:
+            list(export.get_contribution_rows(1))
+        # Any of the indexes starting with the campaign id will do
+        self.assertStatementUsesIndex(statements, 'contribution',
+                                      'ix_contribution_campaign_id_user_id', 'ix_contribution_campaign_id_edit_type')
+
+    def test_reconcile_campaign_counters(self):
+        with self.captured_statements() as statements:
+            stats.reconcile_campaign_counters([1])
+        self.assertStatementUsesIndex(statements, 'contribution', 'ix_contribution_campaign_id_user_id')
+
+    def test_contribution_histograms_by_year(self):
+        with self.captured_statements() as statements:
+            yearly_stats.contribution_histograms_by_year(date(2020, 1, 1), date(2021, 1, 1))
+        self.assertStatementUsesIndex(statements, 'contribution', 'ix_contribution_date')
+
+    def test_top_depicts(self):
+        query = (Contribution.query
+                 .with_entities(Contribution.depict_item)
+                 .filter_by(campaign_id=1, edit_type='depicts', edit_action='add')
+                 .group_by(Contribution.depict_item))
+        self.assertUsesIndex(query, 'ix_contribution_campaign_id_edit_type')
+
+    def test_user_contributions_in_date_range(self):
+        query = Contribution.query.filter(
+            Contribution.user_id == 1,
+            Contribution.date >= '2020-01-01',
+            Contribution.date <= '2020-12-31'
+        )
+        self.assertUsesIndex(query, 'ix_contribution_user_id_date')
+
+    def test_campaign_images_in_country(self):
+        query = (Image.query
+                 .filter(Image.campaign_id == 1, Image.country_id == 2)
+                 .order_by(Image.page_id))
+        self.assertUsesIndex(query, 'ix_image_campaign_id_country_id_page_id')
+
+    def test_rejected_suggestions(self):
+        query = Suggestion.query.filter_by(user_id=1, file_name='File:Test.jpg', update_status=0)
+        self.assertUsesIndex(query, 'ix_suggestion_user_id_file_name_update_status')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Unit tests for the campaign statistics files
+
+import csv
+from datetime import date
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa import app, db
+from isa.campaigns import stats, stats_files
+from isa.models import Campaign, Contribution, User
+from isa.utils import cache
+
+
+class TestStatsFiles(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+        cache._backend = cache.MemoryBackend()
+
+        self.directory = tempfile.mkdtemp()
+        directory_patcher = patch.object(stats_files, 'get_stats_directory',
+                                         lambda campaign_id: os.path.join(self.directory, str(campaign_id)))
+        directory_patcher.start()
+        self.addCleanup(directory_patcher.stop)
+
+        self.alice = User(username='alice', caption_languages='en', depicts_language='en')
+        self.bob = User(username='bob', caption_languages='en', depicts_language='en')
+        db.session.add_all([self.alice, self.bob])
+        db.session.commit()
+
+        campaign = Campaign(campaign_name='Test Campaign',
+                            categories='[]',
+                            start_date=date(2020, 2, 1),
+                            manager_id=self.alice.id,
+                            short_description='',
+                            long_description='',
+                            creation_date=date(2020, 2, 1))
+        db.session.add(campaign)
+        db.session.commit()
+        self.campaign_id = campaign.id
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+
+    def _add_contributions(self, user, country, count):
+        contributions = [
+            Contribution(user=user,
+                         campaign_id=self.campaign_id,
+                         file='File:Test_{}.jpg'.format(i),
+                         edit_type='captions',
+                         edit_action='add',
+                         country=country,
+                         date=date(2020, 3, 1))
+            for i in range(count)
+        ]
+        db.session.add_all(contributions)
+        stats.record_contributions(contributions)
+        db.session.commit()
+
+    def _read_csv(self, file_name):
+        path = os.path.join(stats_files.get_stats_directory(self.campaign_id), file_name)
+        with open(path, encoding='UTF-8') as csv_file:
+            return list(csv.DictReader(csv_file))
+
+    def test_write_stats_files(self):
+        self._add_contributions(self.alice, 'Ghana', 2)
+        self._add_contributions(self.bob, 'Sweden', 1)
+
+        self.assertTrue(stats_files.write_stats_files(self.campaign_id))
+
+        self.assertEqual(self._read_csv('Test_Campaign_stats.csv'), [
+            {'rank': '1', 'username': 'alice', 'images_improved': '2'},
+            {'rank': '2', 'username': 'bob', 'images_improved': '1'},
+        ])
+        self.assertEqual(self._read_csv('Test_Campaign_country_stats.csv'), [
+            {'rank': '1', 'country': 'Ghana', 'images_improved': '2'},
+            {'rank': '2', 'country': 'Sweden', 'images_improved': '1'},
+        ])
+        self.assertEqual(stats_files.read_version(self.campaign_id),
+                         stats_files.get_data_version(Campaign.query.get(self.campaign_id)))
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(stats_files.get_stats_directory(self.campaign_id))),
+                         ['Test_Campaign_country_stats.csv', 'Test_Campaign_stats.csv', 'version'])
+
+    def test_write_stats_files_only_when_changed(self):
+        self._add_contributions(self.alice, 'Ghana', 1)
+        self.assertTrue(stats_files.write_stats_files(self.campaign_id))
+        self.assertFalse(stats_files.write_stats_files(self.campaign_id))
+
+        self._add_contributions(self.bob, 'Ghana', 1)
+        self.assertTrue(stats_files.write_stats_files(self.campaign_id))
+        self.assertEqual(len(self._read_csv('Test_Campaign_stats.csv')), 2)
+
+    def test_write_stats_files_after_rename(self):
+        self._add_contributions(self.alice, 'Ghana', 1)
+        self.assertTrue(stats_files.write_stats_files(self.campaign_id))
+
+        campaign = Campaign.query.get(self.campaign_id)
+        campaign.campaign_name = 'Renamed Campaign'
+        db.session.commit()
+        with patch.object(stats_files.write_stats_files_task, 'delay') as delay:
+            self.assertTrue(stats_files.update_stats_files(campaign))
+        delay.assert_called_once_with(self.campaign_id)
+
+        self.assertTrue(stats_files.write_stats_files(self.campaign_id))
+        self.assertEqual(sorted(os.listdir(stats_files.get_stats_directory(self.campaign_id))),
+                         ['Renamed_Campaign_country_stats.csv', 'Renamed_Campaign_stats.csv', 'version'])
+        self.assertEqual(len(self._read_csv('Renamed_Campaign_stats.csv')), 1)
+
+    def test_update_stats_files_starts_task_when_out_of_date(self):
+        self._add_contributions(self.alice, 'Ghana', 1)
+        campaign = Campaign.query.get(self.campaign_id)
+        with patch.object(stats_files.write_stats_files_task, 'delay') as delay:
+            self.assertTrue(stats_files.update_stats_files(campaign))
+            stats_files.write_stats_files_task(self.campaign_id)
+            self.assertFalse(stats_files.update_stats_files(campaign))
+
+        delay.assert_called_once_with(self.campaign_id)
+
+    def test_update_stats_files_starts_one_task_at_a_time(self):
+        self._add_contributions(self.alice, 'Ghana', 1)
+        campaign = Campaign.query.get(self.campaign_id)
+        with patch.object(stats_files.write_stats_files_task, 'delay') as delay:
+            self.assertTrue(stats_files.update_stats_files(campaign))
+            self._add_contributions(self.bob, 'Ghana', 1)
+            self.assertFalse(stats_files.update_stats_files(campaign))
+            self.assertEqual(delay.call_count, 1)
+
+            # Once the task has run, a new one can be started
+            stats_files.write_stats_files_task(self.campaign_id)
+            self._add_contributions(self.bob, 'Ghana', 1)
+            self.assertTrue(stats_files.update_stats_files(Campaign.query.get(self.campaign_id)))
+            self.assertEqual(delay.call_count, 2)
+
+    def test_campaign_page_does_not_write_files(self):
+        self._add_contributions(self.alice, 'Ghana', 1)
+        with patch.object(stats_files.write_stats_files_task, 'delay') as delay:
+            response = app.test_client().get('/campaigns/{}'.format(self.campaign_id))
+
+        self.assertEqual(response.status_code, 200)
+        delay.assert_called_once_with(self.campaign_id)
+        self.assertFalse(os.path.exists(stats_files.get_stats_directory(self.campaign_id)))
+
+
+if __name__ == '__main__':
+    unittest.main()
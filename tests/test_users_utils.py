@@ -104,6 +104,16 @@ class TestUsersUtils(unittest.TestCase):
 
 		self.assertEqual(rank, 2)
 
+	def test_get_user_ranking_shares_rank_for_ties(self):
+		all_data = [
+			{'username': 'alice', 'images_improved': 5},
+			{'username': 'bob', 'images_improved': 5},
+			{'username': 'charlie', 'images_improved': 1},
+		]
+
+		self.assertEqual(get_user_ranking(all_data, 'bob'), 1)
+		self.assertEqual(get_user_ranking(all_data, 'charlie'), 3)
+
 	def test_get_user_ranking_not_found_returns_zero(self):
 		all_data = [
 			{'username': 'alice', 'images_improved': 5},
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Unit tests for the yearly stats and their snapshot
+
+from datetime import date
+import json
+import os
+import sys
+import unittest
+
+from sqlalchemy import event
+
+# Ensure the project root (containing the "isa" package) is on sys.path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from isa import app, db
+from isa.main import yearly_stats
+from isa.models import Campaign, Contribution, User, YearlyStats
+
+
+class TestYearlyStats(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+        db.create_all()
+
+        self.alice = User(username='alice', caption_languages='en', depicts_language='en')
+        self.bob = User(username='bob', caption_languages='en', depicts_language='en')
+        db.session.add_all([self.alice, self.bob])
+        db.session.commit()
+        campaign = Campaign(campaign_name='Test Campaign', categories='[]', manager_id=self.alice.id,
+                            short_description='', long_description='',
+                            start_date=date(2018, 1, 1), creation_date=date(2018, 1, 1))
+        db.session.add(campaign)
+        db.session.commit()
+        self.campaign_id = campaign.id
+
+        self._add_contributions([(self.alice, date(2018, 12, 31)),
+                                 (self.alice, date(2018, 1, 1)),
+                                 (self.bob, date(2018, 6, 1)),
+                                 (self.bob, date(2020, 1, 1)),
+                                 (self.alice, date(2021, 3, 1))])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def _add_contributions(self, contributions):
+        for user, day in contributions:
+            db.session.add(Contribution(user=user, campaign_id=self.campaign_id, file='File:Test.jpg',
+                                        edit_type='captions', edit_action='add', country='', date=day))
+        db.session.commit()
+
+    def test_contribution_histograms_by_year(self):
+        histograms = yearly_stats.contribution_histograms_by_year(start_date=date(2018, 6, 1),
+                                                                  end_date=date(2021, 1, 1))
+        self.assertEqual(sorted(histograms), [2018, 2020])
+        distribution, num_contributors = histograms[2018]
+        self.assertEqual((distribution.num_users, distribution.total, num_contributors), (2, 2, 2))
+        distribution, num_contributors = histograms[2020]
+        self.assertEqual((distribution.num_users, distribution.total, num_contributors), (1, 1, 1))
+
+    def test_year_stats(self):
+        distribution, num_contributors = yearly_stats.contribution_histograms_by_year()[2018]
+        stats = yearly_stats.year_stats(distribution, num_contributors)
+        self.assertEqual(stats['num_contributions'], 3)
+        self.assertEqual(stats['max_contributions'], 2)
+        self.assertEqual(stats['median_contributions'], 2)
+        self.assertEqual(stats['top_5_share'], 67)
+        self.assertEqual(stats['histogram'], [{'min': 1, 'max': 1, 'users': 1}, {'min': 2, 'max': 3, 'users': 1}])
+        self.assertEqual(yearly_stats.year_stats()['num_contributions'], 0)
+
+    def test_write_snapshot(self):
+        years = yearly_stats.write_snapshot(today=date(2021, 6, 1))
+        db.session.commit()
+
+        # The ended years, including 2019 without contributions
+        self.assertEqual(years, 3)
+        snapshot = {row.year: json.loads(row.stats) for row in YearlyStats.query}
+        self.assertEqual(sorted(snapshot), [2018, 2019, 2020])
+        self.assertEqual(snapshot[2018]['num_contributions'], 3)
+        self.assertEqual(snapshot[2018]['num_contributors'], 2)
+        self.assertEqual(snapshot[2019]['num_contributions'], 0)
+
+        # Writing again replaces the snapshot
+        self.assertEqual(yearly_stats.write_snapshot(today=date(2019, 6, 1)), 1)
+        db.session.commit()
+        self.assertEqual([row.year for row in YearlyStats.query], [2018])
+
+    def test_get_yearly_stats_without_snapshot(self):
+        stats = yearly_stats.get_yearly_stats()
+        self.assertEqual(sorted(stats), [2018, 2020, 2021])
+        self.assertEqual(stats[2018]['num_contributions'], 3)
+
+    def test_get_yearly_stats_merges_snapshot(self):
+        yearly_stats.write_snapshot(today=date(2021, 6, 1))
+        db.session.commit()
+        # Contributions to ended years are only counted when the snapshot
+        # is written again
+        self._add_contributions([(self.bob, date(2018, 2, 1)), (self.bob, date(2021, 4, 1))])
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            stats = yearly_stats.get_yearly_stats()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+        self.assertEqual(sorted(stats), [2018, 2019, 2020, 2021])
+        self.assertEqual(stats[2018]['num_contributions'], 3)
+        self.assertEqual(stats[2021]['num_contributions'], 2)
+        self.assertEqual(stats[2021]['num_contributors'], 2)
+        # Only contributions after the snapshot are read
+        self.assertIn('contribution.date >=', statements[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,4 +2,4 @@
 
 cd ~/www/python/src
 source ~/www/python/venv/bin/activate
-celery -A isa.celery_app --config isa/config.yaml worker --loglevel DEBUG
+celery -A isa.celery_app --config isa/config.yaml worker --beat --loglevel DEBUG